@@ -10,13 +10,32 @@
 
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
-import pandas as pd
-import numpy as np
-import math
-from scipy.optimize import minimize
-from scipy import stats
 import threading
 import os
+import contextlib
+
+import pemcafe_profiling
+
+# pandas, numpy and the model engine take seconds to import; they are loaded by
+# load_numerics() in the background once the window is up (or on first use),
+# so the window appears at once and worker processes re-importing this module stay cheap
+pd = None
+np = None
+pemcafe_cache = None
+pemcafe_engine = None
+_numerics_lock = threading.Lock()
+
+
+def load_numerics():
+    """Import the numerical stack and the model engine on first use"""
+    global pd, np, pemcafe_cache, pemcafe_engine
+    with _numerics_lock:
+        if pemcafe_engine is None:
+            import pandas as pd
+            import numpy as np
+            import pemcafe_cache
+            import pemcafe_engine
+
 
 class PEMCAFEModelGUI:
     def __init__(self, root):
@@ -28,17 +47,30 @@ class PEMCAFEModelGUI:
         self.df = None
         self.results = None
         self.optimized_params = None
+        self.mc_values = None
+        self.mc_variables = None
+        self.profiler = None
+        self.profile_info = {}
+        self.run_in_progress = False
+        self.job_queue = None
+        self.polling_jobs = False
         
         # Create notebook for tabs
         self.notebook = ttk.Notebook(root)
         self.notebook.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
         
-        # Create tabs
-        self.create_file_tab()
-        self.create_parameters_tab()
-        self.create_input_uncertainty_tab()
-        self.create_model_settings_tab()
-        self.create_results_tab()
+        # Create tabs (the content of a tab is built the first time it is shown)
+        self.tabs = []
+        self.built_tabs = set()
+        self.add_tab("File & Data", self.create_file_tab)
+        self.add_tab("Model Parameters", self.create_parameters_tab)
+        self.add_tab("Input Uncertainty", self.create_input_uncertainty_tab)
+        self.add_tab("Model Settings", self.create_model_settings_tab)
+        self.add_tab("Results", self.create_results_tab)
+        self.add_tab("Job Queue", self.create_jobs_tab)
+        self.add_tab("Plots", self.create_plots_tab)
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+        self.build_tab(0)
         
         # Status bar
         self.status_var = tk.StringVar()
@@ -46,10 +78,42 @@ class PEMCAFEModelGUI:
         self.status_bar = ttk.Label(root, textvariable=self.status_var, relief=tk.SUNKEN)
         self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
         
-    def create_file_tab(self):
+        # Import the numerical stack while the user picks a file
+        self.root.after(100, lambda: threading.Thread(target=load_numerics, daemon=True).start())
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        
+    def add_tab(self, title, builder):
+        """Add an empty tab; builder(frame) fills it on first use"""
+        frame = ttk.Frame(self.notebook)
+        self.notebook.add(frame, text=title)
+        self.tabs.append((frame, builder))
+        
+    def build_tab(self, index):
+        """Build the content of a tab if that has not happened yet"""
+        if index not in self.built_tabs:
+            self.built_tabs.add(index)
+            frame, builder = self.tabs[index]
+            builder(frame)
+            
+    def build_all_tabs(self):
+        """Build every tab (runs read settings from all of them)"""
+        for index in range(len(self.tabs)):
+            self.build_tab(index)
+            
+    def on_tab_changed(self, event):
+        self.build_tab(self.notebook.index("current"))
+        
+    def on_close(self):
+        """Stop the job workers before closing the window"""
+        if self.job_queue is not None:
+            if self.job_queue.active() and not messagebox.askyesno(
+                    "Quit", "Queued jobs are still running. Quit and abandon them?"):
+                return
+            self.job_queue.close()
+        self.root.destroy()
+        
+    def create_file_tab(self, file_frame):
         """File operations tab"""
-        file_frame = ttk.Frame(self.notebook)
-        self.notebook.add(file_frame, text="File & Data")
         
         # File selection
         ttk.Label(file_frame, text="Input CSV File:", font=('Arial', 12, 'bold')).pack(pady=10)
@@ -78,10 +142,8 @@ class PEMCAFEModelGUI:
         h_scrollbar.pack(side=tk.BOTTOM, fill=tk.X)
         self.data_tree.configure(xscrollcommand=h_scrollbar.set)
         
-    def create_parameters_tab(self):
+    def create_parameters_tab(self, param_frame):
         """Model parameters tab"""
-        param_frame = ttk.Frame(self.notebook)
-        self.notebook.add(param_frame, text="Model Parameters")
         
         # Create scrollable frame
         canvas = tk.Canvas(param_frame)
@@ -170,10 +232,8 @@ class PEMCAFEModelGUI:
         canvas.pack(side="left", fill="both", expand=True)
         scrollbar.pack(side="right", fill="y")
         
-    def create_input_uncertainty_tab(self):
+    def create_input_uncertainty_tab(self, uncertainty_frame):
         """Input uncertainty tab"""
-        uncertainty_frame = ttk.Frame(self.notebook)
-        self.notebook.add(uncertainty_frame, text="Input Uncertainty")
         
         ttk.Label(uncertainty_frame, text="Standard Deviations for Input Variables", font=('Arial', 14, 'bold')).pack(pady=10)
         
@@ -198,11 +258,10 @@ class PEMCAFEModelGUI:
             ttk.Entry(frame, textvariable=sd_var, width=15).pack(side=tk.LEFT, padx=10)
             ttk.Label(frame, text="Standard deviation for Monte Carlo simulation", foreground='gray').pack(side=tk.LEFT, padx=10)
     
-    def create_model_settings_tab(self):
+    def create_model_settings_tab(self, settings_frame):
         """Model settings tab"""
-        settings_frame = ttk.Frame(self.notebook)
-        self.notebook.add(settings_frame, text="Model Settings")
-        
+        # the option lists come from the engine
+        load_numerics()
         # Model options
         ttk.Label(settings_frame, text="Model Configuration", font=('Arial', 14, 'bold')).pack(pady=20)
         
@@ -224,6 +283,16 @@ class PEMCAFEModelGUI:
         ttk.Radiobutton(bnpp_frame, text="BGC + Dbelow (1)", variable=self.bnpp_method_var, value=1).pack(side=tk.LEFT, padx=10)
         ttk.Radiobutton(bnpp_frame, text="BGC + Soil_AR (0)", variable=self.bnpp_method_var, value=0).pack(side=tk.LEFT, padx=10)
         
+        # Time step of the input rows
+        time_step_frame = ttk.Frame(settings_frame)
+        time_step_frame.pack(fill=tk.X, padx=50, pady=10)
+        
+        ttk.Label(time_step_frame, text="Time Step of Input Rows:", width=30).pack(side=tk.LEFT)
+        self.time_step_var = tk.StringVar(value="Annual")
+        time_step_combo = ttk.Combobox(time_step_frame, textvariable=self.time_step_var, width=15, state="readonly")
+        time_step_combo['values'] = tuple(pemcafe_engine.TIME_STEPS.keys())
+        time_step_combo.pack(side=tk.LEFT, padx=10)
+        
         # Monte Carlo settings
         ttk.Label(settings_frame, text="Monte Carlo Simulation", font=('Arial', 14, 'bold')).pack(pady=(40,20))
         
@@ -234,6 +303,45 @@ class PEMCAFEModelGUI:
         self.n_simulations_var = tk.IntVar(value=1000)
         ttk.Entry(mc_frame, textvariable=self.n_simulations_var, width=15).pack(side=tk.LEFT, padx=10)
         
+        # Random seed (needed to reuse cached Monte Carlo realizations)
+        seed_frame = ttk.Frame(settings_frame)
+        seed_frame.pack(fill=tk.X, padx=50, pady=10)
+        
+        ttk.Label(seed_frame, text="Random Seed:", width=20).pack(side=tk.LEFT)
+        self.seed_var = tk.StringVar(value="")
+        ttk.Entry(seed_frame, textvariable=self.seed_var, width=15).pack(side=tk.LEFT, padx=10)
+        ttk.Label(seed_frame, text="Leave empty for a new random draw every run", foreground='gray').pack(side=tk.LEFT, padx=10)
+        
+        # Output variables (Monte Carlo keeps only these)
+        outputs_frame = ttk.Frame(settings_frame)
+        outputs_frame.pack(fill=tk.X, padx=50, pady=10)
+        
+        ttk.Label(outputs_frame, text="Output Variables:", width=20).pack(side=tk.LEFT)
+        self.output_variables_var = tk.StringVar(value="")
+        ttk.Entry(outputs_frame, textvariable=self.output_variables_var, width=40).pack(side=tk.LEFT, padx=10)
+        ttk.Label(outputs_frame, text="e.g. ANPP, BNPP, TNPP, NEP, GPP (empty = all columns)",
+                  foreground='gray').pack(side=tk.LEFT, padx=10)
+        
+        # Incremental re-run
+        incremental_frame = ttk.Frame(settings_frame)
+        incremental_frame.pack(fill=tk.X, padx=50, pady=10)
+        
+        self.incremental_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(incremental_frame, text="Resume from cached state when rows are appended to the input",
+                        variable=self.incremental_var).pack(side=tk.LEFT)
+        
+        # Result cache
+        result_cache_frame = ttk.Frame(settings_frame)
+        result_cache_frame.pack(fill=tk.X, padx=50, pady=10)
+        
+        self.result_cache_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(result_cache_frame, text="Reuse results of identical runs (MC only with a seed)",
+                        variable=self.result_cache_var).pack(side=tk.LEFT)
+        ttk.Label(result_cache_frame, text="Cache limit (MB):").pack(side=tk.LEFT, padx=(20,5))
+        self.cache_size_var = tk.DoubleVar(value=pemcafe_cache.DEFAULT_RESULT_CACHE_MB)
+        ttk.Entry(result_cache_frame, textvariable=self.cache_size_var, width=8).pack(side=tk.LEFT)
+        ttk.Button(result_cache_frame, text="Clear Cache", command=self.clear_result_cache).pack(side=tk.LEFT, padx=10)
+        
         # Confidence level
         ci_frame = ttk.Frame(settings_frame)
         ci_frame.pack(fill=tk.X, padx=50, pady=10)
@@ -251,9 +359,44 @@ class PEMCAFEModelGUI:
         ttk.Label(opt_frame, text="Optimisation Method:", width=20).pack(side=tk.LEFT)
         self.opt_method_var = tk.StringVar(value="Nelder-Mead")
         method_combo = ttk.Combobox(opt_frame, textvariable=self.opt_method_var, width=15)
-        method_combo['values'] = ("Nelder-Mead", "L-BFGS-B", "TNC", "SLSQP")
+        method_combo['values'] = pemcafe_engine.OPTIMISATION_METHODS
         method_combo.pack(side=tk.LEFT, padx=10)
         
+        surrogate_frame = ttk.Frame(settings_frame)
+        surrogate_frame.pack(fill=tk.X, padx=50, pady=5)
+        
+        self.surrogate_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(surrogate_frame, text="Find start point with surrogate (emulator)",
+                        variable=self.surrogate_var).pack(side=tk.LEFT)
+        ttk.Label(surrogate_frame, text="Screens the parameter bounds with a polynomial emulator, then fits the residuals by least squares",
+                  foreground='gray').pack(side=tk.LEFT, padx=10)
+        
+        # Instrumentation settings
+        ttk.Label(settings_frame, text="Instrumentation", font=('Arial', 14, 'bold')).pack(pady=(40,20))
+        
+        instrument_frame = ttk.Frame(settings_frame)
+        instrument_frame.pack(fill=tk.X, padx=50, pady=5)
+        
+        self.instrument_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(instrument_frame, text="Record run report (stage times, evaluations, cache hits, memory)",
+                        variable=self.instrument_var).pack(side=tk.LEFT)
+        
+        trace_frame = ttk.Frame(settings_frame)
+        trace_frame.pack(fill=tk.X, padx=50, pady=5)
+        
+        self.trace_memory_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(trace_frame, text="Trace Python memory per stage (slower)",
+                        variable=self.trace_memory_var).pack(side=tk.LEFT)
+        
+        profile_frame = ttk.Frame(settings_frame)
+        profile_frame.pack(fill=tk.X, padx=50, pady=5)
+        
+        ttk.Label(profile_frame, text="cProfile Stage:", width=20).pack(side=tk.LEFT)
+        self.profile_stage_var = tk.StringVar(value="None")
+        profile_combo = ttk.Combobox(profile_frame, textvariable=self.profile_stage_var, width=20, state="readonly")
+        profile_combo['values'] = ("None",) + pemcafe_profiling.STAGES
+        profile_combo.pack(side=tk.LEFT, padx=10)
+        
         # Run buttons
         button_frame = ttk.Frame(settings_frame)
         button_frame.pack(pady=40)
@@ -263,10 +406,8 @@ class PEMCAFEModelGUI:
         ttk.Button(button_frame, text="Run Full Analysis (with MC)", command=self.run_full_analysis, 
                   style='Accent.TButton').pack(side=tk.LEFT, padx=10)
         
-    def create_results_tab(self):
+    def create_results_tab(self, results_frame):
         """Results display tab"""
-        results_frame = ttk.Frame(self.notebook)
-        self.notebook.add(results_frame, text="Results")
         
         # Results display area
         self.results_text = tk.Text(results_frame, wrap=tk.WORD, height=30)
@@ -283,6 +424,97 @@ class PEMCAFEModelGUI:
         
         ttk.Button(export_frame, text="Export Results to CSV", command=self.export_results).pack()
         
+    def create_jobs_tab(self, jobs_frame):
+        """Job queue tab: analyses run side by side in worker processes"""
+        ttk.Label(jobs_frame, text="Job Queue", font=('Arial', 14, 'bold')).pack(pady=10)
+        ttk.Label(jobs_frame, text="Each job runs the loaded file with the current settings in its own process; "
+                  "load another file or change the settings and queue again to compare runs.",
+                  foreground='gray').pack(pady=(0, 10))
+        
+        # Queue buttons
+        queue_frame = ttk.Frame(jobs_frame)
+        queue_frame.pack(fill=tk.X, padx=10, pady=5)
+        
+        ttk.Button(queue_frame, text="Queue Optimisation",
+                   command=lambda: self.queue_job(run_mc=False)).pack(side=tk.LEFT, padx=5)
+        ttk.Button(queue_frame, text="Queue Full Analysis (with MC)",
+                   command=lambda: self.queue_job(run_mc=True)).pack(side=tk.LEFT, padx=5)
+        ttk.Label(queue_frame, text="Worker processes:").pack(side=tk.LEFT, padx=(30, 5))
+        self.job_workers_var = tk.IntVar(value=max(1, (os.cpu_count() or 2) - 1))
+        ttk.Spinbox(queue_frame, from_=1, to=os.cpu_count() or 1, textvariable=self.job_workers_var,
+                    width=5).pack(side=tk.LEFT)
+        ttk.Label(queue_frame, text="(fixed once the first job is queued)", foreground='gray').pack(side=tk.LEFT, padx=5)
+        
+        # Job list
+        columns = ("job", "file", "run", "method", "status", "progress", "time")
+        headings = ("Job", "File", "Run", "Method", "Status", "Progress", "Time (s)")
+        widths = (50, 200, 110, 110, 80, 320, 80)
+        self.jobs_tree = ttk.Treeview(jobs_frame, columns=columns, show="headings", height=15)
+        for col, heading, width in zip(columns, headings, widths):
+            self.jobs_tree.heading(col, text=heading)
+            self.jobs_tree.column(col, width=width)
+        self.jobs_tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        
+        # Job buttons
+        job_button_frame = ttk.Frame(jobs_frame)
+        job_button_frame.pack(pady=10)
+        
+        ttk.Button(job_button_frame, text="Show Results", command=self.show_job_results).pack(side=tk.LEFT, padx=5)
+        ttk.Button(job_button_frame, text="Export Results to CSV", command=self.export_job_results).pack(side=tk.LEFT, padx=5)
+        ttk.Button(job_button_frame, text="Cancel", command=self.cancel_job).pack(side=tk.LEFT, padx=5)
+        ttk.Button(job_button_frame, text="Remove", command=self.remove_job).pack(side=tk.LEFT, padx=5)
+        
+    def create_plots_tab(self, plots_frame):
+        """Plots of the current results (needs matplotlib)"""
+        load_numerics()
+        import pemcafe_plotting
+        if not pemcafe_plotting.matplotlib_available():
+            ttk.Label(plots_frame, text="Plotting needs matplotlib: pip install matplotlib",
+                      font=('Arial', 12)).pack(pady=40)
+            return
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+        
+        # Plot options
+        options_frame = ttk.Frame(plots_frame)
+        options_frame.pack(fill=tk.X, padx=10, pady=10)
+        
+        ttk.Label(options_frame, text="Variables:").pack(side=tk.LEFT)
+        self.plot_variables_var = tk.StringVar(value="NEP, TNPP")
+        ttk.Entry(options_frame, textvariable=self.plot_variables_var, width=30).pack(side=tk.LEFT, padx=5)
+        
+        ttk.Label(options_frame, text="Plot:").pack(side=tk.LEFT, padx=(15, 5))
+        self.plot_mode_var = tk.StringVar(value="CI band")
+        mode_combo = ttk.Combobox(options_frame, textvariable=self.plot_mode_var, width=12, state="readonly")
+        mode_combo['values'] = ("CI band", "Density", "Spaghetti")
+        mode_combo.pack(side=tk.LEFT)
+        
+        ttk.Label(options_frame, text="CI:").pack(side=tk.LEFT, padx=(15, 5))
+        self.plot_ci_var = tk.StringVar(value="t")
+        ci_combo = ttk.Combobox(options_frame, textvariable=self.plot_ci_var, width=10, state="readonly")
+        ci_combo['values'] = ("t", "percentile")
+        ci_combo.pack(side=tk.LEFT)
+        
+        ttk.Label(options_frame, text="Bins:").pack(side=tk.LEFT, padx=(15, 5))
+        self.plot_bins_var = tk.IntVar(value=100)
+        ttk.Entry(options_frame, textvariable=self.plot_bins_var, width=6).pack(side=tk.LEFT)
+        ttk.Label(options_frame, text="Lines:").pack(side=tk.LEFT, padx=(15, 5))
+        self.plot_lines_var = tk.IntVar(value=200)
+        ttk.Entry(options_frame, textvariable=self.plot_lines_var, width=6).pack(side=tk.LEFT)
+        
+        ttk.Button(options_frame, text="Plot", command=self.draw_plots).pack(side=tk.LEFT, padx=(20, 5))
+        ttk.Button(options_frame, text="Save Figure", command=self.save_plot).pack(side=tk.LEFT, padx=5)
+        
+        ttk.Label(plots_frame, text="Density and spaghetti plots show the raw Monte Carlo realizations, "
+                  "kept for the Output Variables set in Model Settings", foreground='gray').pack()
+        
+        # Figure
+        self.plot_figure = Figure(figsize=(10, 6))
+        self.plot_canvas = FigureCanvasTkAgg(self.plot_figure, master=plots_frame)
+        toolbar = NavigationToolbar2Tk(self.plot_canvas, plots_frame, pack_toolbar=False)
+        toolbar.pack(side=tk.BOTTOM, fill=tk.X)
+        self.plot_canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        
     def browse_file(self):
         """Browse for input CSV file"""
         filename = filedialog.askopenfilename(
@@ -300,6 +532,7 @@ class PEMCAFEModelGUI:
                 messagebox.showerror("Error", "Please select a file first")
                 return
                 
+            load_numerics()
             self.df = pd.read_csv(filepath)
             self.display_data_preview()
             self.status_var.set(f"Loaded {len(self.df)} rows from {os.path.basename(filepath)}")
@@ -351,230 +584,130 @@ class PEMCAFEModelGUI:
             
         return bounds
     
+    def get_seed(self):
+        """Get the Monte Carlo random seed from GUI (None if empty)"""
+        text = self.seed_var.get().strip()
+        return int(text) if text else None
+    
+    def get_output_variables(self):
+        """Get the output variables of interest from GUI (None if empty = all)"""
+        names = [name.strip() for name in self.output_variables_var.get().replace(';', ',').split(',')]
+        names = [name for name in names if name]
+        return names or None
+    
     def get_input_sds(self):
         """Get input standard deviations from GUI"""
         return {var: self.sd_vars[var].get() for var in self.sd_vars}
     
-    def calculate_values(self, row, prev_row, params):
-        """Calculate values for each row - same as original function"""
-        
-        # 添加保護性檢查
-        def safe_divide(a, b):
-            return a / b if abs(b) > 1e-10 else 0.0
+    def start_profiler(self):
+        """Create a RunProfiler for this run if instrumentation is enabled"""
+        if not self.instrument_var.get():
+            self.profiler = None
+            return
+        profile_stage = self.profile_stage_var.get()
+        self.profiler = pemcafe_profiling.RunProfiler(
+            trace_memory=self.trace_memory_var.get(),
+            profile_stage=None if profile_stage == "None" else profile_stage)
     
-        def safe_exp(x):
-            try:
-                return math.exp(x)
-            except:
-                return 0.0
-            
-        # 初始化prev_row為全零字典（如果為None）
-        if prev_row is None:
-            # 創建包含所有必要字段的默認prev_row
-            default_vals = {col: 0.0 for col in self.df.columns}
-            default_vals.update({
-                'Litter_layer': row['Litter_layer'] if 'Litter_layer' in row else 0.01,
-                'SC': row['SC'] if 'SC' in row else 0.01,
-                'Foliages': row['Foliages'] if 'Foliages' in row else 0.01,
-                'Branches': row['Branches'] if 'Branches' in row else 0.01,
-                'Culms': row['Culms'] if 'Culms' in row else 0.01,
-                'Stumps': row['Stumps'] if 'Stumps' in row else 0.01,
-                'Rhizomes': row['Rhizomes'] if 'Rhizomes' in row else 0.01,
-                'Roots': row['Roots'] if 'Roots' in row else 0.01,
-            })
-            prev_row = pd.Series(default_vals)
-        
-        kLitter, LTurnoverR, BTurnoverR, CTurnoverR, StTurnoverR, RhTurnoverR, RoTurnoverR, Rratio_Litter_layer = params
-        
-        results = row.to_dict()
-        
-
-        
-        # Net production calculations
-        results['LNP'] = row['Foliages'] - prev_row['Foliages'] if prev_row is not None else 0
-        results['BNP'] = row['Branches'] - prev_row['Branches'] if prev_row is not None else 0
-        results['CNP'] = row['Culms'] - prev_row['Culms'] if prev_row is not None else 0
-        
-        results['AGC'] = row['Foliages'] + row['Branches'] + row['Culms']
-        
-        results['StNP'] = 0.1955 * results['CNP']
-        results['RhNP'] = 1.1162 * abs(results['LNP'])**0.7279 if results['LNP'] != 0 else 0
-        results['RoNP'] = 0.9847 * results['RhNP']
-        
-        if prev_row is None:
-            results['Stumps'] = row['Stumps']
-            results['Rhizomes'] = row['Rhizomes']
-            results['Roots'] = row['Roots']
-        else:
-            results['Stumps'] = prev_row['Stumps'] + results['StNP']
-            results['Rhizomes'] = prev_row['Rhizomes'] + results['RhNP']
-            results['Roots'] = prev_row['Roots'] + results['RoNP']
-        
-        results['BGC'] = results['Stumps'] + results['Rhizomes'] + results['Roots']
-        results['Root_Shoot_Ratio'] = safe_divide(results['BGC'], results['AGC'])
-        results['TC'] = results['AGC'] + results['BGC']
-        
-        # Death calculations
-        results['LD'] = prev_row['Foliages'] * LTurnoverR if prev_row is not None else 0
-        results['BD'] = prev_row['Branches'] * BTurnoverR if prev_row is not None else 0
-        results['CD'] = prev_row['Culms'] * CTurnoverR if prev_row is not None else 0
-        
-        HBP = self.hbp_var.get()
-        if HBP == 1:
-            results['Litterfall'] = results['LD'] + results['BD']
-        else:
-            results['Litterfall'] = results['LD'] + results['BD'] + results['CD']
-        
-        results['ANPP'] = results['LNP'] + results['BNP'] + results['CNP'] + results['Litterfall']
-        
-        results['StD'] = prev_row['Stumps'] * StTurnoverR if prev_row is not None else 0
-        results['RhD'] = prev_row['Rhizomes'] * RhTurnoverR if prev_row is not None else 0
-        results['RoD'] = prev_row['Roots'] * RoTurnoverR if prev_row is not None else 0
-        
-        results['Dbelow'] = results['StD'] + results['RhD'] + results['RoD']
-        
-        BNPPmethod = self.bnpp_method_var.get()
-        if BNPPmethod == 1:
-            results['BNPP'] = results['StNP'] + results['RhNP'] + results['RoNP'] + results['Dbelow']
-        else:
-            results['BNPP'] = results['StNP'] + results['RhNP'] + results['RoNP'] + results['Soil_AR']
-        
-        results['TNPP'] = results['ANPP'] + results['BNPP']
-        
-        # Soil HR calculation
-        if results['ANPP'] < 4.17:
-            hr_anpp = 4.17
-        elif results['ANPP'] > 11.8:
-            hr_anpp = 11.8
-        else:
-            hr_anpp = results['ANPP']
-        results['Soil_HR'] = 0.0071 * hr_anpp**3.0772 if results['ANPP'] != 0 else 0
-        
-        # Autotrophic respiration calculations
-        results['Foliages_AR'] = 1.172/1.172 * ((1.445 * 10**(-1) * safe_exp(7.918*10**(-2)*row['AvgTemp'])) * 365*24 * (row['Foliages']/0.4544 * 1000000) /1000/1000/1000 * 12/44.01)
-        results['Branches_AR'] = 0.215/1.172 * ((1.445 * 10**(-1) * safe_exp(7.918*10**(-2)*row['AvgTemp'])) * 365*24 * (row['Branches']/0.4815 * 1000000) /1000/1000/1000 * 12/44.01)
-        results['Culms_AR'] = 0.085/1.172 * ((1.445 * 10**(-1) * safe_exp(7.918*10**(-2)*row['AvgTemp'])) * 365*24 * (row['Culms']/0.4628 * 1000000) /1000/1000/1000 * 12/44.01)
-        results['Aboveground_AR'] = results['Foliages_AR'] + results['Branches_AR'] + results['Culms_AR']
-        
-        # Soil AR ratios
-        denominator = ((0.088/1.172 * ((1.445 * 10**(-1) * safe_exp(7.918*10**(-2)*row['AvgTemp'])) * 365*24 * (results['Roots']/0.4487 * 1000000) /1000/1000/1000 * 12/44.01))+
-                      (0.179/1.172 * ((1.445 * 10**(-1) * safe_exp(7.918*10**(-2)*row['AvgTemp'])) * 365*24 * (results['Rhizomes']/0.4354 * 1000000) /1000/1000/1000 * 12/44.01))+
-                      (0.085/1.172 * ((1.445 * 10**(-1) * safe_exp(7.918*10**(-2)*row['AvgTemp'])) * 365*24 * (results['Stumps']/0.4628 * 1000000) /1000/1000/1000 * 12/44.01)))
-        
-        if abs(denominator) > 1e-10:
-            results['Roots_AR_ratio'] = (0.088/1.172 * ((1.445 * 10**(-1) * safe_exp(7.918*10**(-2)*row['AvgTemp'])) * 365*24 * (results['Roots']/0.4487 * 1000000) /1000/1000/1000 * 12/44.01)) / denominator
-            results['Rhizomes_AR_ratio'] = (0.179/1.172 * ((1.445 * 10**(-1) * safe_exp(7.918*10**(-2)*row['AvgTemp'])) * 365*24 * (results['Rhizomes']/0.4354 * 1000000) /1000/1000/1000 * 12/44.01)) / denominator
-            results['Stumps_AR_ratio'] = (0.085/1.172 * ((1.445 * 10**(-1) * safe_exp(7.918*10**(-2)*row['AvgTemp'])) * 365*24 * (results['Stumps']/0.4628 * 1000000) /1000/1000/1000 * 12/44.01)) / denominator
-        else:
-            results['Roots_AR_ratio'] = 0
-            results['Rhizomes_AR_ratio'] = 0
-            results['Stumps_AR_ratio'] = 0
-        
-        results['Soil_AR'] = 0.000006 * results['BGC']**3.3249
-        
-        results['Roots_AR'] = results['Soil_AR'] * results['Roots_AR_ratio']
-        results['Rhizomes_AR'] = results['Soil_AR'] * results['Rhizomes_AR_ratio']
-        results['Stumps_AR'] = results['Soil_AR'] * results['Stumps_AR_ratio']
-        
-        results['AR'] = results['Aboveground_AR'] + results['Soil_AR']
-        results['SR'] = results['Soil_AR'] + results['Soil_HR']
-        results['NEP_with_Aboveground_Detritus_Litter_layer_HR'] = results['TNPP'] - results['Soil_HR'] if results['TNPP'] != 0 else 0
-        
-        # Litter layer calculations
-        results['Litter_layer'] = (prev_row['Litter_layer'] + results['Litterfall']) * kLitter if prev_row is not None else row['Litter_layer']
-        results['DLitter_layer'] = results['Litter_layer'] * kLitter
-        results['Litter_layer_HR'] = results['Litter_layer'] * Rratio_Litter_layer
-        
-        results['HR'] = results['Soil_HR'] + results['Litter_layer_HR']
-        results['NEP'] = results['NEP_with_Aboveground_Detritus_Litter_layer_HR'] - results['Litter_layer_HR'] if results['TNPP'] != 0 else 0
-        
-        # Soil carbon
-        if prev_row is not None:
-            results['SC'] = prev_row['SC'] + results['Dbelow'] - results['Soil_HR'] + results['DLitter_layer']
-        else:
-            results['SC'] = row['SC']
-        
-        results['dSC'] = results['SC'] - prev_row['SC'] if prev_row is not None else 0
-        results['TEC'] = results['TC'] + results['Litter_layer'] + results['SC'] + row['Undergrowth']
-        results['NEP_from_dTEC'] = results['TEC'] - prev_row['TEC'] if prev_row is not None else 0
-        
-        results['GPP'] = results['TNPP'] + results['AR']
-
-
-        # 檢查是否為初始 t0
-        is_initial = (prev_row is None)
-        
-        return results
+    def profile_stage(self, name):
+        """Context manager timing a stage (does nothing without instrumentation)"""
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.stage(name)
     
+    def finish_profiler(self, run_type):
+        """Write the JSON run report and show it below the results"""
+        if self.profiler is None:
+            return
+        self.profile_info = {
+            'run_type': run_type,
+            'input_file': self.file_path_var.get(),
+            'n_rows': len(self.df) if self.df is not None else 0,
+            'method': self.opt_method_var.get(),
+            'n_simulations': self.n_simulations_var.get(),
+        }
+        self.profiler.write_json("pemcafe_run_report.json", self.profile_info)
+        self.results_text.insert(tk.END, "\n\n" + self.profiler.format_text())
+        self.results_text.insert(tk.END, "Run report written to pemcafe_run_report.json\n")
     
-    def run_model(self, params, input_df=None):
-        """Run the model with given parameters"""
-        if input_df is None:
-            input_df = self.df
-        
-        if input_df is None:
-            raise ValueError("No input data loaded")
-        
-        results = []
-        prev_row = None
+    def get_run_config(self, run_mc):
+        """Complete run configuration from GUI (also the key of the result cache)"""
+        return pemcafe_engine.analysis_config(
+            params=[float(p) for p in self.get_model_parameters()],
+            bounds=[[float(lo), float(hi)] for lo, hi in self.get_parameter_bounds()],
+            method=self.opt_method_var.get(),
+            hbp=self.hbp_var.get(),
+            bnpp_method=self.bnpp_method_var.get(),
+            time_step=self.time_step_var.get(),
+            run_mc=run_mc,
+            n_simulations=self.n_simulations_var.get(),
+            confidence_level=self.confidence_level_var.get(),
+            sds=self.get_input_sds(),
+            seed=self.get_seed(),
+            surrogate=self.surrogate_var.get(),
+            output_variables=self.get_output_variables(),
+        )
+    
+    def run_analysis(self, run_mc):
+        """Run optimisation (and MC if run_mc) through the engine, using the caches if enabled"""
+        def progress(message):
+            self.status_var.set(message)
+            self.root.update()
+        
+        state_cache = pemcafe_cache.StateCache() if self.incremental_var.get() else None
+        result_cache = None
+        if self.result_cache_var.get():
+            result_cache = pemcafe_cache.ResultCache(max_mb=self.cache_size_var.get())
+        
+        config = self.get_run_config(run_mc)
+        output = pemcafe_engine.run_analysis(self.df, config, progress=progress,
+                                             profiler=self.profiler, state_cache=state_cache,
+                                             result_cache=result_cache)
         
-        for i in range(len(input_df)):
-            updated_values = self.calculate_values(input_df.iloc[i], prev_row, params)
-            results.append(updated_values)
-            prev_row = updated_values
+        # 保存錯誤日誌
+        if output['error_log']:
+            with open("monte_carlo_errors.log", "w") as f:
+                f.write("\n".join(output['error_log']))
         
-        return pd.DataFrame(results)
-    
-    def objective_function(self, params):
-        """Objective function for optimisation"""
-        try:
-            results = self.run_model(params)
-            if len(results) > 1:
-                rmse = np.sqrt(np.mean((results['NEP_from_dTEC'].iloc[1:] - results['NEP'].iloc[1:])**2))
-                return rmse
-            else:
-                return 1e6
-        except:
-            return 1e6
+        self.optimized_params = output['params']
+        self.results = output['results']
+        self.mc_values = output['mc_values']
+        self.mc_variables = config['output_variables']
+        return output
     
     def run_optimisation(self):
         """Run optimisation only"""
         if self.df is None:
             messagebox.showerror("Error", "Please load input data first")
             return
+        if self.run_in_progress:
+            messagebox.showwarning("Warning", "A run is already in progress. "
+                                   "Use the Job Queue tab to run several analyses at once.")
+            return
+        
+        self.build_all_tabs()
+        self.run_in_progress = True
         
         def optimise():
             try:
                 self.status_var.set("Running optimisation...")
                 self.root.update()
+                load_numerics()
                 
-                initial_params = self.get_model_parameters()
-                bounds = self.get_parameter_bounds()
-                
-                # Define constraints
-                constraints = [
-                    {'type': 'ineq', 'fun': lambda params: params[1] - params[2]},  # LTurnoverR > BTurnoverR
-                    {'type': 'ineq', 'fun': lambda params: params[2] - params[3]},  # BTurnoverR > CTurnoverR
-                    {'type': 'ineq', 'fun': lambda params: params[6] - params[5]}   # RoTurnoverR > RhTurnoverR
-                ]
-                
-                result = minimize(self.objective_function, initial_params, 
-                                method=self.opt_method_var.get(), 
-                                bounds=bounds, constraints=constraints)
-                
-                self.optimized_params = result.x
-                
-                # Run model with optimised parameters
-                self.results = self.run_model(self.optimized_params)
+                self.start_profiler()
+                output = self.run_analysis(run_mc=False)
                 
                 # Display results
-                self.display_optimisation_results(result)
+                self.display_optimisation_results(output['optimisation'])
+                self.finish_profiler('optimisation')
                 
                 self.status_var.set("Optimisation completed successfully")
                 
             except Exception as e:
                 messagebox.showerror("Error", f"Optimisation failed: {str(e)}")
                 self.status_var.set("Optimisation failed")
+            finally:
+                self.run_in_progress = False
         
         # Run in separate thread to prevent GUI freezing
         threading.Thread(target=optimise, daemon=True).start()
@@ -584,303 +717,222 @@ class PEMCAFEModelGUI:
         if self.df is None:
             messagebox.showerror("Error", "Please load input data first")
             return
+        if self.run_in_progress:
+            messagebox.showwarning("Warning", "A run is already in progress. "
+                                   "Use the Job Queue tab to run several analyses at once.")
+            return
+        
+        self.build_all_tabs()
+        self.run_in_progress = True
         
         def full_analysis():
             try:
                 self.status_var.set("Running full analysis...")
                 self.root.update()
+                load_numerics()
                 
-                # First run optimisation
-                initial_params = self.get_model_parameters()
-                bounds = self.get_parameter_bounds()
-                
-                constraints = [
-                    {'type': 'ineq', 'fun': lambda params: params[1] - params[2]},
-                    {'type': 'ineq', 'fun': lambda params: params[2] - params[3]},
-                    {'type': 'ineq', 'fun': lambda params: params[6] - params[5]}
-                ]
-                
-                self.status_var.set("Running optimisation...")
-                self.root.update()
-                
-                result = minimize(self.objective_function, initial_params, 
-                                method=self.opt_method_var.get(), 
-                                bounds=bounds, constraints=constraints)
-                
-                self.optimized_params = result.x
-                
-                # Run Monte Carlo simulation
-                self.status_var.set("Running Monte Carlo simulation...")
-                self.root.update()
-                
-                n_simulations = self.n_simulations_var.get()
-                all_mc_results = self.run_monte_carlo_simulation(self.optimized_params, n_simulations)
-                
-                # Calculate confidence intervals
-                self.status_var.set("Calculating confidence intervals...")
-                self.root.update()
-                
-                confidence_level = self.confidence_level_var.get()
-                ci_results = self.calculate_confidence_intervals(all_mc_results, confidence_level)
-                
-                # Get base results
-                base_results = self.run_model(self.optimized_params)
-                
-                # Create final results with CI
-                self.results = self.create_final_results_with_ci(base_results, ci_results)
+                self.start_profiler()
+                output = self.run_analysis(run_mc=True)
                 
                 # Display results
-                self.display_full_analysis_results(result, ci_results)
+                self.display_full_analysis_results(output['optimisation'], output['ci_results'])
+                self.finish_profiler('full_analysis')
                 
                 self.status_var.set("Full analysis completed successfully")
                 
             except Exception as e:
                 messagebox.showerror("Error", f"Full analysis failed: {str(e)}")
                 self.status_var.set("Full analysis failed")
+            finally:
+                self.run_in_progress = False
         
         # Run in separate thread
         threading.Thread(target=full_analysis, daemon=True).start()
     
-    def generate_perturbed_data(self, original_df, sds):
-        """Generate perturbed input data based on standard deviations"""
-        perturbed_df = original_df.copy()
-        
-        for var in sds.keys():
-            if var in perturbed_df.columns:
-                original_values = perturbed_df[var].values
-                random_perturbations = np.random.normal(0, sds[var], len(original_values))
-                perturbed_values = original_values + random_perturbations
-                # 根據變量類型應用不同的約束
-                if var in ['Foliages', 'Branches', 'Culms', 'Roots', 'Rhizomes', 'Stumps']:
-                    # 生物量變量應為非負
-                    perturbed_values = np.maximum(perturbed_values, 0.01)
-                elif var == 'AvgTemp':
-                    # 溫度應在合理範圍內
-                    perturbed_values = np.clip(perturbed_values, -10, 50)
-                elif var in ['Litter_layer', 'SC']:
-                    # 土壤和凋落物應為非負
-                    perturbed_values = np.maximum(perturbed_values, 0.01)
-                    
-                perturbed_df[var] = perturbed_values
-        
-        return perturbed_df
-    
-    def run_monte_carlo_simulation(self, params, n_simulations):
-        """Run Monte Carlo simulation"""
-        input_sds = self.get_input_sds()
-        all_results = []
-        error_log = []
-        
-        for i in range(n_simulations):
-            if i % 100 == 0:
-                self.status_var.set(f"Monte Carlo simulation: {i+1}/{n_simulations}")
-                self.root.update()
-            
-            try:
-                perturbed_df = self.generate_perturbed_data(self.df, input_sds)
-                result = self.run_model(params, perturbed_df)
-            # 檢查結果是否有效
-                if result.isnull().values.any():
-                    error_msg = f"Simulation {i+1} contains NaN values"
-                    error_log.append(error_msg)
-                else:
-                    all_results.append(result)
-            except Exception as e:
-                error_msg = f"Simulation {i+1} failed: {str(e)}"
-                error_log.append(error_msg)
-    
-        # 保存錯誤日誌
-        if error_log:
-            with open("monte_carlo_errors.log", "w") as f:
-                f.write("\n".join(error_log))
-    
-        return all_results
-    
-    def calculate_confidence_intervals(self, all_results, confidence_level=0.95):
-        """Calculate confidence intervals from Monte Carlo results"""
-        if len(all_results) == 0:
-            return None
-        
-        # 清理結果 - 替換NaN為0
-        for result in all_results:
-            result.fillna(0, inplace=True)
+    def queue_job(self, run_mc):
+        """Queue the loaded file with the current settings as a job"""
+        if self.df is None:
+            messagebox.showerror("Error", "Please load input data first")
+            return
         
-        output_columns = [col for col in all_results[0].columns 
-                         if col not in ['t', 'AvgTemp', 'Undergrowth']]
-    
-        ci_results = {}
-        alpha = 1 - confidence_level
-    
-        for col in output_columns:
-            col_values = []
-            for result in all_results:
-                if col in result.columns:
-                    col_values.append(result[col].values)
-        
-            if col_values:
-                col_array = np.array(col_values)
-            
-                # 方法1：使用t分布置信區間（推薦）
-                mean_values = np.mean(col_array, axis=0)
-                std_values = np.std(col_array, axis=0, ddof=1)  # 使用樣本標準差
-                n = len(col_values)
-            
-                # 使用t分布計算置信區間
-                t_value = stats.t.ppf(1 - alpha/2, df=n-1)
-                margin_of_error = t_value * std_values / np.sqrt(n)
-            
-                lower_ci = mean_values - margin_of_error
-                upper_ci = mean_values + margin_of_error
-            
-                # 方法2：百分位數方法（作為備選）
-                lower_percentile = (alpha/2) * 100
-                upper_percentile = (1 - alpha/2) * 100
-                percentile_lower = np.percentile(col_array, lower_percentile, axis=0)
-                percentile_upper = np.percentile(col_array, upper_percentile, axis=0)
+        self.build_all_tabs()
+        try:
+            load_numerics()
+            import pemcafe_jobs
+            if self.job_queue is None:
+                self.job_queue = pemcafe_jobs.JobQueue(workers=self.job_workers_var.get())
             
-                ci_results[col] = {
-                    'mean': mean_values,
-                    'std': std_values,
-                    'lower_ci': lower_ci,
-                    'upper_ci': upper_ci,
-                    'percentile_lower': percentile_lower,
-                    'percentile_upper': percentile_upper,
-                    'n_simulations': n
-                }
-        
-        return ci_results
-
-    def display_full_analysis_results(self, optimisation_result, ci_results):
-        """Display full analysis results with confidence intervals"""
-        self.results_text.delete(1.0, tk.END)
-    
-        param_names = ['kLitter', 'LTurnoverR', 'BTurnoverR', 'CTurnoverR', 
-                      'StTurnoverR', 'RhTurnoverR', 'RoTurnoverR', 'Rratio_Litter_layer']
+            config = self.get_run_config(run_mc)
+            result_cache_mb = self.cache_size_var.get() if self.result_cache_var.get() else None
+            filename = os.path.basename(self.file_path_var.get())
+            run = "Full analysis" if run_mc else "Optimisation"
+            job_id = self.job_queue.submit(f"{filename} / {run}", self.df, config,
+                                           use_state_cache=self.incremental_var.get(),
+                                           result_cache_mb=result_cache_mb,
+                                           info={'file': filename, 'run': run})
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to queue job: {str(e)}")
+            return
+        
+        self.jobs_tree.insert("", "end", iid=str(job_id), values=self.job_row(job_id))
+        self.status_var.set(f"Job {job_id} queued ({self.job_queue.active()} queued or running)")
+        if not self.polling_jobs:
+            self.polling_jobs = True
+            self.root.after(500, self.poll_jobs)
     
-        results_text = "PEMCAFE Model Full Analysis Results\n"
-        results_text += "=" * 60 + "\n\n"
+    def job_row(self, job_id):
+        """Values of a job's row in the job list"""
+        job = self.job_queue.jobs[job_id]
+        return (job_id, job['info']['file'], job['info']['run'], job['config']['method'],
+                job['status'], job['message'], f"{self.job_queue.elapsed(job_id):.1f}")
     
-        # Optimisation results
-        results_text += "OPTIMISATION RESULTS:\n"
-        results_text += f"Status: {'Success' if optimisation_result.success else 'Failed'}\n"
-        results_text += f"Method: {self.opt_method_var.get()}\n"
-        results_text += f"Final Objective Value: {optimisation_result.fun:.6f}\n\n"
+    def poll_jobs(self):
+        """Refresh the job list while jobs are queued or running"""
+        finished = []
+        for job_id in self.job_queue.poll():
+            if self.job_queue.jobs[job_id]['status'] in ('done', 'failed'):
+                finished.append(job_id)
+        for job_id, job in self.job_queue.jobs.items():
+            if self.jobs_tree.exists(str(job_id)):
+                self.jobs_tree.item(str(job_id), values=self.job_row(job_id))
+        
+        for job_id in finished:
+            self.status_var.set(f"Job {job_id} {self.job_queue.jobs[job_id]['status']}")
+        
+        if self.job_queue.active():
+            self.root.after(500, self.poll_jobs)
+        else:
+            self.polling_jobs = False
     
-        results_text += "Optimised Parameters:\n"
-        for i, (name, value) in enumerate(zip(param_names, self.optimized_params)):
-            results_text += f"  {name:20}: {value:.6f}\n"
+    def selected_job(self):
+        """Id of the job selected in the job list (None if nothing is selected)"""
+        selection = self.jobs_tree.selection()
+        if not selection:
+            messagebox.showwarning("Warning", "Please select a job first")
+            return None
+        return int(selection[0])
     
-        # Monte Carlo results
-        results_text += f"\n\nMONTE CARLO SIMULATION RESULTS:\n"
-        results_text += f"Number of Simulations: {self.n_simulations_var.get()}\n"
-        results_text += f"Confidence Level: {self.confidence_level_var.get()*100:.0f}%\n\n"
+    def finished_job(self):
+        """Id of the selected job if it has finished successfully"""
+        job_id = self.selected_job()
+        if job_id is None:
+            return None
+        job = self.job_queue.jobs[job_id]
+        if job['status'] != 'done':
+            messagebox.showwarning("Warning", f"Job {job_id} is {job['status']}"
+                                   + (f": {job['error']}" if job['error'] else ""))
+            return None
+        return job_id
     
-        if ci_results:
-            results_text += f"Summary of {self.confidence_level_var.get()*100:.0f}% Confidence Intervals for Key Variables:\n"
-            results_text += "Method: Mean ± t * SE (t-distribution based)\n"
-            results_text += "-" * 80 + "\n"
-            results_text += f"{'Variable':<12} {'Mean':<12} {'Std':<12} {'95% CI Lower':<15} {'95% CI Upper':<15}\n"
-            results_text += "-" * 80 + "\n"
-        
-            key_vars = ['ANPP', 'BNPP', 'TNPP', 'NEP', 'GPP', 'SR', 'AGC', 'BGC']
-            for var in key_vars:
-                if var in ci_results:
-                    mean_val = np.mean(ci_results[var]['mean'])
-                    std_val = np.mean(ci_results[var]['std'])
-                    mean_lower = np.mean(ci_results[var]['lower_ci'])
-                    mean_upper = np.mean(ci_results[var]['upper_ci'])
-                
-                    results_text += f"{var:<12} {mean_val:<12.3f} {std_val:<12.3f} {mean_lower:<15.3f} {mean_upper:<15.3f}\n"
-        
-            # 添加百分位數方法的結果作為比較
-            results_text += f"\n\nComparison with Percentile Method:\n"
-            results_text += "-" * 80 + "\n"
-            results_text += f"{'Variable':<12} {'Mean':<12} {'Percentile Lower':<18} {'Percentile Upper':<18}\n"
-            results_text += "-" * 80 + "\n"
+    def show_job_results(self):
+        """Show a finished job's results in the Results tab (also the target of Export there)"""
+        job_id = self.finished_job()
+        if job_id is None:
+            return
         
-            for var in key_vars:
-                if var in ci_results:
-                    mean_val = np.mean(ci_results[var]['mean'])
-                    perc_lower = np.mean(ci_results[var]['percentile_lower'])
-                    perc_upper = np.mean(ci_results[var]['percentile_upper'])
-                
-                    results_text += f"{var:<12} {mean_val:<12.3f} {perc_lower:<18.3f} {perc_upper:<18.3f}\n"
-    
-        # Model settings summary
-        results_text += f"\n\nMODEL SETTINGS:\n"
-        results_text += f"Harvesting Bamboo Products (HBP): {self.hbp_var.get()}\n"
-        results_text += f"BNPP Method: {'BGC + Dbelow' if self.bnpp_method_var.get() == 1 else 'BGC + Soil_AR'}\n"
+        job = self.job_queue.jobs[job_id]
+        output = job['output']
+        self.optimized_params = output['params']
+        self.results = output['results']
+        self.mc_values = output['mc_values']
+        self.mc_variables = job['config']['output_variables']
+        if job['config']['run_mc']:
+            self.display_full_analysis_results(output['optimisation'], output['ci_results'],
+                                               config=job['config'], input_df=job['input_df'])
+        else:
+            self.display_optimisation_results(output['optimisation'], config=job['config'])
+        self.results_text.insert(1.0, f"Job {job_id}: {job['name']}\n\n")
+        self.status_var.set(f"Showing results of job {job_id}")
     
-        results_text += f"\n\nInput Data Summary:\n"
-        results_text += f"Number of time points: {len(self.df) if self.df is not None else 'N/A'}\n"
-        if self.df is not None:
-            results_text += f"Data columns: {', '.join(self.df.columns.tolist())}\n"
+    def export_job_results(self):
+        """Export a finished job's results to CSV"""
+        job_id = self.finished_job()
+        if job_id is None:
+            return
+        
+        try:
+            filename = filedialog.asksaveasfilename(
+                title="Save Results",
+                defaultextension=".csv",
+                initialfile=f"job{job_id}_results.csv",
+                filetypes=[("CSV files", "*.csv"), ("All files", "*.*")]
+            )
+            if filename:
+                self.job_queue.export(job_id, filename)
+                self.status_var.set(f"Results of job {job_id} exported to {os.path.basename(filename)}")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to export results: {str(e)}")
     
-        self.results_text.insert(tk.END, results_text)
+    def cancel_job(self):
+        """Cancel a job that has not started yet"""
+        job_id = self.selected_job()
+        if job_id is None:
+            return
+        if self.job_queue.cancel(job_id):
+            self.jobs_tree.item(str(job_id), values=self.job_row(job_id))
+        else:
+            messagebox.showwarning("Warning", f"Job {job_id} has already started and cannot be cancelled")
     
-        # Switch to results tab
-        self.notebook.select(4)
+    def remove_job(self):
+        """Remove a finished, failed or cancelled job from the list"""
+        job_id = self.selected_job()
+        if job_id is None:
+            return
+        if self.job_queue.remove(job_id):
+            self.jobs_tree.delete(str(job_id))
+        else:
+            messagebox.showwarning("Warning", f"Job {job_id} is still queued or running")
     
-    def create_final_results_with_ci(self, base_results, ci_results):
-        """Create final results DataFrame with confidence intervals"""
+    def draw_plots(self):
+        """Plot the selected variables of the current results"""
+        if self.results is None:
+            messagebox.showwarning("Warning", "No results to plot. Please run the model first.")
+            return
         
-        final_results = base_results.copy()
+        import pemcafe_plotting
+        names = [name.strip() for name in self.plot_variables_var.get().replace(';', ',').split(',')]
+        variables = [name for name in names if name]
+        missing = [var for var in variables if var not in self.results.columns]
+        if not variables or missing:
+            messagebox.showerror("Error", f"Unknown variables: {', '.join(missing)}" if missing
+                                 else "Please enter the variables to plot")
+            return
         
-
-        is_initial = (base_results['t'] == base_results['t'].min())
-    
-        # t0 flux need to be 0
-        flux_vars = [
-            'LNP', 'BNP', 'CNP', 'StNP', 'RhNP', 'RoNP',
-            'ANPP', 'BNPP', 'TNPP', 'LD', 'BD', 'CD',
-            'Litterfall', 'StD', 'RhD', 'RoD', 'Dbelow',
-            'NEP', 'NEP_with_Aboveground_Detritus_Litter_layer_HR',
-            'NEP_from_dTEC', 'dSC', 'DLitter_layer', 'GPP',
-            'SR', 'Litter_layer_HR', 'Soil_HR', 'HR',
-            'Foliages_AR', 'Branches_AR', 'Culms_AR', 'Aboveground_AR',
-            'Soil_AR', 'AR', 'Roots_AR', 'Rhizomes_AR', 'Stumps_AR',
-            'Roots_AR_ratio', 'Rhizomes_AR_ratio', 'Stumps_AR_ratio'
-        ]
-    
-        # t0 flux must be 0
-        for var in flux_vars:
-            if var in final_results.columns:
-                final_results.loc[is_initial, var] = 0.0
-        
-        # t0 CI also must be 0
-        suffixes = [
-            '_MC_mean', '_MC_std', '_t_lower_95CI',
-            '_t_upper_95CI', '_percentile_lower_95CI',
-            '_percentile_upper_95CI'
-        ]
-    
-        for var in flux_vars:
-            for suffix in suffixes:
-                col_name = f"{var}{suffix}"
-                if col_name in final_results.columns:
-                    final_results.loc[is_initial, col_name] = 0.0
+        modes = {"CI band": 'band', "Density": 'density', "Spaghetti": 'spaghetti'}
+        try:
+            pemcafe_plotting.plot_results(self.plot_figure, self.results, variables,
+                                          modes[self.plot_mode_var.get()], self.mc_values, self.mc_variables,
+                                          self.plot_ci_var.get(), self.plot_bins_var.get(),
+                                          self.plot_lines_var.get())
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        self.plot_canvas.draw_idle()
     
-        # add CI
-        if ci_results:
-            for col in ci_results.keys():
-                if col in final_results.columns:
-                    final_results[f'{col}_MC_mean'] = ci_results[col]['mean']
-                    final_results[f'{col}_MC_std'] = ci_results[col]['std']
-                    final_results[f'{col}_t_lower_{int(self.confidence_level_var.get()*100)}CI'] = ci_results[col]['lower_ci']
-                    final_results[f'{col}_t_upper_{int(self.confidence_level_var.get()*100)}CI'] = ci_results[col]['upper_ci']
-                    final_results[f'{col}_percentile_lower_{int(self.confidence_level_var.get()*100)}CI'] = ci_results[col]['percentile_lower']
-                    final_results[f'{col}_percentile_upper_{int(self.confidence_level_var.get()*100)}CI'] = ci_results[col]['percentile_upper']
-        for col in final_results.columns:
-            for flux_var in flux_vars:
-                if col.startswith(flux_var) and col.endswith(tuple(suffixes)):
-                    final_results.loc[is_initial, col] = 0.0
-        return final_results    
+    def save_plot(self):
+        """Save the current figure as an image"""
+        filename = filedialog.asksaveasfilename(
+            title="Save Figure",
+            defaultextension=".png",
+            filetypes=[("PNG images", "*.png"), ("PDF files", "*.pdf"), ("SVG images", "*.svg"), ("All files", "*.*")]
+        )
+        if filename:
+            try:
+                self.plot_figure.savefig(filename, dpi=150)
+                self.status_var.set(f"Figure saved to {os.path.basename(filename)}")
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to save figure: {str(e)}")
     
-
+    def clear_result_cache(self):
+        """Remove all cached analysis results"""
+        load_numerics()
+        pemcafe_cache.ResultCache().clear()
+        self.status_var.set("Result cache cleared")
     
-    def display_optimisation_results(self, optimisation_result):
-        """Display optimisation results"""
+    def display_optimisation_results(self, optimisation_result, config=None):
+        """Display optimisation results (config: settings of the run, default the GUI's)"""
         self.results_text.delete(1.0, tk.END)
+        method = config['method'] if config else self.opt_method_var.get()
         
         param_names = ['kLitter', 'LTurnoverR', 'BTurnoverR', 'CTurnoverR', 
                       'StTurnoverR', 'RhTurnoverR', 'RoTurnoverR', 'Rratio_Litter_layer']
@@ -889,10 +941,14 @@ class PEMCAFEModelGUI:
         results_text += "=" * 50 + "\n\n"
         
         results_text += f"Optimisation Status: {'Success' if optimisation_result.success else 'Failed'}\n"
-        results_text += f"Optimisation Method: {self.opt_method_var.get()}\n"
+        results_text += f"Optimisation Method: {method}\n"
         results_text += f"Final Objective Value: {optimisation_result.fun:.6f}\n"
         results_text += f"Number of Iterations: {optimisation_result.nit if hasattr(optimisation_result, 'nit') else 'N/A'}\n\n"
         
+        if optimisation_result.get('surrogate_validation'):
+            import pemcafe_surrogate
+            results_text += pemcafe_surrogate.format_validation(optimisation_result['surrogate_validation']) + "\n"
+        
         results_text += "Optimised Parameters:\n"
         results_text += "-" * 30 + "\n"
         for i, (name, value) in enumerate(zip(param_names, self.optimized_params)):
@@ -914,9 +970,15 @@ class PEMCAFEModelGUI:
         # Switch to results tab
         self.notebook.select(4)
     
-    def display_full_analysis_results(self, optimisation_result, ci_results):
-        """Display full analysis results with confidence intervals"""
+    def display_full_analysis_results(self, optimisation_result, ci_results, config=None, input_df=None):
+        """Display full analysis results with confidence intervals (config, input_df: default the GUI's)"""
         self.results_text.delete(1.0, tk.END)
+        if config is None:
+            config = {'method': self.opt_method_var.get(), 'n_simulations': self.n_simulations_var.get(),
+                      'confidence_level': self.confidence_level_var.get(), 'hbp': self.hbp_var.get(),
+                      'bnpp_method': self.bnpp_method_var.get(), 'time_step': self.time_step_var.get()}
+        if input_df is None:
+            input_df = self.df
         
         param_names = ['kLitter', 'LTurnoverR', 'BTurnoverR', 'CTurnoverR', 
                       'StTurnoverR', 'RhTurnoverR', 'RoTurnoverR', 'Rratio_Litter_layer']
@@ -927,20 +989,24 @@ class PEMCAFEModelGUI:
         # Optimisation results
         results_text += "OPTIMISATION RESULTS:\n"
         results_text += f"Status: {'Success' if optimisation_result.success else 'Failed'}\n"
-        results_text += f"Method: {self.opt_method_var.get()}\n"
+        results_text += f"Method: {config['method']}\n"
         results_text += f"Final Objective Value: {optimisation_result.fun:.6f}\n\n"
         
+        if optimisation_result.get('surrogate_validation'):
+            import pemcafe_surrogate
+            results_text += pemcafe_surrogate.format_validation(optimisation_result['surrogate_validation']) + "\n"
+        
         results_text += "Optimised Parameters:\n"
         for i, (name, value) in enumerate(zip(param_names, self.optimized_params)):
             results_text += f"  {name:20}: {value:.6f}\n"
         
         # Monte Carlo results
         results_text += f"\n\nMONTE CARLO SIMULATION RESULTS:\n"
-        results_text += f"Number of Simulations: {self.n_simulations_var.get()}\n"
-        results_text += f"Confidence Level: {self.confidence_level_var.get()*100:.0f}%\n\n"
+        results_text += f"Number of Simulations: {config['n_simulations']}\n"
+        results_text += f"Confidence Level: {config['confidence_level']*100:.0f}%\n\n"
         
         if ci_results:
-            results_text += f"Summary of {self.confidence_level_var.get()*100:.0f}% Confidence Intervals for Key Variables:\n"
+            results_text += f"Summary of {config['confidence_level']*100:.0f}% Confidence Intervals for Key Variables:\n"
             results_text += "-" * 60 + "\n"
             
             key_vars = ['ANPP', 'BNPP', 'TNPP', 'NEP', 'GPP']
@@ -953,13 +1019,14 @@ class PEMCAFEModelGUI:
         
         # Model settings summary
         results_text += f"\n\nMODEL SETTINGS:\n"
-        results_text += f"Harvesting Bamboo Products (HBP): {self.hbp_var.get()}\n"
-        results_text += f"BNPP Method: {'BGC + Dbelow' if self.bnpp_method_var.get() == 1 else 'BGC + Soil_AR'}\n"
+        results_text += f"Harvesting Bamboo Products (HBP): {config['hbp']}\n"
+        results_text += f"BNPP Method: {'BGC + Dbelow' if config['bnpp_method'] == 1 else 'BGC + Soil_AR'}\n"
+        results_text += f"Time Step: {config['time_step']}\n"
         
         results_text += f"\n\nInput Data Summary:\n"
-        results_text += f"Number of time points: {len(self.df) if self.df is not None else 'N/A'}\n"
-        if self.df is not None:
-            results_text += f"Data columns: {', '.join(self.df.columns.tolist())}\n"
+        results_text += f"Number of time points: {len(input_df) if input_df is not None else 'N/A'}\n"
+        if input_df is not None:
+            results_text += f"Data columns: {', '.join(input_df.columns.tolist())}\n"
         
         self.results_text.insert(tk.END, results_text)
         
@@ -980,7 +1047,10 @@ class PEMCAFEModelGUI:
             )
             
             if filename:
-                self.results.to_csv(filename, index=False)
+                with self.profile_stage('csv_export'):
+                    self.results.to_csv(filename, index=False)
+                if self.profiler is not None:
+                    self.profiler.write_json("pemcafe_run_report.json", dict(self.profile_info, exported_to=filename))
                 messagebox.showinfo("Success", f"Results exported to {filename}")
                 self.status_var.set(f"Results exported to {os.path.basename(filename)}")
                 
@@ -0,0 +1,81 @@
+# PEMCAFE import-time benchmark
+# measures how long the GUI module and the engine / worker modules take to import in a
+# fresh interpreter, and checks that the GUI module does not pull in the numerical stack
+# (pandas, numpy, scipy are loaded lazily once the window is up)
+#
+#   python benchmarks/bench_import.py                 # exits with 1 if a guard fails
+#   python benchmarks/bench_import.py --repeat 10 --gui-budget 0.3
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ['PEMCAFE_ad', 'pemcafe_engine', 'pemcafe_server', 'pemcafe_distributed']
+# modules the GUI must not import at start-up
+HEAVY_MODULES = ['pandas', 'numpy', 'scipy']
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds,
+                  'heavy': sorted(m for m in {heavy!r} if m in sys.modules)}}))
+"""
+
+
+def measure_import(module, repeat=5):
+    """Median import time (s) of module in a fresh interpreter and the heavy modules it loaded"""
+    times = []
+    heavy = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', _PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                                cwd=ROOT, capture_output=True, text=True, check=True).stdout
+        record = json.loads(output.strip().splitlines()[-1])
+        times.append(record['seconds'])
+        heavy = record['heavy']
+    return statistics.median(times), heavy
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PEMCAFE import-time benchmark")
+    parser.add_argument('--modules', nargs='+', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--gui-budget', type=float, default=0.5,
+                        help="maximum import time of PEMCAFE_ad in seconds")
+    parser.add_argument('--output', help="write the results to a JSON file")
+    args = parser.parse_args()
+
+    records = {}
+    failures = []
+    print(f"{'module':<24} {'import (s)':>12}  heavy modules loaded")
+    for module in args.modules:
+        seconds, heavy = measure_import(module, args.repeat)
+        records[module] = {'seconds': seconds, 'heavy_modules': heavy}
+        print(f"{module:<24} {seconds:12.3f}  {', '.join(heavy) or '-'}")
+
+        if module == 'PEMCAFE_ad':
+            if heavy:
+                failures.append(f"PEMCAFE_ad imports {', '.join(heavy)} at start-up")
+            if seconds > args.gui_budget:
+                failures.append(f"PEMCAFE_ad takes {seconds:.3f} s to import (budget {args.gui_budget} s)")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(records, f, indent=2)
+
+    if failures:
+        print()
+        for failure in failures:
+            print(f"FAIL: {failure}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+# PEMCAFE benchmark suite
+# times the model kernel, the objective function, calibration with every optimiser
+# and the Monte Carlo path (default unseeded draws, and seeded per-realization draws)
+# on synthetic series derived from inputdataforPEMCAFE.csv, records throughput and
+# peak memory, and compares with the baseline stored in benchmarks/baseline.json
+#
+#   python benchmarks/bench_pemcafe.py                     # run and compare with baseline
+#   python benchmarks/bench_pemcafe.py --save-baseline     # run and store as new baseline
+#   python benchmarks/bench_pemcafe.py --sizes 10 100 --mc-sims 1000
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pemcafe_engine
+
+DEFAULT_INPUT = os.path.join(ROOT, 'inputdataforPEMCAFE.csv')
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def synthetic_series(base_df, n_steps, seed=0):
+    """Synthetic input of n_steps rows derived from the observed table
+
+    The first row (initial pools) is kept; the aboveground pools of the following rows
+    fluctuate around the observed mean (AR(1), 5% sd) so long series stay stationary.
+    """
+    rng = np.random.default_rng(seed)
+    observed = base_df.iloc[1:] if len(base_df) > 1 else base_df
+    rows = pd.DataFrame(index=range(n_steps), columns=base_df.columns, dtype=float)
+    rows.iloc[0] = base_df.iloc[0].to_numpy(dtype=float)
+
+    for col in ['Foliages', 'Branches', 'Culms']:
+        mean = observed[col].mean()
+        noise = np.zeros(n_steps)
+        for i in range(1, n_steps):
+            noise[i] = 0.8 * noise[i-1] + rng.normal(0, 0.05 * mean)
+        rows.loc[1:, col] = mean + noise[1:]
+    rows['AGC'] = rows['Foliages'] + rows['Branches'] + rows['Culms']
+    rows['AvgTemp'] = base_df['AvgTemp'].iloc[0] + rng.normal(0, 0.5, n_steps)
+    rows['Undergrowth'] = 0.0
+    rows[rows.columns[0]] = np.arange(n_steps)
+    return rows
+
+
+def measure(func, memory=True):
+    """Wall time and Python peak memory (MB) of a call
+
+    tracemalloc slows the call down, so the time comes from a plain call and the
+    peak memory from a second, traced call.
+    """
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    if not memory:
+        return result, seconds, float('nan')
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak / 1e6
+
+
+def run_benchmarks(input_path, sizes, mc_sims, methods, max_seconds, params, memory=True, log=print):
+    """Run all benchmark cases; returns {case name: record}"""
+    base_df = pd.read_csv(input_path, encoding='utf-8-sig')
+    bounds = [pemcafe_engine.DEFAULT_BOUNDS[n] for n in pemcafe_engine.PARAM_NAMES]
+    sds = pemcafe_engine.DEFAULT_SDS
+    records = {}
+
+    def record(name, seconds, peak_mb, work, unit, extra=None):
+        records[name] = {'seconds': seconds, 'peak_mb': peak_mb,
+                         'throughput': work / seconds if seconds > 0 else float('inf'),
+                         'unit': unit}
+        if extra:
+            records[name].update(extra)
+        log(f"{name:<40} {seconds:10.4f} s {peak_mb:9.2f} MB {records[name]['throughput']:14.1f} {unit}")
+
+    def skip(name, estimate):
+        records[name] = {'skipped': True, 'estimated_seconds': estimate}
+        log(f"{name:<40} skipped (estimated {estimate:.0f} s > --max-seconds)")
+
+    for n_steps in sizes:
+        df = synthetic_series(base_df, n_steps)
+
+        # model kernel: one run_model call
+        _, seconds, peak = measure(lambda: pemcafe_engine.run_model(df, params), memory)
+        record(f"run_model/{n_steps}", seconds, peak, n_steps, 'steps/s')
+        run_seconds = seconds
+
+        # objective evaluations
+        n_evals = max(1, min(20, int(1.0 / max(run_seconds, 1e-6))))
+        _, seconds, peak = measure(lambda: [pemcafe_engine.objective_function(params, df) for _ in range(n_evals)], memory)
+        record(f"objective_function/{n_steps}", seconds, peak, n_evals, 'evals/s')
+
+        # full calibration with each optimiser (a few hundred evaluations each)
+        for method in methods:
+            name = f"minimize[{method}]/{n_steps}"
+            estimate = run_seconds * 300
+            if estimate > max_seconds:
+                skip(name, estimate)
+                continue
+            result, seconds, peak = measure(lambda: pemcafe_engine.optimise_parameters(df, params, bounds, method), memory)
+            record(name, seconds, peak, result.nfev, 'evals/s',
+                   {'nfev': int(result.nfev), 'fun': float(result.fun)})
+
+        # Monte Carlo simulation + confidence intervals: the default unseeded draws and
+        # the reproducible seeded draws (perturb_rows), both without a state cache
+        for n_sims in mc_sims:
+            for case, seed in (('monte_carlo', None), ('monte_carlo_seeded', 0)):
+                name = f"{case}/{n_steps}x{n_sims}"
+                estimate = run_seconds * n_sims
+                if estimate > max_seconds:
+                    skip(name, estimate)
+                    continue
+
+                def mc():
+                    all_results, _ = pemcafe_engine.run_monte_carlo(df, params, sds, n_sims, seed=seed)
+                    return pemcafe_engine.calculate_confidence_intervals(all_results, 0.95)
+
+                _, seconds, peak = measure(mc, memory)
+                record(name, seconds, peak, n_sims * n_steps, 'steps/s')
+
+    return records
+
+
+def compare(records, baseline, tolerance):
+    """List of (case, current s, baseline s, ratio) where the case got slower than allowed"""
+    regressions = []
+    for name, rec in records.items():
+        base = baseline.get('results', {}).get(name)
+        if rec.get('skipped') or not base or base.get('skipped'):
+            continue
+        ratio = rec['seconds'] / base['seconds'] if base['seconds'] > 0 else float('inf')
+        if ratio > 1 + tolerance:
+            regressions.append((name, rec['seconds'], base['seconds'], ratio))
+    return regressions
+
+
+def missing_baseline(records, baseline):
+    """Cases that ran but have no (non-skipped) baseline record, so compare() cannot check them"""
+    results = baseline.get('results', {})
+    return [name for name, rec in records.items()
+            if not rec.get('skipped') and (name not in results or results[name].get('skipped'))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PEMCAFE benchmark suite")
+    parser.add_argument('--input', default=DEFAULT_INPUT)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 10000])
+    parser.add_argument('--mc-sims', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--methods', nargs='+', default=list(pemcafe_engine.OPTIMISATION_METHODS))
+    parser.add_argument('--max-seconds', type=float, default=600,
+                        help="skip cases whose estimated run time is longer")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed slow-down relative to the baseline (0.25 = 25%%)")
+    parser.add_argument('--output', help="write this run's results to a JSON file")
+    parser.add_argument('--no-memory', action='store_true', help="skip the peak memory pass")
+    args = parser.parse_args()
+
+    # Nelder-Mead / L-BFGS-B / TNC warn that they ignore the ordering constraints
+    warnings.filterwarnings('ignore', message='Method .* cannot handle')
+
+    params = [pemcafe_engine.DEFAULT_PARAMS[n] for n in pemcafe_engine.PARAM_NAMES]
+    print(f"{'case':<40} {'time':>12} {'peak mem':>12} {'throughput':>14}")
+    records = run_benchmarks(args.input, args.sizes, args.mc_sims, args.methods, args.max_seconds,
+                             params, not args.no_memory)
+
+    report = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'results': records,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline}; run with --save-baseline to create one")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(records, baseline, args.tolerance)
+    missing = missing_baseline(records, baseline)
+    if missing:
+        print(f"\n{len(missing)} case(s) not in the baseline, not compared: {', '.join(missing)}")
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) against {args.baseline}:")
+        for name, current, base, ratio in regressions:
+            print(f"  {name:<40} {current:.4f} s vs {base:.4f} s ({ratio:.2f}x)")
+        return 1
+    print(f"\nNo regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1 @@
+# pytest: makes the top-level pemcafe_* modules importable from tests/
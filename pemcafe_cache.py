@@ -0,0 +1,244 @@
+# PEMCAFE on-disk cache
+# StateCache : end-of-run state of a series, keyed by the run settings and by a hash of the
+#              input rows it was computed from, so when rows are appended only the new rows are computed
+# ResultCache: complete analysis outputs, content-addressed by the input data and the complete
+#              run configuration
+# both evict their least recently used entries above a size limit
+
+import glob
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import numpy as np
+import pandas as pd
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".pemcafe_cache")
+DEFAULT_STATE_CACHE_MB = 500
+DEFAULT_RESULT_CACHE_MB = 500
+# part of every key: bump when the model equations or the cached payloads change, so entries
+# written by an older version are never returned
+CACHE_VERSION = 4
+
+
+def _to_builtin(value):
+    """json.dumps helper for numpy values in run settings"""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot hash value of type {type(value).__name__}")
+
+
+def config_key(**settings):
+    """Hash of the run settings (parameters, HBP, BNPP method, time step, ...) and CACHE_VERSION"""
+    text = json.dumps(dict(settings, version=CACHE_VERSION), sort_keys=True, default=_to_builtin)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+
+def row_hashes(input_df):
+    """One hash per input row; a row's hash does not depend on the rows after it"""
+    return pd.util.hash_pandas_object(input_df, index=False).to_numpy()
+
+
+def prefix_hash(input_df, n_rows, hashes=None):
+    """Hash of the first n_rows rows of input_df (column names included)"""
+    if hashes is None:
+        hashes = row_hashes(input_df)
+    h = hashlib.sha256()
+    h.update(json.dumps([str(c) for c in input_df.columns]).encode('utf-8'))
+    h.update(np.ascontiguousarray(hashes[:n_rows]).tobytes())
+    return h.hexdigest()[:32]
+
+
+def analysis_key(input_df, config):
+    """Content address of an analysis: hash of the whole input table, the run configuration
+    and CACHE_VERSION (through config_key)"""
+    return config_key(kind='analysis', data=prefix_hash(input_df, len(input_df)), config=config)
+
+
+def _write_atomic(path, payload):
+    """Pickle payload to path via a temporary file so a crash never leaves a partial entry
+
+    The temporary file has a unique name, so processes writing the same entry at the
+    same time do not clobber each other's file; the last os.replace wins.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path),
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _lru_entries(pattern):
+    """(modification time, size, path) of every file matching pattern, oldest first"""
+    entries = []
+    for path in glob.glob(pattern):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    return sorted(entries)
+
+
+def _evict_lru(entries, max_bytes, keep_path=None):
+    """Remove the oldest entries until their total size fits in max_bytes"""
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        if path == keep_path:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+class StateCache:
+    """End-of-run states stored as <cache_dir>/state/<config key>/<n_rows>_<prefix hash>.pkl
+
+    Loading an entry refreshes its modification time; when the folder grows beyond
+    max_mb the least recently used entries (of any key) are removed.
+    """
+
+    def __init__(self, cache_dir=None, max_mb=DEFAULT_STATE_CACHE_MB):
+        self.cache_dir = os.path.join(cache_dir or DEFAULT_CACHE_DIR, 'state')
+        self.max_bytes = int(max_mb * 1024 * 1024)
+
+    def _entries(self, key):
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, key, '*.pkl')):
+            name = os.path.splitext(os.path.basename(path))[0]
+            n_rows, _, digest = name.partition('_')
+            if n_rows.isdigit():
+                entries.append((int(n_rows), digest, path))
+        return sorted(entries, reverse=True)
+
+    def load(self, key, input_df):
+        """Return (n_rows, payload) for the longest cached run whose input rows are a prefix
+        of input_df, or (0, None) if there is none"""
+        hashes = row_hashes(input_df)
+        for n_rows, digest, path in self._entries(key):
+            if n_rows > len(input_df):
+                continue
+            if prefix_hash(input_df, n_rows, hashes) != digest:
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    payload = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                continue
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return n_rows, payload
+        return 0, None
+
+    def save(self, key, input_df, payload):
+        """Store the payload for all rows of input_df, replacing older entries of this key
+
+        A failed write (disk full, read-only cache folder, ...) is ignored: the cache only
+        saves time, it must never fail a run.
+        """
+        folder = os.path.join(self.cache_dir, key)
+        n_rows = len(input_df)
+        path = os.path.join(folder, f"{n_rows}_{prefix_hash(input_df, n_rows)}.pkl")
+        try:
+            os.makedirs(folder, exist_ok=True)
+            _write_atomic(path, payload)
+        except OSError:
+            return
+
+        for _, _, old_path in self._entries(key):
+            if old_path != path:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+        self.evict(keep_path=path)
+
+    def entries(self):
+        """(modification time, size, path) of every entry, oldest first"""
+        return _lru_entries(os.path.join(self.cache_dir, '*', '*.pkl'))
+
+    def size_bytes(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep_path=None):
+        """Remove least recently used entries until the cache fits in max_bytes"""
+        _evict_lru(self.entries(), self.max_bytes, keep_path)
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class ResultCache:
+    """Analysis outputs stored as <cache_dir>/results/<key>.pkl
+
+    Reading an entry refreshes its modification time; when the folder grows beyond
+    max_mb the least recently used entries are removed.
+    """
+
+    def __init__(self, cache_dir=None, max_mb=DEFAULT_RESULT_CACHE_MB):
+        self.cache_dir = os.path.join(cache_dir or DEFAULT_CACHE_DIR, 'results')
+        self.max_bytes = int(max_mb * 1024 * 1024)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def get(self, key):
+        """Cached output for key, or None"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                payload = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return payload
+
+    def put(self, key, payload):
+        """Store an output and evict old entries above the size limit (a failed write is ignored)"""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            _write_atomic(self._path(key), payload)
+        except OSError:
+            return
+        self.evict(keep=key)
+
+    def entries(self):
+        """(modification time, size, path) of every entry, oldest first"""
+        return _lru_entries(os.path.join(self.cache_dir, '*.pkl'))
+
+    def size_bytes(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits in max_bytes"""
+        _evict_lru(self.entries(), self.max_bytes, self._path(keep) if keep is not None else None)
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
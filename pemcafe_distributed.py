@@ -0,0 +1,418 @@
+# PEMCAFE distributed runs
+# a coordinator splits work into shards - chunks of Monte Carlo realizations, or whole sites -
+# and hands them to worker processes on any number of machines through a multiprocessing manager
+# (two queues served over TCP). Workers return mergeable MCAccumulator statistics (Monte Carlo)
+# or analysis outputs (sites); shards that fail or whose worker stops sending heartbeats are retried
+#
+#   python pemcafe_distributed.py mc    --input data.csv --n-simulations 100000 --seed 1 --port 50000 --authkey secret
+#   python pemcafe_distributed.py sites --input plot1.csv plot2.csv ... --output-dir results --port 50000 --authkey secret
+#   python pemcafe_distributed.py worker --address coordinator-host:50000 --authkey secret --processes 8
+#
+# --local-workers N on the coordinator commands also starts N workers on this machine
+#
+# the manager exchanges pickles, so anyone who can reach the port and knows the authkey can run
+# code on the coordinator and the workers: the coordinator listens on 127.0.0.1 unless --host is
+# given, there is no default authkey (a random one is generated and printed if none is passed),
+# and the port must only be reachable on a trusted network
+
+import argparse
+import json
+import os
+import queue
+import secrets
+import socket
+import threading
+import time
+import multiprocessing
+from multiprocessing.managers import BaseManager
+
+import pemcafe_engine
+
+DEFAULT_PORT = 50000
+# realizations per Monte Carlo shard
+DEFAULT_CHUNK_SIZE = 250
+# a started shard whose worker has been silent this long is handed out again
+HEARTBEAT_SECONDS = 5
+HEARTBEAT_TIMEOUT = 60
+
+_tasks = queue.Queue()
+_results = queue.Queue()
+
+
+def _get_tasks():
+    return _tasks
+
+
+def _get_results():
+    return _results
+
+
+class QueueManager(BaseManager):
+    """Serves the task and result queues of the coordinator"""
+
+
+QueueManager.register('get_tasks', callable=_get_tasks)
+QueueManager.register('get_results', callable=_get_results)
+
+
+def parse_address(text):
+    """'host:port' -> (host, port)"""
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def run_shard(kind, payload):
+    """Compute one shard (runs on the worker)"""
+    if kind == 'mc':
+        return pemcafe_engine.run_monte_carlo_chunk(**payload)
+    if kind == 'site':
+        output = pemcafe_engine.run_analysis(payload['input_df'], payload['config'])
+        return {key: output[key] for key in ('optimisation', 'params', 'results', 'error_log')}
+    raise ValueError(f"Unknown shard kind {kind}")
+
+
+def worker_loop(address, authkey, idle_exit=None):
+    """Take shards from the coordinator until it goes away (or idle_exit seconds without work)"""
+    manager = QueueManager(address=tuple(address), authkey=authkey)
+    manager.connect()
+    tasks, results = manager.get_tasks(), manager.get_results()
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    idle_since = time.time()
+
+    while True:
+        try:
+            task = tasks.get(timeout=1)
+        except queue.Empty:
+            if idle_exit is not None and time.time() - idle_since > idle_exit:
+                return
+            continue
+        except (EOFError, OSError):
+            # coordinator finished or was stopped
+            return
+
+        message = {'id': task['id'], 'attempt': task['attempt'], 'worker': name}
+        stop = threading.Event()
+
+        def heartbeat():
+            # the proxy opens its own connection in this thread
+            beats = manager.get_results()
+            while not stop.wait(HEARTBEAT_SECONDS):
+                try:
+                    beats.put(dict(message, status='alive'))
+                except (EOFError, OSError):
+                    return
+
+        try:
+            results.put(dict(message, status='started'))
+            beat = threading.Thread(target=heartbeat, daemon=True)
+            beat.start()
+            start = time.perf_counter()
+            try:
+                value = run_shard(task['kind'], task['payload'])
+                reply = dict(message, status='done', value=value, seconds=time.perf_counter() - start)
+            except Exception as e:
+                reply = dict(message, status='failed', error=f"{type(e).__name__}: {e}")
+            finally:
+                stop.set()
+            results.put(reply)
+        except (EOFError, OSError):
+            return
+        idle_since = time.time()
+
+
+def start_local_workers(address, authkey, n_workers=None):
+    """Start worker processes on this machine; returns the Process objects"""
+    workers = []
+    for _ in range(n_workers or multiprocessing.cpu_count()):
+        process = multiprocessing.Process(target=worker_loop, args=(address, authkey), daemon=True)
+        process.start()
+        workers.append(process)
+    return workers
+
+
+class Coordinator:
+    """Hands shards to the workers and collects their results
+
+    address           : (host, port) to listen on; port 0 picks a free port. Listen on other
+                        interfaces than 127.0.0.1 only on a trusted network.
+    authkey           : shared secret of the coordinator and the workers (bytes); None
+                        generates a random one (see the authkey attribute)
+    max_retries       : how often a failed or lost shard is handed out again
+    heartbeat_timeout : seconds of silence after which a started shard counts as lost
+    """
+
+    def __init__(self, address=('127.0.0.1', DEFAULT_PORT), authkey=None, max_retries=3,
+                 heartbeat_timeout=HEARTBEAT_TIMEOUT):
+        if authkey is None:
+            authkey = secrets.token_hex(16).encode()
+        self.manager = QueueManager(address=tuple(address), authkey=authkey)
+        self.authkey = authkey
+        self.max_retries = max_retries
+        self.heartbeat_timeout = heartbeat_timeout
+        self.tasks = None
+        self.results = None
+        self.workers = set()
+        self._next_id = 0
+
+    def start(self):
+        self.manager.start()
+        self.tasks, self.results = self.manager.get_tasks(), self.manager.get_results()
+        return self
+
+    @property
+    def address(self):
+        """Address workers connect to"""
+        host, port = self.manager.address
+        return (host if host not in ('', '0.0.0.0') else '127.0.0.1', port)
+
+    def close(self):
+        self.manager.shutdown()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _put(self, shard_id, kind, payload, attempt):
+        self.tasks.put({'id': shard_id, 'kind': kind, 'payload': payload, 'attempt': attempt})
+
+    def _retry(self, shard_id, shard, state):
+        state[0] += 1
+        state[1] = None
+        state[2] = time.time()
+        self._put(shard_id, *shard, state[0])
+
+    def run_shards(self, shards, on_result=None, progress=None):
+        """Run (kind, payload) shards on the workers
+
+        on_result(index, value) is called as shards finish (in completion order);
+        progress(done, total) after each one.
+        Returns {index: error} of the shards that still failed after max_retries retries.
+        """
+        base_id = self._next_id
+        self._next_id += len(shards)
+        # shard id -> [attempt, last sign of life (None while queued), time queued]
+        pending = {}
+        for index, (kind, payload) in enumerate(shards):
+            pending[base_id + index] = [0, None, time.time()]
+            self._put(base_id + index, kind, payload, 0)
+        drained_at = None
+
+        failures = {}
+        done = 0
+        while pending:
+            try:
+                message = self.results.get(timeout=1)
+            except queue.Empty:
+                message = None
+
+            if message is not None and message['id'] in pending:
+                shard_id = message['id']
+                index = shard_id - base_id
+                state = pending[shard_id]
+                self.workers.add(message['worker'])
+                status = message['status']
+
+                if status == 'done':
+                    # any attempt that finishes counts, later duplicates are ignored
+                    del pending[shard_id]
+                    done += 1
+                    if on_result is not None:
+                        on_result(index, message['value'])
+                    if progress is not None:
+                        progress(done, len(shards))
+                elif message['attempt'] != state[0]:
+                    # heartbeat or failure of an attempt that was already replaced
+                    pass
+                elif status in ('started', 'alive'):
+                    state[1] = time.time()
+                elif status == 'failed':
+                    if state[0] >= self.max_retries:
+                        del pending[shard_id]
+                        failures[index] = message['error']
+                        done += 1
+                        if progress is not None:
+                            progress(done, len(shards))
+                    else:
+                        self._retry(shard_id, shards[index], state)
+
+            # shards whose worker went silent, and shards taken by a worker that died before
+            # reporting (no longer queued but never started)
+            now = time.time()
+            if self.tasks.qsize() > 0:
+                drained_at = None
+            elif drained_at is None:
+                drained_at = now
+            for shard_id, state in list(pending.items()):
+                if state[1] is not None:
+                    lost = now - state[1] > self.heartbeat_timeout
+                else:
+                    lost = drained_at is not None and now - max(drained_at, state[2]) > self.heartbeat_timeout
+                if lost:
+                    index = shard_id - base_id
+                    if state[0] >= self.max_retries:
+                        del pending[shard_id]
+                        failures[index] = "worker lost"
+                        done += 1
+                        if progress is not None:
+                            progress(done, len(shards))
+                    else:
+                        self._retry(shard_id, shards[index], state)
+        return failures
+
+    def run_monte_carlo(self, input_df, params, sds, n_simulations, hbp=0, bnpp_method=1, dt=1.0,
+                        seed=None, chunk_size=DEFAULT_CHUNK_SIZE, max_samples=10000, progress=None):
+        """Distributed run_monte_carlo + statistics
+
+        The realizations are split into chunks of chunk_size; as the draws of a realization
+        depend only on (seed, realization), the result does not depend on how the work is split.
+        Returns (MCAccumulator, error_log); accumulator.ci_results(level) gives the same
+        dictionary as calculate_confidence_intervals.
+        """
+        if seed is None:
+            seed = int(pemcafe_engine.np.random.SeedSequence().entropy % (2**32))
+        shards = []
+        for start in range(0, n_simulations, chunk_size):
+            shards.append(('mc', {
+                'input_df': input_df, 'params': list(params), 'sds': sds, 'seed': seed,
+                'start': start, 'count': min(chunk_size, n_simulations - start),
+                'hbp': hbp, 'bnpp_method': bnpp_method, 'dt': dt, 'max_samples': max_samples,
+            }))
+
+        # merge in shard order so the percentile sample does not depend on completion order
+        accumulator = pemcafe_engine.MCAccumulator(max_samples, seed=seed)
+        finished = {}
+        error_logs = {}
+        next_index = [0]
+
+        def on_result(index, value):
+            finished[index], error_logs[index] = value
+            while next_index[0] in finished:
+                accumulator.merge(finished.pop(next_index[0]))
+                next_index[0] += 1
+
+        failures = self.run_shards(shards, on_result, progress)
+        if failures:
+            index, error = next(iter(sorted(failures.items())))
+            raise RuntimeError(f"{len(failures)} Monte Carlo chunk(s) failed, e.g. chunk {index}: {error}")
+
+        error_log = [line for index in sorted(error_logs) for line in error_logs[index]]
+        return accumulator, error_log
+
+    def run_sites(self, sites, config, progress=None):
+        """Run the full analysis (run_analysis) of every site on the workers
+
+        sites: {site name: input DataFrame}
+        Returns ({site name: output}, {site name: error}).
+        """
+        names = list(sites)
+        shards = [('site', {'input_df': sites[name], 'config': config}) for name in names]
+        outputs = {}
+
+        def on_result(index, value):
+            outputs[names[index]] = value
+
+        failures = self.run_shards(shards, on_result, progress)
+        return outputs, {names[index]: error for index, error in failures.items()}
+
+
+def _print_progress(done, total):
+    print(f"\r{done}/{total} shards", end='', flush=True)
+    if done == total:
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PEMCAFE distributed coordinator / worker")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    def coordinator_args(p):
+        p.add_argument('--host', default='127.0.0.1',
+                       help="interface to listen on (default 127.0.0.1; use '' or the machine's address "
+                            "for remote workers, on a trusted network only)")
+        p.add_argument('--port', type=int, default=DEFAULT_PORT)
+        p.add_argument('--authkey', default=None,
+                       help="shared secret of coordinator and workers (default: a random key, printed)")
+        p.add_argument('--config', help="JSON file with analysis settings (see pemcafe_engine.analysis_config)")
+        p.add_argument('--max-retries', type=int, default=3)
+        p.add_argument('--local-workers', type=int, default=0, help="also start this many workers here")
+
+    mc = sub.add_parser('mc', help="Monte Carlo of one input table with the configured parameters")
+    coordinator_args(mc)
+    mc.add_argument('--input', required=True)
+    mc.add_argument('--n-simulations', type=int, default=None)
+    mc.add_argument('--seed', type=int, default=None)
+    mc.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    mc.add_argument('--output', default='pemcafe_distributed_mc.csv')
+
+    sites = sub.add_parser('sites', help="full analysis of many sites, one input table per site")
+    coordinator_args(sites)
+    sites.add_argument('--input', nargs='+', required=True)
+    sites.add_argument('--output-dir', default='.')
+
+    worker = sub.add_parser('worker', help="take shards from a coordinator")
+    worker.add_argument('--address', required=True, help="coordinator host:port")
+    worker.add_argument('--authkey', required=True, help="the coordinator's authkey")
+    worker.add_argument('--processes', type=int, default=None, help="worker processes (default: CPU count)")
+    worker.add_argument('--idle-exit', type=float, default=None, help="stop after this many idle seconds")
+
+    args = parser.parse_args()
+    authkey = args.authkey.encode() if args.authkey else None
+
+    if args.command == 'worker':
+        address = parse_address(args.address)
+        processes = [multiprocessing.Process(target=worker_loop, args=(address, authkey, args.idle_exit))
+                     for _ in range(args.processes or multiprocessing.cpu_count())]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        return
+
+    import pandas as pd
+    config = {}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+    config = pemcafe_engine.analysis_config(**config)
+    dt = pemcafe_engine.TIME_STEPS[config['time_step']]
+
+    with Coordinator((args.host, args.port), authkey, args.max_retries) as coordinator:
+        if args.local_workers:
+            start_local_workers(coordinator.address, coordinator.authkey, args.local_workers)
+        print(f"Coordinator listening on {args.host or 'all interfaces'}, port {coordinator.manager.address[1]}")
+        if authkey is None:
+            print(f"Workers connect with --authkey {coordinator.authkey.decode()}")
+
+        if args.command == 'mc':
+            input_df = pd.read_csv(args.input, encoding='utf-8-sig')
+            n_simulations = args.n_simulations or config['n_simulations']
+            seed = args.seed if args.seed is not None else config['seed']
+            start = time.perf_counter()
+            accumulator, error_log = coordinator.run_monte_carlo(
+                input_df, config['params'], config['sds'], n_simulations, config['hbp'],
+                config['bnpp_method'], dt, seed=seed, chunk_size=args.chunk_size, progress=_print_progress)
+            seconds = time.perf_counter() - start
+
+            base_results = pemcafe_engine.run_model(input_df, config['params'], config['hbp'],
+                                                    config['bnpp_method'], dt)
+            results = pemcafe_engine.create_final_results_with_ci(
+                base_results, accumulator.ci_results(config['confidence_level']), config['confidence_level'])
+            results.to_csv(args.output, index=False)
+            print(f"{accumulator.n} realizations in {seconds:.1f} s on {len(coordinator.workers)} workers "
+                  f"({len(error_log)} failed) -> {args.output}")
+        else:
+            site_tables = {os.path.splitext(os.path.basename(path))[0]: pd.read_csv(path, encoding='utf-8-sig')
+                           for path in args.input}
+            outputs, failures = coordinator.run_sites(site_tables, config, progress=_print_progress)
+            os.makedirs(args.output_dir, exist_ok=True)
+            for name, output in outputs.items():
+                output['results'].to_csv(os.path.join(args.output_dir, f"{name}_results.csv"), index=False)
+            for name, error in failures.items():
+                print(f"Site {name} failed: {error}")
+            print(f"{len(outputs)} sites done, {len(failures)} failed -> {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1239 @@
+# PEMCAFE model engine (headless)
+# the same carbon allocation equations as the GUI, usable without tkinter
+# calculate_values / run_model : original row-by-row version (one site, one series)
+# step_batch                   : vectorised version, one time step for many scenarios at once
+
+import contextlib
+import math
+import numpy as np
+import pandas as pd
+
+import pemcafe_cache
+
+# scipy is imported inside the functions that use it (optimisation, confidence
+# intervals); it takes longer to import than the rest and plain model runs do not need it
+
+PARAM_NAMES = ['kLitter', 'LTurnoverR', 'BTurnoverR', 'CTurnoverR',
+               'StTurnoverR', 'RhTurnoverR', 'RoTurnoverR', 'Rratio_Litter_layer']
+
+OPTIMISATION_METHODS = ("Nelder-Mead", "L-BFGS-B", "TNC", "SLSQP")
+
+DEFAULT_PARAMS = {
+    'kLitter': 0.32,
+    'LTurnoverR': 0.63,
+    'BTurnoverR': 0.21,
+    'CTurnoverR': 0.18,
+    'StTurnoverR': 0.18,
+    'RhTurnoverR': 0.9/8.1,
+    'RoTurnoverR': 3.10/8.40,
+    'Rratio_Litter_layer': 3.87561968569648/(1.57416255555556 + 3.87561968569648)
+}
+
+DEFAULT_BOUNDS = {
+    'kLitter': (0, 1),
+    'LTurnoverR': (0, 2),
+    'BTurnoverR': (0, 2),
+    'CTurnoverR': (0, 2),
+    'StTurnoverR': (0, 2),
+    'RhTurnoverR': (0, 1),
+    'RoTurnoverR': (0, 1),
+    'Rratio_Litter_layer': (0, 1)
+}
+
+# standard deviations of the inputs for Monte Carlo simulation
+DEFAULT_SDS = {
+    'Foliages': 0.3,
+    'Branches': 0.7,
+    'Culms': 3.2,
+    'Roots': 0.4,
+    'Rhizomes': 0.3,
+    'Stumps': 1.1
+}
+
+# pools carried from one time step to the next
+STATE_COLUMNS = ['Foliages', 'Branches', 'Culms', 'Stumps', 'Rhizomes', 'Roots',
+                 'Litter_layer', 'SC', 'TEC']
+
+# fluxes (per time step, 0 at t0)
+FLUX_COLUMNS = [
+    'LNP', 'BNP', 'CNP', 'StNP', 'RhNP', 'RoNP',
+    'ANPP', 'BNPP', 'TNPP', 'LD', 'BD', 'CD',
+    'Litterfall', 'StD', 'RhD', 'RoD', 'Dbelow',
+    'NEP', 'NEP_with_Aboveground_Detritus_Litter_layer_HR',
+    'NEP_from_dTEC', 'dSC', 'DLitter_layer', 'GPP',
+    'SR', 'Litter_layer_HR', 'Soil_HR', 'HR',
+    'Foliages_AR', 'Branches_AR', 'Culms_AR', 'Aboveground_AR',
+    'Soil_AR', 'AR', 'Roots_AR', 'Rhizomes_AR', 'Stumps_AR',
+    'Roots_AR_ratio', 'Rhizomes_AR_ratio', 'Stumps_AR_ratio'
+]
+
+# columns that have to be given for every time step
+DRIVER_COLUMNS = ['AvgTemp', 'Foliages', 'Branches', 'Culms', 'Undergrowth']
+
+# length of one time step in years
+# turnover rates, litter decomposition, respiration and the annual HR / allometric relations
+# are scaled by dt
+TIME_STEPS = {
+    'Annual': 1.0,
+    'Monthly': 1.0/12,
+    'Daily': 1.0/365,
+}
+
+
+def calculate_values(row, prev_row, params, hbp=0, bnpp_method=1, columns=None, dt=1.0):
+    """Calculate values for each row - same as original function
+
+    dt is the length of the time step in years (see TIME_STEPS); annual rates are scaled
+    to the step, dt=1 gives the original annual model.
+    """
+
+    # 添加保護性檢查
+    def safe_divide(a, b):
+        return a / b if abs(b) > 1e-10 else 0.0
+
+    def safe_exp(x):
+        try:
+            return math.exp(x)
+        except:
+            return 0.0
+
+    # 初始化prev_row為全零字典（如果為None）
+    if prev_row is None:
+        # 創建包含所有必要字段的默認prev_row
+        default_vals = {col: 0.0 for col in (columns if columns is not None else row.index)}
+        default_vals.update({
+            'Litter_layer': row['Litter_layer'] if 'Litter_layer' in row else 0.01,
+            'SC': row['SC'] if 'SC' in row else 0.01,
+            'Foliages': row['Foliages'] if 'Foliages' in row else 0.01,
+            'Branches': row['Branches'] if 'Branches' in row else 0.01,
+            'Culms': row['Culms'] if 'Culms' in row else 0.01,
+            'Stumps': row['Stumps'] if 'Stumps' in row else 0.01,
+            'Rhizomes': row['Rhizomes'] if 'Rhizomes' in row else 0.01,
+            'Roots': row['Roots'] if 'Roots' in row else 0.01,
+        })
+        prev_row = pd.Series(default_vals)
+
+    kLitter, LTurnoverR, BTurnoverR, CTurnoverR, StTurnoverR, RhTurnoverR, RoTurnoverR, Rratio_Litter_layer = params
+
+    results = row.to_dict()
+
+
+
+    # Net production calculations
+    results['LNP'] = row['Foliages'] - prev_row['Foliages'] if prev_row is not None else 0
+    results['BNP'] = row['Branches'] - prev_row['Branches'] if prev_row is not None else 0
+    results['CNP'] = row['Culms'] - prev_row['Culms'] if prev_row is not None else 0
+
+    results['AGC'] = row['Foliages'] + row['Branches'] + row['Culms']
+
+    results['StNP'] = 0.1955 * results['CNP']
+    results['RhNP'] = 1.1162 * abs(results['LNP']/dt)**0.7279 * dt if results['LNP'] != 0 else 0
+    results['RoNP'] = 0.9847 * results['RhNP']
+
+    if prev_row is None:
+        results['Stumps'] = row['Stumps']
+        results['Rhizomes'] = row['Rhizomes']
+        results['Roots'] = row['Roots']
+    else:
+        results['Stumps'] = prev_row['Stumps'] + results['StNP']
+        results['Rhizomes'] = prev_row['Rhizomes'] + results['RhNP']
+        results['Roots'] = prev_row['Roots'] + results['RoNP']
+
+    results['BGC'] = results['Stumps'] + results['Rhizomes'] + results['Roots']
+    results['Root_Shoot_Ratio'] = safe_divide(results['BGC'], results['AGC'])
+    results['TC'] = results['AGC'] + results['BGC']
+
+    # Death calculations
+    results['LD'] = prev_row['Foliages'] * LTurnoverR * dt if prev_row is not None else 0
+    results['BD'] = prev_row['Branches'] * BTurnoverR * dt if prev_row is not None else 0
+    results['CD'] = prev_row['Culms'] * CTurnoverR * dt if prev_row is not None else 0
+
+    HBP = hbp
+    if HBP == 1:
+        results['Litterfall'] = results['LD'] + results['BD']
+    else:
+        results['Litterfall'] = results['LD'] + results['BD'] + results['CD']
+
+    results['ANPP'] = results['LNP'] + results['BNP'] + results['CNP'] + results['Litterfall']
+
+    results['StD'] = prev_row['Stumps'] * StTurnoverR * dt if prev_row is not None else 0
+    results['RhD'] = prev_row['Rhizomes'] * RhTurnoverR * dt if prev_row is not None else 0
+    results['RoD'] = prev_row['Roots'] * RoTurnoverR * dt if prev_row is not None else 0
+
+    results['Dbelow'] = results['StD'] + results['RhD'] + results['RoD']
+
+    BNPPmethod = bnpp_method
+    if BNPPmethod == 1:
+        results['BNPP'] = results['StNP'] + results['RhNP'] + results['RoNP'] + results['Dbelow']
+    else:
+        results['BNPP'] = results['StNP'] + results['RhNP'] + results['RoNP'] + results['Soil_AR']
+
+    results['TNPP'] = results['ANPP'] + results['BNPP']
+
+    # Soil HR calculation (annual relation, applied to the annualised ANPP)
+    annual_anpp = results['ANPP'] / dt
+    if annual_anpp < 4.17:
+        hr_anpp = 4.17
+    elif annual_anpp > 11.8:
+        hr_anpp = 11.8
+    else:
+        hr_anpp = annual_anpp
+    results['Soil_HR'] = 0.0071 * hr_anpp**3.0772 * dt if results['ANPP'] != 0 else 0
+
+    # Autotrophic respiration calculations
+    results['Foliages_AR'] = 1.172/1.172 * ((1.445 * 10**(-1) * safe_exp(7.918*10**(-2)*row['AvgTemp'])) * 365*24*dt * (row['Foliages']/0.4544 * 1000000) /1000/1000/1000 * 12/44.01)
+    results['Branches_AR'] = 0.215/1.172 * ((1.445 * 10**(-1) * safe_exp(7.918*10**(-2)*row['AvgTemp'])) * 365*24*dt * (row['Branches']/0.4815 * 1000000) /1000/1000/1000 * 12/44.01)
+    results['Culms_AR'] = 0.085/1.172 * ((1.445 * 10**(-1) * safe_exp(7.918*10**(-2)*row['AvgTemp'])) * 365*24*dt * (row['Culms']/0.4628 * 1000000) /1000/1000/1000 * 12/44.01)
+    results['Aboveground_AR'] = results['Foliages_AR'] + results['Branches_AR'] + results['Culms_AR']
+
+    # Soil AR ratios
+    denominator = ((0.088/1.172 * ((1.445 * 10**(-1) * safe_exp(7.918*10**(-2)*row['AvgTemp'])) * 365*24*dt * (results['Roots']/0.4487 * 1000000) /1000/1000/1000 * 12/44.01))+
+                  (0.179/1.172 * ((1.445 * 10**(-1) * safe_exp(7.918*10**(-2)*row['AvgTemp'])) * 365*24*dt * (results['Rhizomes']/0.4354 * 1000000) /1000/1000/1000 * 12/44.01))+
+                  (0.085/1.172 * ((1.445 * 10**(-1) * safe_exp(7.918*10**(-2)*row['AvgTemp'])) * 365*24*dt * (results['Stumps']/0.4628 * 1000000) /1000/1000/1000 * 12/44.01)))
+
+    if abs(denominator) > 1e-10:
+        results['Roots_AR_ratio'] = (0.088/1.172 * ((1.445 * 10**(-1) * safe_exp(7.918*10**(-2)*row['AvgTemp'])) * 365*24*dt * (results['Roots']/0.4487 * 1000000) /1000/1000/1000 * 12/44.01)) / denominator
+        results['Rhizomes_AR_ratio'] = (0.179/1.172 * ((1.445 * 10**(-1) * safe_exp(7.918*10**(-2)*row['AvgTemp'])) * 365*24*dt * (results['Rhizomes']/0.4354 * 1000000) /1000/1000/1000 * 12/44.01)) / denominator
+        results['Stumps_AR_ratio'] = (0.085/1.172 * ((1.445 * 10**(-1) * safe_exp(7.918*10**(-2)*row['AvgTemp'])) * 365*24*dt * (results['Stumps']/0.4628 * 1000000) /1000/1000/1000 * 12/44.01)) / denominator
+    else:
+        results['Roots_AR_ratio'] = 0
+        results['Rhizomes_AR_ratio'] = 0
+        results['Stumps_AR_ratio'] = 0
+
+    results['Soil_AR'] = 0.000006 * results['BGC']**3.3249 * dt
+
+    results['Roots_AR'] = results['Soil_AR'] * results['Roots_AR_ratio']
+    results['Rhizomes_AR'] = results['Soil_AR'] * results['Rhizomes_AR_ratio']
+    results['Stumps_AR'] = results['Soil_AR'] * results['Stumps_AR_ratio']
+
+    results['AR'] = results['Aboveground_AR'] + results['Soil_AR']
+    results['SR'] = results['Soil_AR'] + results['Soil_HR']
+    results['NEP_with_Aboveground_Detritus_Litter_layer_HR'] = results['TNPP'] - results['Soil_HR'] if results['TNPP'] != 0 else 0
+
+    # Litter layer calculations
+    # annual model: (previous pool + litterfall) * kLitter, written as a rate so that every
+    # litter term scales linearly with dt (sub-annual steps add up to the annual model)
+    results['Litter_layer'] = (prev_row['Litter_layer'] + kLitter * results['Litterfall']
+                               - (1 - kLitter) * dt * prev_row['Litter_layer']) if prev_row is not None else row['Litter_layer']
+    results['DLitter_layer'] = results['Litter_layer'] * kLitter * dt
+    results['Litter_layer_HR'] = results['Litter_layer'] * Rratio_Litter_layer * dt
+
+    results['HR'] = results['Soil_HR'] + results['Litter_layer_HR']
+    results['NEP'] = results['NEP_with_Aboveground_Detritus_Litter_layer_HR'] - results['Litter_layer_HR'] if results['TNPP'] != 0 else 0
+
+    # Soil carbon
+    if prev_row is not None:
+        results['SC'] = prev_row['SC'] + results['Dbelow'] - results['Soil_HR'] + results['DLitter_layer']
+    else:
+        results['SC'] = row['SC']
+
+    results['dSC'] = results['SC'] - prev_row['SC'] if prev_row is not None else 0
+    results['TEC'] = results['TC'] + results['Litter_layer'] + results['SC'] + row['Undergrowth']
+    results['NEP_from_dTEC'] = results['TEC'] - prev_row['TEC'] if prev_row is not None else 0
+
+    results['GPP'] = results['TNPP'] + results['AR']
+
+    return results
+
+
+def run_model(input_df, params, hbp=0, bnpp_method=1, dt=1.0, prev_row=None, start_row=0):
+    """Run the model with given parameters
+
+    prev_row / start_row resume a run: rows before start_row are skipped and prev_row is
+    the last computed row (the end state of the earlier run).
+    """
+    if input_df is None:
+        raise ValueError("No input data loaded")
+
+    results = []
+    columns = input_df.columns
+
+    for i in range(start_row, len(input_df)):
+        updated_values = calculate_values(input_df.iloc[i], prev_row, params, hbp, bnpp_method, columns, dt)
+        results.append(updated_values)
+        prev_row = updated_values
+
+    return pd.DataFrame(results)
+
+
+def run_model_incremental(input_df, params, hbp=0, bnpp_method=1, dt=1.0, cache=None, profiler=None):
+    """run_model that resumes from the cached end state when rows have been appended
+
+    The end state is stored per parameter set / settings together with a hash of the
+    input rows; if those rows are unchanged at the top of input_df only the new rows
+    are computed. profiler (pemcafe_profiling.RunProfiler) counts evaluations and cache hits.
+    """
+    cache = cache if cache is not None else pemcafe_cache.StateCache()
+    key = pemcafe_cache.config_key(kind='run', params=[float(p) for p in params],
+                                   hbp=int(hbp), bnpp_method=int(bnpp_method), dt=float(dt))
+    n_done, payload = cache.load(key, input_df)
+    if profiler is not None:
+        profiler.count('cache_hits' if payload is not None else 'cache_misses')
+    if payload is not None and n_done == len(input_df):
+        return payload['results']
+
+    prev_row = payload['state'] if payload is not None else None
+    new_results = run_model(input_df, params, hbp, bnpp_method, dt, prev_row, n_done)
+    if profiler is not None:
+        profiler.count('model_evaluations')
+    if payload is not None:
+        results = pd.concat([payload['results'], new_results], ignore_index=True)
+    else:
+        results = new_results
+
+    cache.save(key, input_df, {'results': results, 'state': results.iloc[-1].to_dict()})
+    return results
+
+
+def objective_function(params, input_df, hbp=0, bnpp_method=1, dt=1.0):
+    """Objective function for optimisation"""
+    try:
+        results = run_model(input_df, params, hbp, bnpp_method, dt)
+        if len(results) > 1:
+            rmse = np.sqrt(np.mean((results['NEP_from_dTEC'].iloc[1:] - results['NEP'].iloc[1:])**2))
+            return rmse
+        else:
+            return 1e6
+    except:
+        return 1e6
+
+
+def parameter_constraints():
+    """Ordering constraints between turnover rates"""
+    return [
+        {'type': 'ineq', 'fun': lambda params: params[1] - params[2]},  # LTurnoverR > BTurnoverR
+        {'type': 'ineq', 'fun': lambda params: params[2] - params[3]},  # BTurnoverR > CTurnoverR
+        {'type': 'ineq', 'fun': lambda params: params[6] - params[5]}   # RoTurnoverR > RhTurnoverR
+    ]
+
+
+def optimise_parameters(input_df, initial_params, bounds, method='Nelder-Mead',
+                        hbp=0, bnpp_method=1, dt=1.0, objective=None):
+    """Calibrate the parameters (minimise the NEP vs NEP_from_dTEC RMSE)
+
+    objective replaces the default objective_function, e.g. the GUI's own method.
+    """
+    from scipy.optimize import minimize
+
+    if objective is None:
+        def objective(params):
+            return objective_function(params, input_df, hbp, bnpp_method, dt)
+
+    return minimize(objective, initial_params, method=method,
+                    bounds=bounds, constraints=parameter_constraints())
+
+
+def limit_perturbed_values(var, values):
+    """Keep perturbed inputs physically meaningful"""
+    # 根據變量類型應用不同的約束
+    if var in ['Foliages', 'Branches', 'Culms', 'Roots', 'Rhizomes', 'Stumps']:
+        # 生物量變量應為非負
+        return np.maximum(values, 0.01)
+    elif var == 'AvgTemp':
+        # 溫度應在合理範圍內
+        return np.clip(values, -10, 50)
+    elif var in ['Litter_layer', 'SC']:
+        # 土壤和凋落物應為非負
+        return np.maximum(values, 0.01)
+    return values
+
+
+def steps_per_year(dt):
+    """Number of input rows per year for a time step of dt years (1 for annual steps)"""
+    return max(1, int(round(1.0 / dt)))
+
+
+def interpolate_noise(nodes, rows, n_per_year, first_node=0):
+    """Noise of the given rows from draws made once per inventory year
+
+    The SDs are those of the annual inventory, so each year (row k * n_per_year) gets one
+    draw, nodes[k - first_node], and the rows in between are interpolated linearly, as
+    interpolate_inventory does for the pools. With annual steps every row is a node.
+    """
+    k, within = np.divmod(np.asarray(rows), n_per_year)
+    f = (within / n_per_year)[:, None]
+    lower = nodes[k - first_node]
+    upper = nodes[np.minimum(k + 1 - first_node, len(nodes) - 1)]
+    return (1 - f) * lower + f * upper
+
+
+def generate_perturbed_data(original_df, sds, dt=1.0):
+    """Generate perturbed input data based on standard deviations (see interpolate_noise)"""
+    perturbed_df = original_df.copy()
+    variables = [var for var in sds.keys() if var in perturbed_df.columns]
+    if not variables or len(perturbed_df) == 0:
+        return perturbed_df
+
+    n_per_year = steps_per_year(dt)
+    n_nodes = -(-(len(perturbed_df) - 1) // n_per_year) + 1
+    scales = np.array([sds[var] for var in variables], dtype=float)
+    nodes = np.random.normal(0, 1, (n_nodes, len(variables))) * scales
+    noise = interpolate_noise(nodes, np.arange(len(perturbed_df)), n_per_year)
+
+    for k, var in enumerate(variables):
+        perturbed_df[var] = limit_perturbed_values(var, perturbed_df[var].values + noise[:, k])
+
+    return perturbed_df
+
+
+# seeded perturbations are drawn per block of this many inventory years
+PERTURB_ROW_BLOCK = 64
+
+
+def seeded_noise(seed, realization, block, n_variables):
+    """Standard normal draws (PERTURB_ROW_BLOCK, n_variables) for one block of inventory years
+
+    The generator is seeded with (seed, realization, block) and always draws a full block,
+    so the draws of a year do not change when rows are appended.
+    """
+    return np.random.default_rng([seed, realization, block]).standard_normal((PERTURB_ROW_BLOCK, n_variables))
+
+
+def perturb_rows(original_df, sds, seed, realization, start_row=0, dt=1.0):
+    """Perturbed copy of the rows from start_row on, reproducible row by row
+
+    One draw per inventory year (seeded_noise), interpolated to the rows (interpolate_noise).
+    """
+    perturbed_df = original_df.iloc[start_row:].copy()
+    variables = [var for var in sds.keys() if var in perturbed_df.columns]
+    if not variables or len(perturbed_df) == 0:
+        return perturbed_df
+
+    n_per_year = steps_per_year(dt)
+    scales = np.array([sds[var] for var in variables], dtype=float)
+    first_block = (start_row // n_per_year) // PERTURB_ROW_BLOCK
+    last_block = (-(-(len(original_df) - 1) // n_per_year)) // PERTURB_ROW_BLOCK
+    nodes = np.concatenate([seeded_noise(seed, realization, block, len(variables))
+                            for block in range(first_block, last_block + 1)]) * scales
+    noise = interpolate_noise(nodes, np.arange(start_row, len(original_df)), n_per_year,
+                              first_block * PERTURB_ROW_BLOCK)
+
+    for k, var in enumerate(variables):
+        perturbed_df[var] = limit_perturbed_values(var, perturbed_df[var].values + noise[:, k])
+
+    return perturbed_df
+
+
+def run_monte_carlo(input_df, params, sds, n_simulations, hbp=0, bnpp_method=1, dt=1.0,
+                    seed=None, cache=None, progress=None, profiler=None):
+    """Run Monte Carlo simulation
+
+    Without a seed every call draws new perturbations (original behaviour). With a seed the
+    draws are reproducible and, if a StateCache is given, every realization's results and
+    end state are stored, so appended rows are computed only for the new years.
+
+    profiler (pemcafe_profiling.RunProfiler) counts model evaluations and cache hits.
+
+    Returns (all_results, error_log).
+    """
+    all_results = []
+    error_log = []
+
+    if seed is None or cache is None:
+        for i in range(n_simulations):
+            if progress is not None and i % 100 == 0:
+                progress(i, n_simulations)
+            try:
+                if seed is None:
+                    perturbed_df = generate_perturbed_data(input_df, sds, dt)
+                else:
+                    perturbed_df = perturb_rows(input_df, sds, seed, i, dt=dt)
+                result = run_model(perturbed_df, params, hbp, bnpp_method, dt)
+                if profiler is not None:
+                    profiler.count('model_evaluations')
+                # 檢查結果是否有效
+                if result.isnull().values.any():
+                    error_log.append(f"Simulation {i+1} contains NaN values")
+                else:
+                    all_results.append(result)
+            except Exception as e:
+                error_log.append(f"Simulation {i+1} failed: {str(e)}")
+        return all_results, error_log
+
+    key = pemcafe_cache.config_key(kind='monte_carlo', params=[float(p) for p in params],
+                                   sds={k: float(v) for k, v in sds.items()},
+                                   n_simulations=int(n_simulations), seed=int(seed),
+                                   hbp=int(hbp), bnpp_method=int(bnpp_method), dt=float(dt))
+    n_done, payload = cache.load(key, input_df)
+    if profiler is not None:
+        profiler.count('cache_hits' if payload is not None else 'cache_misses')
+    if payload is None:
+        payload = {'realizations': {}, 'states': {}, 'failed': {}}
+
+    for i in range(n_simulations):
+        if progress is not None and i % 100 == 0:
+            progress(i, n_simulations)
+
+        if i in payload['failed']:
+            error_log.append(payload['failed'][i])
+            continue
+
+        try:
+            if i in payload['realizations']:
+                if n_done < len(input_df):
+                    perturbed_df = perturb_rows(input_df, sds, seed, i, n_done, dt)
+                    new_rows = run_model(perturbed_df, params, hbp, bnpp_method, dt,
+                                         payload['states'][i])
+                    result = pd.concat([payload['realizations'][i], new_rows], ignore_index=True)
+                    if profiler is not None:
+                        profiler.count('model_evaluations')
+                else:
+                    result = payload['realizations'][i]
+                if profiler is not None:
+                    profiler.count('realizations_reused')
+            else:
+                perturbed_df = perturb_rows(input_df, sds, seed, i, dt=dt)
+                result = run_model(perturbed_df, params, hbp, bnpp_method, dt)
+                if profiler is not None:
+                    profiler.count('model_evaluations')
+
+            # 檢查結果是否有效
+            if result.isnull().values.any():
+                error_msg = f"Simulation {i+1} contains NaN values"
+            else:
+                error_msg = None
+        except Exception as e:
+            result = None
+            error_msg = f"Simulation {i+1} failed: {str(e)}"
+
+        if error_msg is not None:
+            error_log.append(error_msg)
+            payload['failed'][i] = error_msg
+            payload['realizations'].pop(i, None)
+            payload['states'].pop(i, None)
+        else:
+            all_results.append(result)
+            payload['realizations'][i] = result
+            payload['states'][i] = result.iloc[-1].to_dict()
+
+    cache.save(key, input_df, payload)
+    return all_results, error_log
+
+
+def check_output_variables(variables, bnpp_method=1):
+    """Raise ValueError if variables cannot be kept by run_monte_carlo_arrays
+
+    The names must be output columns of step_batch. BNPP method 0 is refused: step_batch
+    uses the Soil_AR of the current step, while calculate_values takes it from the input
+    row, so the realizations would not match the model run.
+    """
+    if bnpp_method != 1:
+        raise ValueError("Output variables need BNPP method 1 (method 0 takes Soil_AR from the "
+                         "input rows); leave them empty to run the full Monte Carlo")
+    known = step_batch({col: 1.0 for col in STATE_COLUMNS}, {col: 1.0 for col in DRIVER_COLUMNS},
+                       [DEFAULT_PARAMS[name] for name in PARAM_NAMES])
+    unknown = [var for var in variables if var not in known]
+    if unknown:
+        raise ValueError(f"Unknown output variables: {', '.join(unknown)}")
+
+
+def run_monte_carlo_arrays(input_df, params, sds, n_simulations, variables, hbp=0, bnpp_method=1, dt=1.0,
+                           seed=None, batch_size=1000, dtype=np.float32, progress=None, profiler=None):
+    """Monte Carlo simulation keeping only the requested output variables
+
+    The realizations are run together, batch_size at a time, with step_batch; only the
+    columns needed for variables (and the state) are computed, and the outputs are stored
+    in one compact array instead of a DataFrame per realization. With a seed the
+    perturbations are the same as in run_monte_carlo.
+
+    Returns (values, error_log): values has shape (valid realizations, rows, len(variables)).
+    """
+    variables = list(variables)
+    check_output_variables(variables, bnpp_method)
+    outputs = set(variables)
+    n_steps = len(input_df)
+    perturbed = [var for var in sds.keys() if var in input_df.columns]
+    scales = np.array([sds[var] for var in perturbed], dtype=float)
+    n_per_year = steps_per_year(dt)
+    columns = {col: input_df[col].to_numpy(dtype=float)
+               for col in set(perturbed) | set(DRIVER_COLUMNS) | set(STATE_COLUMNS) if col in input_df.columns}
+
+    values = np.empty((n_simulations, n_steps, len(variables)), dtype=dtype)
+    valid = np.ones(n_simulations, dtype=bool)
+
+    for start in range(0, n_simulations, batch_size):
+        if progress is not None:
+            progress(start, n_simulations)
+        stop = min(start + batch_size, n_simulations)
+        n = stop - start
+
+        # one draw per inventory year (node), interpolated to the rows in between
+        nodes, blocks = {}, {}
+
+        def node(k):
+            if k not in nodes:
+                if seed is None:
+                    nodes[k] = np.random.normal(0, 1, (n, len(perturbed)))
+                else:
+                    block = k // PERTURB_ROW_BLOCK
+                    if block not in blocks:
+                        blocks[block] = np.stack([seeded_noise(seed, i, block, len(perturbed))
+                                                  for i in range(start, stop)])
+                        blocks.pop(block - 2, None)
+                    nodes[k] = blocks[block][:, k % PERTURB_ROW_BLOCK]
+                nodes.pop(k - 2, None)
+            return nodes[k]
+
+        state = None
+        for row in range(n_steps):
+            k, within = divmod(row, n_per_year)
+            if within == 0:
+                noise = node(k) * scales
+            else:
+                f = within / n_per_year
+                noise = ((1 - f) * node(k) + f * node(k + 1)) * scales
+            row_values = {col: column[row] for col, column in columns.items()}
+            for k, var in enumerate(perturbed):
+                row_values[var] = limit_perturbed_values(var, row_values[var] + noise[:, k])
+
+            if state is None:
+                # t=0: pools start at the (perturbed) observed values, as initial_state
+                state = {col: (0.0 if col == 'TEC' else
+                               np.broadcast_to(np.nan_to_num(row_values[col], nan=0.01), (n,)) if col in row_values
+                               else 0.01)
+                         for col in STATE_COLUMNS}
+            drivers = {col: np.broadcast_to(row_values[col], (n,)) for col in DRIVER_COLUMNS}
+            step = step_batch(state, drivers, params, hbp, bnpp_method, dt, outputs)
+            state = {col: step[col] for col in STATE_COLUMNS}
+            for k, var in enumerate(variables):
+                values[start:stop, row, k] = step[var]
+
+        if profiler is not None:
+            profiler.count('model_evaluations', n)
+
+    # 檢查結果是否有效
+    bad = np.flatnonzero(~np.isfinite(values).all(axis=(1, 2)))
+    valid[bad] = False
+    error_log = [f"Simulation {i+1} contains NaN values" for i in bad]
+    return values[valid], error_log
+
+
+def calculate_confidence_intervals(all_results, confidence_level=0.95, variables=None):
+    """Calculate confidence intervals from Monte Carlo results
+
+    variables limits the calculation to these output columns (default: all).
+    """
+    from scipy import stats
+
+    if len(all_results) == 0:
+        return None
+
+    # 清理結果 - 替換NaN為0
+    for result in all_results:
+        result.fillna(0, inplace=True)
+
+    output_columns = [col for col in all_results[0].columns
+                     if col not in ['t', 'AvgTemp', 'Undergrowth']]
+    if variables is not None:
+        output_columns = [col for col in output_columns if col in variables]
+
+    ci_results = {}
+    alpha = 1 - confidence_level
+
+    for col in output_columns:
+        col_values = []
+        for result in all_results:
+            if col in result.columns:
+                col_values.append(result[col].values)
+
+        if col_values:
+            col_array = np.array(col_values)
+
+            # 方法1：使用t分布置信區間（推薦）
+            mean_values = np.mean(col_array, axis=0)
+            std_values = np.std(col_array, axis=0, ddof=1)  # 使用樣本標準差
+            n = len(col_values)
+
+            # 使用t分布計算置信區間
+            t_value = stats.t.ppf(1 - alpha/2, df=n-1)
+            margin_of_error = t_value * std_values / np.sqrt(n)
+
+            lower_ci = mean_values - margin_of_error
+            upper_ci = mean_values + margin_of_error
+
+            # 方法2：百分位數方法（作為備選）
+            lower_percentile = (alpha/2) * 100
+            upper_percentile = (1 - alpha/2) * 100
+            percentile_lower = np.percentile(col_array, lower_percentile, axis=0)
+            percentile_upper = np.percentile(col_array, upper_percentile, axis=0)
+
+            ci_results[col] = {
+                'mean': mean_values,
+                'std': std_values,
+                'lower_ci': lower_ci,
+                'upper_ci': upper_ci,
+                'percentile_lower': percentile_lower,
+                'percentile_upper': percentile_upper,
+                'n_simulations': n
+            }
+
+    return ci_results
+
+
+def confidence_intervals_from_array(values, variables, confidence_level=0.95):
+    """calculate_confidence_intervals for the array of run_monte_carlo_arrays"""
+    from scipy import stats
+
+    if len(values) == 0:
+        return None
+
+    n = len(values)
+    alpha = 1 - confidence_level
+    t_value = stats.t.ppf(1 - alpha/2, df=n-1)
+
+    ci_results = {}
+    for k, col in enumerate(variables):
+        col_array = values[:, :, k].astype(float)
+        mean_values = np.mean(col_array, axis=0)
+        std_values = np.std(col_array, axis=0, ddof=1)
+        margin_of_error = t_value * std_values / np.sqrt(n)
+        ci_results[col] = {
+            'mean': mean_values,
+            'std': std_values,
+            'lower_ci': mean_values - margin_of_error,
+            'upper_ci': mean_values + margin_of_error,
+            'percentile_lower': np.percentile(col_array, (alpha/2) * 100, axis=0),
+            'percentile_upper': np.percentile(col_array, (1 - alpha/2) * 100, axis=0),
+            'n_simulations': n
+        }
+    return ci_results
+
+
+class MCAccumulator:
+    """Mergeable Monte Carlo statistics, the partial-result form of calculate_confidence_intervals
+
+    Realizations are added one at a time (add) and accumulators built from different
+    chunks of realizations can be combined (merge), e.g. on different machines.
+    Mean and standard deviation are merged exactly (Chan et al. pairwise update); the
+    percentiles come from a uniform sample of at most max_samples realizations, so they
+    are exact as long as the total number of realizations does not exceed max_samples.
+    """
+
+    def __init__(self, max_samples=10000, seed=0):
+        self.max_samples = max_samples
+        self.rng = np.random.default_rng(seed)
+        self.n = 0
+        self.columns = None
+        self.mean = None
+        self.m2 = None
+        self.samples = []
+
+    def add(self, result):
+        """Add one realization (a run_model DataFrame)"""
+        # 清理結果 - 替換NaN為0
+        result = result.fillna(0)
+        if self.columns is None:
+            self.columns = [col for col in result.columns
+                            if col not in ['t', 'AvgTemp', 'Undergrowth']]
+            self.mean = np.zeros((len(self.columns), len(result)))
+            self.m2 = np.zeros_like(self.mean)
+
+        x = result[self.columns].to_numpy(dtype=float).T
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+        # reservoir sampling for the percentiles
+        if len(self.samples) < self.max_samples:
+            self.samples.append(x)
+        else:
+            j = self.rng.integers(0, self.n)
+            if j < self.max_samples:
+                self.samples[j] = x
+
+    def merge(self, other):
+        """Combine with another accumulator (in place); returns self"""
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.columns, self.mean, self.m2 = other.columns, other.mean.copy(), other.m2.copy()
+            self.n, self.samples = other.n, list(other.samples)
+            return self
+
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.n / n
+        self.m2 = self.m2 + other.m2 + delta**2 * self.n * other.n / n
+
+        if len(self.samples) + len(other.samples) <= self.max_samples:
+            self.samples = self.samples + other.samples
+        else:
+            # keep each side in proportion to the realizations it represents
+            k_self = int(round(self.max_samples * self.n / n))
+            k_self = min(k_self, len(self.samples))
+            k_other = min(self.max_samples - k_self, len(other.samples))
+            pick_self = self.rng.choice(len(self.samples), k_self, replace=False)
+            pick_other = self.rng.choice(len(other.samples), k_other, replace=False)
+            self.samples = [self.samples[i] for i in pick_self] + [other.samples[i] for i in pick_other]
+        self.n = n
+        return self
+
+    def ci_results(self, confidence_level=0.95):
+        """Same dictionary as calculate_confidence_intervals"""
+        if self.n == 0:
+            return None
+
+        alpha = 1 - confidence_level
+        std = np.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else np.full_like(self.mean, np.nan)
+        from scipy import stats
+        t_value = stats.t.ppf(1 - alpha/2, df=self.n-1)
+        margin_of_error = t_value * std / np.sqrt(self.n)
+        samples = np.array(self.samples)
+        percentile_lower = np.percentile(samples, (alpha/2) * 100, axis=0)
+        percentile_upper = np.percentile(samples, (1 - alpha/2) * 100, axis=0)
+
+        ci_results = {}
+        for k, col in enumerate(self.columns):
+            ci_results[col] = {
+                'mean': self.mean[k],
+                'std': std[k],
+                'lower_ci': self.mean[k] - margin_of_error[k],
+                'upper_ci': self.mean[k] + margin_of_error[k],
+                'percentile_lower': percentile_lower[k],
+                'percentile_upper': percentile_upper[k],
+                'n_simulations': self.n
+            }
+        return ci_results
+
+
+def run_monte_carlo_chunk(input_df, params, sds, seed, start, count, hbp=0, bnpp_method=1, dt=1.0,
+                          max_samples=10000):
+    """Run realizations start .. start+count-1 into an MCAccumulator
+
+    The draws of a realization depend only on (seed, realization), so splitting a run into
+    chunks gives the same realizations as running it in one piece.
+    Returns (accumulator, error_log).
+    """
+    accumulator = MCAccumulator(max_samples, seed=[seed, start])
+    error_log = []
+    for i in range(start, start + count):
+        try:
+            result = run_model(perturb_rows(input_df, sds, seed, i, dt=dt), params, hbp, bnpp_method, dt)
+            if result.isnull().values.any():
+                error_log.append(f"Simulation {i+1} contains NaN values")
+            else:
+                accumulator.add(result)
+        except Exception as e:
+            error_log.append(f"Simulation {i+1} failed: {str(e)}")
+    return accumulator, error_log
+
+
+def create_final_results_with_ci(base_results, ci_results, confidence_level=0.95):
+    """Create final results DataFrame with confidence intervals"""
+
+    final_results = base_results.copy()
+
+
+    is_initial = (base_results['t'] == base_results['t'].min())
+
+    # t0 flux need to be 0
+    flux_vars = FLUX_COLUMNS
+
+    # t0 flux must be 0
+    for var in flux_vars:
+        if var in final_results.columns:
+            final_results.loc[is_initial, var] = 0.0
+
+    # t0 CI also must be 0
+    suffixes = [
+        '_MC_mean', '_MC_std', '_t_lower_95CI',
+        '_t_upper_95CI', '_percentile_lower_95CI',
+        '_percentile_upper_95CI'
+    ]
+
+    for var in flux_vars:
+        for suffix in suffixes:
+            col_name = f"{var}{suffix}"
+            if col_name in final_results.columns:
+                final_results.loc[is_initial, col_name] = 0.0
+
+    # add CI (collected first and joined at once, adding columns one by one fragments the frame)
+    if ci_results:
+        ci_columns = {}
+        for col in ci_results.keys():
+            if col in final_results.columns:
+                ci_columns[f'{col}_MC_mean'] = ci_results[col]['mean']
+                ci_columns[f'{col}_MC_std'] = ci_results[col]['std']
+                ci_columns[f'{col}_t_lower_{int(confidence_level*100)}CI'] = ci_results[col]['lower_ci']
+                ci_columns[f'{col}_t_upper_{int(confidence_level*100)}CI'] = ci_results[col]['upper_ci']
+                ci_columns[f'{col}_percentile_lower_{int(confidence_level*100)}CI'] = ci_results[col]['percentile_lower']
+                ci_columns[f'{col}_percentile_upper_{int(confidence_level*100)}CI'] = ci_results[col]['percentile_upper']
+        final_results = pd.concat([final_results, pd.DataFrame(ci_columns, index=final_results.index)], axis=1)
+    for col in final_results.columns:
+        for flux_var in flux_vars:
+            if col.startswith(flux_var) and col.endswith(tuple(suffixes)):
+                final_results.loc[is_initial, col] = 0.0
+    return final_results
+
+
+def analysis_config(**overrides):
+    """Complete run configuration of an analysis (defaults of the GUI plus overrides)"""
+    config = {
+        'params': [DEFAULT_PARAMS[name] for name in PARAM_NAMES],
+        'bounds': [list(DEFAULT_BOUNDS[name]) for name in PARAM_NAMES],
+        'method': 'Nelder-Mead',
+        'hbp': 0,
+        'bnpp_method': 1,
+        'time_step': 'Annual',
+        'run_mc': True,
+        'n_simulations': 1000,
+        'confidence_level': 0.95,
+        'sds': dict(DEFAULT_SDS),
+        'seed': None,
+        'surrogate': False,
+        'output_variables': None,
+    }
+    config.update(overrides)
+    return config
+
+
+def run_analysis(input_df, config, progress=None, profiler=None, state_cache=None, result_cache=None):
+    """Optimisation, optionally followed by Monte Carlo simulation and confidence intervals
+
+    config       : see analysis_config; with 'surrogate' the calibration starts from the best
+                   parameter set proposed by a polynomial chaos emulator (pemcafe_surrogate) and
+                   is finished by a least-squares fit of the residuals ('method' is the fallback);
+                   'output_variables' (list of columns) runs the Monte Carlo with
+                   run_monte_carlo_arrays and keeps only those columns in the results
+    progress     : callback receiving status messages
+    profiler     : pemcafe_profiling.RunProfiler timing the stages
+    state_cache  : StateCache to resume the final run and MC from appended rows
+    result_cache : ResultCache; an identical earlier run (same input data and complete
+                   configuration) is returned without recomputation. Monte Carlo runs
+                   are only cached when a seed is set, since they are not reproducible otherwise.
+
+    Returns a dict with 'optimisation' (OptimizeResult), 'params', 'base_results',
+    'results' (with CI columns if MC was run), 'ci_results', 'error_log' and 'mc_values'
+    (float32 realizations of the output variables, None unless output_variables is set).
+    """
+    from scipy.optimize import OptimizeResult
+
+    config = analysis_config(**config)
+    dt = TIME_STEPS[config['time_step']]
+    hbp, bnpp_method = config['hbp'], config['bnpp_method']
+    if config['run_mc'] and config['output_variables']:
+        # fail before the optimisation, not after it
+        check_output_variables(config['output_variables'], bnpp_method)
+
+    def report(message):
+        if progress is not None:
+            progress(message)
+
+    def stage(name):
+        return profiler.stage(name) if profiler is not None else contextlib.nullcontext()
+
+    cacheable = result_cache is not None and (not config['run_mc'] or config['seed'] is not None)
+    if cacheable:
+        key = pemcafe_cache.analysis_key(input_df, config)
+        cached = result_cache.get(key)
+        if profiler is not None:
+            profiler.count('cache_hits' if cached is not None else 'cache_misses')
+        if cached is not None:
+            report("Loaded results of an identical earlier run from the cache")
+            return cached
+
+    def objective(params):
+        if profiler is not None:
+            profiler.count('model_evaluations')
+        return objective_function(params, input_df, hbp, bnpp_method, dt)
+
+    report("Running optimisation...")
+    with stage('optimisation'):
+        if config['surrogate']:
+            import pemcafe_surrogate
+            result = pemcafe_surrogate.calibrate_with_surrogate(
+                input_df, config['bounds'], hbp, bnpp_method, dt, fallback_method=config['method'],
+                initial_params=config['params'], objective=objective, profiler=profiler, progress=report)
+        else:
+            result = optimise_parameters(input_df, config['params'], config['bounds'], config['method'],
+                                         objective=objective)
+    optimisation = OptimizeResult(x=np.asarray(result.x), fun=float(result.fun), success=bool(result.success),
+                                  nit=getattr(result, 'nit', None), nfev=getattr(result, 'nfev', None),
+                                  message=str(getattr(result, 'message', '')),
+                                  surrogate_validation=result.get('validation'))
+    params = optimisation.x
+
+    variables = config['output_variables']
+    ci_results = None
+    mc_values = None
+    error_log = []
+    if config['run_mc']:
+        report("Running Monte Carlo simulation...")
+
+        def mc_progress(i, n):
+            report(f"Monte Carlo simulation: {i+1}/{n}")
+
+        with stage('monte_carlo'):
+            if variables:
+                mc_values, error_log = run_monte_carlo_arrays(
+                    input_df, params, config['sds'], config['n_simulations'], variables, hbp, bnpp_method, dt,
+                    seed=config['seed'], progress=mc_progress, profiler=profiler)
+            else:
+                all_mc_results, error_log = run_monte_carlo(
+                    input_df, params, config['sds'], config['n_simulations'], hbp, bnpp_method, dt,
+                    seed=config['seed'], cache=state_cache if config['seed'] is not None else None,
+                    progress=mc_progress, profiler=profiler)
+
+        report("Calculating confidence intervals...")
+        with stage('confidence_intervals'):
+            if variables:
+                ci_results = confidence_intervals_from_array(mc_values, variables, config['confidence_level'])
+            else:
+                ci_results = calculate_confidence_intervals(all_mc_results, config['confidence_level'])
+
+    with stage('final_run'):
+        if state_cache is not None:
+            base_results = run_model_incremental(input_df, params, hbp, bnpp_method, dt,
+                                                 state_cache, profiler)
+        else:
+            if profiler is not None:
+                profiler.count('model_evaluations')
+            base_results = run_model(input_df, params, hbp, bnpp_method, dt)
+        if variables:
+            keep = ['t'] + [col for col in variables if col != 't']
+            base_results = base_results[[col for col in keep if col in base_results.columns]]
+
+        if config['run_mc']:
+            results = create_final_results_with_ci(base_results, ci_results, config['confidence_level'])
+        else:
+            results = base_results
+
+    output = {
+        'optimisation': optimisation,
+        'params': params,
+        'base_results': base_results,
+        'results': results,
+        'ci_results': ci_results,
+        'error_log': error_log,
+        'mc_values': mc_values,
+    }
+    if cacheable:
+        result_cache.put(key, output)
+    return output
+
+
+def run_model_streaming(input_path, params, hbp=0, bnpp_method=1, dt=1.0,
+                        chunksize=10000, output_path=None, progress=None):
+    """Run a long (e.g. daily) series chunk by chunk without loading the whole file
+
+    The CSV is read chunksize rows at a time and the recursive state is carried from one
+    chunk to the next, so memory depends on chunksize, not on the length of the series.
+    If output_path is given the results are appended to that CSV chunk by chunk and only
+    the final state is kept; otherwise the results are returned as one DataFrame.
+
+    Returns (results or None, final state, number of rows processed).
+    """
+    state = None
+    n_rows = 0
+    kept = []
+
+    for chunk in pd.read_csv(input_path, chunksize=chunksize, encoding='utf-8-sig'):
+        if state is None:
+            state = initial_state(chunk.iloc[0])
+
+        drivers = {col: chunk[col].to_numpy(dtype=float) for col in DRIVER_COLUMNS}
+        rows = []
+        for i in range(len(chunk)):
+            values = step_batch(state, {col: drivers[col][i] for col in DRIVER_COLUMNS},
+                                params, hbp, bnpp_method, dt)
+            state = {col: values[col] for col in STATE_COLUMNS}
+            rows.append({name: float(value) for name, value in values.items()})
+
+        out = pd.DataFrame(rows)
+        if 't' in chunk.columns:
+            out.insert(0, 't', chunk['t'].to_numpy())
+
+        if output_path is not None:
+            out.to_csv(output_path, mode='w' if n_rows == 0 else 'a', header=(n_rows == 0), index=False)
+        else:
+            kept.append(out)
+
+        n_rows += len(chunk)
+        if progress is not None:
+            progress(n_rows)
+
+    if state is None:
+        raise ValueError("No input data loaded")
+
+    final = {col: float(state[col]) for col in STATE_COLUMNS}
+    results = pd.concat(kept, ignore_index=True) if kept else None
+    return results, final, n_rows
+
+
+def interpolate_inventory(annual_df, steps_per_year, temperature=None):
+    """Expand an annual inventory table to a sub-annual series
+
+    Biomass pools and Undergrowth are interpolated linearly between the annual
+    inventories; t becomes fractional years. temperature, if given, is a sequence
+    with one value per new time step (e.g. daily means from the weather record),
+    otherwise the annual AvgTemp is repeated. The initial pools of the first row are kept.
+    """
+    annual_df = annual_df.reset_index(drop=True)
+    n_steps = (len(annual_df) - 1) * steps_per_year + 1
+    t_new = np.arange(n_steps) / steps_per_year
+    t_old = np.arange(len(annual_df))
+
+    out = pd.DataFrame({'t': annual_df['t'].iloc[0] + t_new})
+    for col in ['Foliages', 'Branches', 'Culms', 'Undergrowth']:
+        out[col] = np.interp(t_new, t_old, annual_df[col].to_numpy(dtype=float))
+    if temperature is not None:
+        out['AvgTemp'] = np.asarray(temperature, dtype=float)[:n_steps]
+    else:
+        out['AvgTemp'] = annual_df['AvgTemp'].to_numpy(dtype=float)[np.floor(t_new).astype(int)]
+
+    for col in ['Stumps', 'Rhizomes', 'Roots', 'Litter_layer', 'SC', 'TEC']:
+        if col in annual_df.columns:
+            out[col] = np.nan
+            out.loc[0, col] = annual_df[col].iloc[0]
+    return out
+
+
+def initial_state(row):
+    """Build the step_batch state for the first time step from an input row (t=0)
+
+    Mirrors calculate_values with prev_row=None: the pools start at the observed
+    values and TEC starts at 0.
+    """
+    state = {}
+    for col in STATE_COLUMNS:
+        if col == 'TEC':
+            state[col] = 0.0
+        else:
+            state[col] = row[col] if col in row and not pd.isna(row[col]) else 0.01
+    return state
+
+
+def final_state(results):
+    """Extract the state carried to the next time step from the last row of run_model output"""
+    last = results.iloc[-1]
+    return {col: float(last[col]) for col in STATE_COLUMNS}
+
+
+def step_batch(state, drivers, params, hbp=0, bnpp_method=1, dt=1.0, outputs=None):
+    """Advance many scenarios by one time step (vectorised calculate_values)
+
+    state   : dict of STATE_COLUMNS -> array (n,) or scalar, the previous time step
+    drivers : dict of DRIVER_COLUMNS -> array (n,) or scalar, this time step
+    params  : sequence of the 8 parameters, each scalar or array (n,)
+    hbp     : 0/1 scalar or array (n,) so harvest scenarios can be mixed in one batch
+    dt      : length of the time step in years (see calculate_values)
+    outputs : output columns needed besides the state; columns that neither these nor the
+              next state depend on (respiration split, ratios, ...) are not computed.
+              None computes everything.
+
+    Returns a dict with every output column of calculate_values as arrays (only the
+    state and the needed columns if outputs is given).
+    Unlike calculate_values, BNPP method 0 uses the Soil_AR of the current step
+    (the row-by-row version reads it from the input row before it is computed).
+    """
+    kLitter, LTurnoverR, BTurnoverR, CTurnoverR, StTurnoverR, RhTurnoverR, RoTurnoverR, Rratio_Litter_layer = params
+
+    def needed(*columns):
+        return outputs is None or any(col in outputs for col in columns)
+
+    r = {}
+    temp = np.asarray(drivers['AvgTemp'], dtype=float)
+    r['AvgTemp'] = temp
+    r['Foliages'] = np.asarray(drivers['Foliages'], dtype=float)
+    r['Branches'] = np.asarray(drivers['Branches'], dtype=float)
+    r['Culms'] = np.asarray(drivers['Culms'], dtype=float)
+    r['Undergrowth'] = np.asarray(drivers['Undergrowth'], dtype=float)
+
+    # Net production calculations
+    r['LNP'] = r['Foliages'] - state['Foliages']
+    r['BNP'] = r['Branches'] - state['Branches']
+    r['CNP'] = r['Culms'] - state['Culms']
+    r['AGC'] = r['Foliages'] + r['Branches'] + r['Culms']
+
+    r['StNP'] = 0.1955 * r['CNP']
+    r['RhNP'] = 1.1162 * np.abs(r['LNP']/dt)**0.7279 * dt
+    r['RoNP'] = 0.9847 * r['RhNP']
+
+    r['Stumps'] = state['Stumps'] + r['StNP']
+    r['Rhizomes'] = state['Rhizomes'] + r['RhNP']
+    r['Roots'] = state['Roots'] + r['RoNP']
+
+    r['BGC'] = r['Stumps'] + r['Rhizomes'] + r['Roots']
+    if needed('Root_Shoot_Ratio'):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r['Root_Shoot_Ratio'] = np.where(np.abs(r['AGC']) > 1e-10, r['BGC'] / r['AGC'], 0.0)
+    r['TC'] = r['AGC'] + r['BGC']
+
+    # Death calculations
+    r['LD'] = state['Foliages'] * LTurnoverR * dt
+    r['BD'] = state['Branches'] * BTurnoverR * dt
+    r['CD'] = state['Culms'] * CTurnoverR * dt
+    r['Litterfall'] = np.where(np.asarray(hbp) == 1, r['LD'] + r['BD'], r['LD'] + r['BD'] + r['CD'])
+    r['ANPP'] = r['LNP'] + r['BNP'] + r['CNP'] + r['Litterfall']
+
+    r['StD'] = state['Stumps'] * StTurnoverR * dt
+    r['RhD'] = state['Rhizomes'] * RhTurnoverR * dt
+    r['RoD'] = state['Roots'] * RoTurnoverR * dt
+    r['Dbelow'] = r['StD'] + r['RhD'] + r['RoD']
+
+    r['Soil_AR'] = 0.000006 * r['BGC']**3.3249 * dt
+    if bnpp_method == 1:
+        r['BNPP'] = r['StNP'] + r['RhNP'] + r['RoNP'] + r['Dbelow']
+    else:
+        r['BNPP'] = r['StNP'] + r['RhNP'] + r['RoNP'] + r['Soil_AR']
+    r['TNPP'] = r['ANPP'] + r['BNPP']
+
+    # Soil HR calculation (annual relation, applied to the annualised ANPP)
+    hr_anpp = np.clip(r['ANPP'] / dt, 4.17, 11.8)
+    r['Soil_HR'] = np.where(r['ANPP'] != 0, 0.0071 * hr_anpp**3.0772 * dt, 0.0)
+
+    # Autotrophic respiration calculations
+    # respiration rate per unit biomass, converted to Mg C per time step
+    soil_ar_split = ('Roots_AR_ratio', 'Rhizomes_AR_ratio', 'Stumps_AR_ratio', 'Roots_AR', 'Rhizomes_AR', 'Stumps_AR')
+    if needed('Foliages_AR', 'Branches_AR', 'Culms_AR', 'Aboveground_AR', 'AR', 'GPP', *soil_ar_split):
+        rate = 1.445 * 10**(-1) * np.exp(7.918*10**(-2)*temp) * 365*24*dt / 1000 * 12/44.01
+    if needed('Foliages_AR', 'Branches_AR', 'Culms_AR', 'Aboveground_AR', 'AR', 'GPP'):
+        r['Foliages_AR'] = 1.172/1.172 * rate * r['Foliages']/0.4544
+        r['Branches_AR'] = 0.215/1.172 * rate * r['Branches']/0.4815
+        r['Culms_AR'] = 0.085/1.172 * rate * r['Culms']/0.4628
+        r['Aboveground_AR'] = r['Foliages_AR'] + r['Branches_AR'] + r['Culms_AR']
+
+    # Soil AR ratios
+    if needed(*soil_ar_split):
+        roots_w = 0.088/1.172 * rate * r['Roots']/0.4487
+        rhizomes_w = 0.179/1.172 * rate * r['Rhizomes']/0.4354
+        stumps_w = 0.085/1.172 * rate * r['Stumps']/0.4628
+        denominator = roots_w + rhizomes_w + stumps_w
+        ok = np.abs(denominator) > 1e-10
+        safe_den = np.where(ok, denominator, 1.0)
+        r['Roots_AR_ratio'] = np.where(ok, roots_w / safe_den, 0.0)
+        r['Rhizomes_AR_ratio'] = np.where(ok, rhizomes_w / safe_den, 0.0)
+        r['Stumps_AR_ratio'] = np.where(ok, stumps_w / safe_den, 0.0)
+
+        r['Roots_AR'] = r['Soil_AR'] * r['Roots_AR_ratio']
+        r['Rhizomes_AR'] = r['Soil_AR'] * r['Rhizomes_AR_ratio']
+        r['Stumps_AR'] = r['Soil_AR'] * r['Stumps_AR_ratio']
+
+    if needed('AR', 'GPP'):
+        r['AR'] = r['Aboveground_AR'] + r['Soil_AR']
+    if needed('SR'):
+        r['SR'] = r['Soil_AR'] + r['Soil_HR']
+    tnpp_nonzero = r['TNPP'] != 0
+    r['NEP_with_Aboveground_Detritus_Litter_layer_HR'] = np.where(tnpp_nonzero, r['TNPP'] - r['Soil_HR'], 0.0)
+
+    # Litter layer calculations
+    r['Litter_layer'] = state['Litter_layer'] + kLitter * r['Litterfall'] - (1 - kLitter) * dt * state['Litter_layer']
+    r['DLitter_layer'] = r['Litter_layer'] * kLitter * dt
+    r['Litter_layer_HR'] = r['Litter_layer'] * Rratio_Litter_layer * dt
+
+    if needed('HR'):
+        r['HR'] = r['Soil_HR'] + r['Litter_layer_HR']
+    r['NEP'] = np.where(tnpp_nonzero, r['NEP_with_Aboveground_Detritus_Litter_layer_HR'] - r['Litter_layer_HR'], 0.0)
+
+    # Soil carbon
+    r['SC'] = state['SC'] + r['Dbelow'] - r['Soil_HR'] + r['DLitter_layer']
+    if needed('dSC'):
+        r['dSC'] = r['SC'] - state['SC']
+    r['TEC'] = r['TC'] + r['Litter_layer'] + r['SC'] + r['Undergrowth']
+    r['NEP_from_dTEC'] = r['TEC'] - state['TEC']
+
+    if needed('GPP'):
+        r['GPP'] = r['TNPP'] + r['AR']
+
+    return r
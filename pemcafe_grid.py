@@ -0,0 +1,235 @@
+# PEMCAFE gridded (raster) mode
+# runs the model at every pixel of time x rows x cols stacks (e.g. wall-to-wall bamboo maps)
+# the grid is cut into tiles that are processed in parallel; within a tile all pixels are one
+# step_batch batch, advanced time step by time step, and every step is written straight into
+# memory-mapped .npy output stacks, so memory depends on the tile size, not on the map size
+#
+# input folder (.npy files, float, NaN = no bamboo / no data):
+#   Foliages, Branches, Culms, AvgTemp     (T, rows, cols)   required
+#   Undergrowth                            (T, rows, cols)   optional, default 0
+#   Stumps, Rhizomes, Roots, Litter_layer, SC                initial pools, (rows, cols) or the
+#                                                            first slice of (T, rows, cols); default 0.01
+#   kLitter, ..., Rratio_Litter_layer, HBP (rows, cols)      optional per-pixel parameter / harvest maps
+#
+#   python pemcafe_grid.py synthetic --input inputdataforPEMCAFE.csv --rows 2000 --cols 2000 --output-dir grid_in
+#   python pemcafe_grid.py run --input-dir grid_in --output-dir grid_out --workers 8 --tile-size 256
+
+import argparse
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pemcafe_engine
+
+GRID_DRIVERS = ['Foliages', 'Branches', 'Culms', 'AvgTemp']
+INITIAL_POOLS = ['Stumps', 'Rhizomes', 'Roots', 'Litter_layer', 'SC']
+DEFAULT_OUTPUTS = ['ANPP', 'BNPP', 'TNPP', 'NEP', 'GPP', 'AGC', 'BGC', 'Litter_layer', 'SC', 'TEC']
+DONE_FILE = 'tiles_done.txt'
+
+
+def _path(folder, name):
+    return os.path.join(folder, f"{name}.npy")
+
+
+def load_stack(folder, name):
+    """Memory-mapped array <folder>/<name>.npy, or None if there is no such file"""
+    path = _path(folder, name)
+    return np.load(path, mmap_mode='r') if os.path.exists(path) else None
+
+
+def grid_shape(input_dir):
+    """(time steps, rows, cols) of the input stacks"""
+    shape = None
+    for name in GRID_DRIVERS:
+        stack = load_stack(input_dir, name)
+        if stack is None:
+            raise FileNotFoundError(f"Missing input stack {_path(input_dir, name)}")
+        if stack.ndim != 3 or (shape is not None and stack.shape != shape):
+            raise ValueError(f"{name}.npy has shape {stack.shape}, expected (time, rows, cols) like the others")
+        shape = stack.shape
+    return shape
+
+
+def make_tiles(rows, cols, tile_size):
+    """(row start, row end, col start, col end) of every tile"""
+    return [(r, min(r + tile_size, rows), c, min(c + tile_size, cols))
+            for r in range(0, rows, tile_size) for c in range(0, cols, tile_size)]
+
+
+def run_tile(input_dir, output_dir, tile, params, hbp=0, bnpp_method=1, dt=1.0, outputs=DEFAULT_OUTPUTS):
+    """Run the model for all pixels of one tile and write the tile into the output stacks
+
+    Pixels with missing drivers or pools at the first time step are skipped (left NaN).
+    Returns (tile, number of pixels computed).
+    """
+    r0, r1, c0, c1 = tile
+    n_steps = grid_shape(input_dir)[0]
+    drivers = {name: load_stack(input_dir, name) for name in GRID_DRIVERS + ['Undergrowth']}
+    store = {name: np.load(_path(output_dir, name), mmap_mode='r+') for name in outputs}
+
+    def tile_values(array, t=None):
+        if array.ndim == 3:
+            array = array[0 if t is None else t]
+        return np.asarray(array[r0:r1, c0:c1], dtype=float).ravel()
+
+    # initial pools (t=0), as pemcafe_engine.initial_state
+    state = {}
+    for col in INITIAL_POOLS:
+        pool = load_stack(input_dir, col)
+        state[col] = tile_values(pool) if pool is not None else np.full((r1 - r0) * (c1 - c0), 0.01)
+    for col in ['Foliages', 'Branches', 'Culms']:
+        state[col] = tile_values(drivers[col], 0)
+    state['TEC'] = np.zeros_like(state['SC'])
+
+    valid = np.all([np.isfinite(state[col]) for col in pemcafe_engine.STATE_COLUMNS], axis=0)
+    valid &= np.isfinite(tile_values(drivers['AvgTemp'], 0))
+    state = {col: values[valid] for col, values in state.items()}
+    n_valid = int(valid.sum())
+
+    # per-pixel parameter and harvest maps override the scalar values
+    pixel_params = []
+    for name, value in zip(pemcafe_engine.PARAM_NAMES, params):
+        param_map = load_stack(input_dir, name)
+        pixel_params.append(tile_values(param_map)[valid] if param_map is not None else value)
+    hbp_map = load_stack(input_dir, 'HBP')
+    if hbp_map is not None:
+        hbp = tile_values(hbp_map)[valid].astype(int)
+
+    out = np.full((r1 - r0) * (c1 - c0), np.nan, dtype=np.float32)
+    for t in range(n_steps):
+        if n_valid:
+            step_drivers = {name: tile_values(drivers[name], t)[valid] for name in GRID_DRIVERS}
+            step_drivers['Undergrowth'] = (tile_values(drivers['Undergrowth'], t)[valid]
+                                           if drivers['Undergrowth'] is not None else 0.0)
+            values = pemcafe_engine.step_batch(state, step_drivers, pixel_params, hbp, bnpp_method, dt, outputs)
+            state = {col: values[col] for col in pemcafe_engine.STATE_COLUMNS}
+        for name in outputs:
+            if n_valid:
+                # t=0, flux of C need to be 0 (as in the results tables of the GUI)
+                out[valid] = 0.0 if t == 0 and name in pemcafe_engine.FLUX_COLUMNS else values[name]
+            store[name][t, r0:r1, c0:c1] = out.reshape(r1 - r0, c1 - c0)
+
+    for array in store.values():
+        array.flush()
+    return tile, n_valid
+
+
+def run_grid(input_dir, output_dir, params, hbp=0, bnpp_method=1, dt=1.0, outputs=DEFAULT_OUTPUTS,
+             tile_size=256, workers=None, resume=False, progress=None):
+    """Run every tile of the grid in worker processes
+
+    Outputs are (T, rows, cols) float32 stacks <output_dir>/<name>.npy. Finished tiles are
+    listed in <output_dir>/tiles_done.txt; with resume=True those tiles are not run again,
+    so an interrupted national run continues where it stopped.
+    progress(done, total) is called as tiles finish.
+    Returns a dict of output name -> read-only memory-mapped stack.
+    """
+    n_steps, rows, cols = grid_shape(input_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    done_path = os.path.join(output_dir, DONE_FILE)
+
+    done = set()
+    if resume and os.path.exists(done_path) and all(os.path.exists(_path(output_dir, n)) for n in outputs):
+        with open(done_path) as f:
+            done = {tuple(int(v) for v in line.split()) for line in f if line.strip()}
+    else:
+        for name in outputs:
+            np.lib.format.open_memmap(_path(output_dir, name), mode='w+', dtype=np.float32,
+                                      shape=(n_steps, rows, cols)).flush()
+        open(done_path, 'w').close()
+
+    tiles = [tile for tile in make_tiles(rows, cols, tile_size) if tile not in done]
+    total = len(tiles) + len(done)
+    params = [float(p) for p in params]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool, open(done_path, 'a') as done_file:
+        futures = [pool.submit(run_tile, input_dir, output_dir, tile, params, hbp, bnpp_method, dt, list(outputs))
+                   for tile in tiles]
+        for future in as_completed(futures):
+            tile, _ = future.result()
+            done_file.write(" ".join(str(v) for v in tile) + "\n")
+            done_file.flush()
+            done.add(tile)
+            if progress is not None:
+                progress(len(done), total)
+
+    return {name: np.load(_path(output_dir, name), mmap_mode='r') for name in outputs}
+
+
+def synthetic_grid(input_df, output_dir, rows, cols, variability=0.1, nodata_fraction=0.2, seed=0):
+    """Write input stacks built from a site table (e.g. inputdataforPEMCAFE.csv) for testing
+
+    Every pixel follows the site's series scaled by a random factor (sd = variability);
+    nodata_fraction of the pixels are NaN (no bamboo).
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    scale = np.clip(rng.normal(1.0, variability, (rows, cols)), 0.1, None)
+    nodata = rng.random((rows, cols)) < nodata_fraction
+    n_steps = len(input_df)
+
+    for name in GRID_DRIVERS + INITIAL_POOLS:
+        series = input_df[name].to_numpy(dtype=float)
+        stack = np.lib.format.open_memmap(_path(output_dir, name), mode='w+', dtype=np.float32,
+                                          shape=(n_steps, rows, cols))
+        for t in range(n_steps):
+            if name == 'AvgTemp':
+                layer = series[t] + rng.normal(0, 0.5, (rows, cols))
+            else:
+                layer = series[t] * scale
+            layer[nodata] = np.nan
+            stack[t] = layer
+        stack.flush()
+    return (n_steps, rows, cols)
+
+
+def _print_progress(done, total):
+    print(f"\r{done}/{total} tiles", end='', flush=True)
+    if done == total:
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PEMCAFE gridded mode")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run = sub.add_parser('run', help="run the model at every pixel")
+    run.add_argument('--input-dir', required=True)
+    run.add_argument('--output-dir', required=True)
+    run.add_argument('--params', type=float, nargs=8, metavar='P',
+                     help="calibrated parameters in the order " + ", ".join(pemcafe_engine.PARAM_NAMES))
+    run.add_argument('--hbp', type=int, default=0)
+    run.add_argument('--bnpp-method', type=int, default=1)
+    run.add_argument('--time-step', default='Annual', choices=list(pemcafe_engine.TIME_STEPS))
+    run.add_argument('--outputs', nargs='+', default=DEFAULT_OUTPUTS)
+    run.add_argument('--tile-size', type=int, default=256)
+    run.add_argument('--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    run.add_argument('--resume', action='store_true', help="skip tiles finished by an earlier run")
+
+    synthetic = sub.add_parser('synthetic', help="write test input stacks from a site table")
+    synthetic.add_argument('--input', required=True)
+    synthetic.add_argument('--rows', type=int, default=1000)
+    synthetic.add_argument('--cols', type=int, default=1000)
+    synthetic.add_argument('--nodata-fraction', type=float, default=0.2)
+    synthetic.add_argument('--output-dir', required=True)
+    synthetic.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == 'synthetic':
+        import pandas as pd
+        df = pd.read_csv(args.input, encoding='utf-8-sig')
+        shape = synthetic_grid(df, args.output_dir, args.rows, args.cols,
+                               nodata_fraction=args.nodata_fraction, seed=args.seed)
+        print(f"Input stacks of shape {shape} written to {args.output_dir}")
+        return
+
+    params = args.params if args.params else [pemcafe_engine.DEFAULT_PARAMS[n] for n in pemcafe_engine.PARAM_NAMES]
+    store = run_grid(args.input_dir, args.output_dir, params, args.hbp, args.bnpp_method,
+                     pemcafe_engine.TIME_STEPS[args.time_step], args.outputs, args.tile_size,
+                     args.workers, args.resume, progress=_print_progress)
+    shape = next(iter(store.values())).shape
+    print(f"{len(store)} output stacks of shape {shape} written to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
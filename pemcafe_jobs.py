@@ -0,0 +1,168 @@
+# PEMCAFE job queue
+# analyses queued from the GUI run concurrently in a process pool; each job gets its own
+# copy of the input table and of the run configuration, so jobs never share state,
+# and reports its progress messages through a manager queue that the GUI polls
+# waiting jobs stay in our own queue and are handed to the pool only when a worker is free
+# (the pool would otherwise pre-dispatch them, and a pre-dispatched job cannot be cancelled)
+
+import collections
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pemcafe_engine
+import pemcafe_cache
+
+
+def run_job(job_id, input_df, config, progress_queue, use_state_cache=False, result_cache_mb=None):
+    """Worker entry point: run one analysis, sending (job_id, message) progress updates"""
+    def progress(message):
+        progress_queue.put((job_id, message))
+
+    progress("Started")
+    state_cache = pemcafe_cache.StateCache() if use_state_cache else None
+    result_cache = pemcafe_cache.ResultCache(max_mb=result_cache_mb) if result_cache_mb else None
+    return pemcafe_engine.run_analysis(input_df, config, progress=progress,
+                                       state_cache=state_cache, result_cache=result_cache)
+
+
+class JobQueue:
+    """Queued analyses and the process pool running them
+
+    The pool and the progress queue are created with the first job; workers are started
+    with the 'spawn' method so they do not inherit the GUI process. At most `workers`
+    jobs are submitted to the pool at a time; submit() and poll() dispatch the next ones.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.executor = None
+        self.manager = None
+        self.progress_queue = None
+        self.jobs = {}
+        self.waiting = collections.deque()
+        self._ids = itertools.count(1)
+
+    def _start(self):
+        if self.executor is None:
+            context = multiprocessing.get_context('spawn')
+            self.manager = context.Manager()
+            self.progress_queue = self.manager.Queue()
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+
+    def submit(self, name, input_df, config, use_state_cache=False, result_cache_mb=None, info=None):
+        """Queue an analysis; returns the job id"""
+        self._start()
+        job_id = next(self._ids)
+        config = pemcafe_engine.analysis_config(**config)
+        input_df = input_df.copy()
+        self.jobs[job_id] = {
+            'name': name, 'input_df': input_df, 'config': config, 'info': dict(info or {}),
+            'use_state_cache': use_state_cache, 'result_cache_mb': result_cache_mb,
+            'status': 'queued', 'message': '', 'future': None,
+            'submitted': time.time(), 'started': None, 'finished': None,
+            'output': None, 'error': None,
+        }
+        self.waiting.append(job_id)
+        self._dispatch()
+        return job_id
+
+    def _dispatch(self):
+        """Hand waiting jobs to the pool while fewer than `workers` are in it"""
+        in_pool = sum(1 for job in self.jobs.values()
+                      if job['future'] is not None and job['status'] in ('queued', 'running'))
+        while self.waiting and in_pool < self.workers:
+            job_id = self.waiting.popleft()
+            job = self.jobs[job_id]
+            job['future'] = self.executor.submit(run_job, job_id, job['input_df'], job['config'],
+                                                 self.progress_queue, job['use_state_cache'],
+                                                 job['result_cache_mb'])
+            in_pool += 1
+
+    def poll(self):
+        """Collect progress messages and finished jobs; returns the ids of jobs that changed"""
+        changed = set()
+        if self.progress_queue is None:
+            return changed
+
+        while True:
+            try:
+                job_id, message = self.progress_queue.get_nowait()
+            except Exception:
+                break
+            job = self.jobs.get(job_id)
+            if job is None or job['status'] in ('done', 'failed', 'cancelled'):
+                continue
+            if job['status'] == 'queued':
+                job['status'] = 'running'
+                job['started'] = time.time()
+            job['message'] = message
+            changed.add(job_id)
+
+        for job_id, job in self.jobs.items():
+            future = job['future']
+            if future is not None and job['status'] in ('queued', 'running') and future.done():
+                job['finished'] = time.time()
+                if future.cancelled():
+                    job['status'] = 'cancelled'
+                elif future.exception() is not None:
+                    job['status'] = 'failed'
+                    job['error'] = f"{type(future.exception()).__name__}: {future.exception()}"
+                    job['message'] = job['error']
+                else:
+                    job['status'] = 'done'
+                    job['output'] = future.result()
+                    job['message'] = "Finished"
+                changed.add(job_id)
+        self._dispatch()
+        return changed
+
+    def active(self):
+        """Number of queued or running jobs"""
+        return sum(1 for job in self.jobs.values() if job['status'] in ('queued', 'running'))
+
+    def elapsed(self, job_id):
+        """Run time of a job in seconds (so far, if still running)"""
+        job = self.jobs[job_id]
+        if job['started'] is None:
+            return 0.0
+        return (job['finished'] or time.time()) - job['started']
+
+    def cancel(self, job_id):
+        """Cancel a job that has not started yet; returns True if it was cancelled"""
+        job = self.jobs.get(job_id)
+        if job is None or job['status'] != 'queued':
+            return False
+        if job_id in self.waiting:
+            self.waiting.remove(job_id)
+        elif not job['future'].cancel():
+            return False
+        job['status'] = 'cancelled'
+        job['finished'] = time.time()
+        return True
+
+    def remove(self, job_id):
+        """Forget a finished, failed or cancelled job"""
+        job = self.jobs.get(job_id)
+        if job is not None and job['status'] not in ('queued', 'running'):
+            del self.jobs[job_id]
+            return True
+        return False
+
+    def export(self, job_id, path):
+        """Write a finished job's results table (and its Monte Carlo error log, if any)"""
+        output = self.jobs[job_id]['output']
+        output['results'].to_csv(path, index=False)
+        if output['error_log']:
+            with open(os.path.splitext(path)[0] + "_monte_carlo_errors.log", "w") as f:
+                f.write("\n".join(output['error_log']))
+
+    def close(self):
+        """Stop the workers (running jobs are abandoned)"""
+        self.waiting.clear()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.manager.shutdown()
+            self.executor = None
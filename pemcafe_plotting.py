@@ -0,0 +1,207 @@
+# PEMCAFE plots
+# time series of pools and fluxes with the Monte Carlo CI bands of create_final_results_with_ci,
+# and the spread of the raw realizations (mc_values of a run with output variables)
+# many realizations are never drawn line by line: they are binned into a 2-D histogram
+# (time step x value) or decimated to a few hundred lines, so 100k realizations plot interactively
+# matplotlib is optional; it is only imported by the functions that draw
+#
+#   python pemcafe_plotting.py --results results.csv --variables NEP TNPP SC --output ci.png
+#   python pemcafe_plotting.py --input inputdataforPEMCAFE.csv --variables NEP TEC --n-simulations 100000 --mode density --output nep.png
+
+import argparse
+import importlib.util
+import numpy as np
+
+from pemcafe_engine import FLUX_COLUMNS
+
+MODES = ('band', 'density', 'spaghetti')
+
+
+def matplotlib_available():
+    """True if matplotlib can be imported"""
+    return importlib.util.find_spec('matplotlib') is not None
+
+
+def ci_band(results, variable, kind='t'):
+    """(t, central, lower, upper) of a variable from a results table
+
+    central is the MC mean if the table has CI columns (create_final_results_with_ci), else the
+    model run; lower/upper are the t or percentile CI bounds, None without MC columns.
+    """
+    t = results['t'].to_numpy(dtype=float)
+    central = results.get(f'{variable}_MC_mean', results[variable]).to_numpy(dtype=float)
+    lower = [col for col in results.columns if col.startswith(f'{variable}_{kind}_lower_') and col.endswith('CI')]
+    upper = [col for col in results.columns if col.startswith(f'{variable}_{kind}_upper_') and col.endswith('CI')]
+    if not lower or not upper:
+        return t, central, None, None
+    return t, central, results[lower[0]].to_numpy(dtype=float), results[upper[0]].to_numpy(dtype=float)
+
+
+def realization_density(values, bins=100, value_range=None):
+    """2-D histogram of realizations
+
+    values : (n realizations, T) array
+    Returns (counts[T, bins], value edges). The value range defaults to the 0.1-99.9 percentiles,
+    so a few extreme realizations do not squash the plot.
+    """
+    values = np.asarray(values, dtype=float)
+    n_steps = values.shape[1]
+    if value_range is None:
+        finite = values[np.isfinite(values)]
+        value_range = np.percentile(finite, [0.1, 99.9]) if finite.size else (0.0, 1.0)
+    lo, hi = float(value_range[0]), float(value_range[1])
+    if hi <= lo:
+        lo, hi = lo - 0.5, hi + 0.5
+    edges = np.linspace(lo, hi, bins + 1)
+
+    # one bincount over (time step, bin) instead of a histogram per time step
+    index = np.floor((values - lo) / (hi - lo) * bins)
+    inside = np.isfinite(index) & (index >= 0) & (index < bins)
+    steps = np.broadcast_to(np.arange(n_steps), values.shape)
+    flat = steps[inside] * bins + index[inside].astype(np.int64)
+    counts = np.bincount(flat, minlength=n_steps * bins).reshape(n_steps, bins)
+    return counts, edges
+
+
+def decimate(values, max_lines=200, seed=0):
+    """Random subset of at most max_lines realizations (rows) of values"""
+    values = np.asarray(values)
+    if len(values) <= max_lines:
+        return values
+    rows = np.random.default_rng(seed).choice(len(values), max_lines, replace=False)
+    return values[np.sort(rows)]
+
+
+def _time_edges(t):
+    """Cell edges around the time points (they may be unevenly spaced)"""
+    t = np.asarray(t, dtype=float)
+    if len(t) == 1:
+        return np.array([t[0] - 0.5, t[0] + 0.5])
+    mid = (t[1:] + t[:-1]) / 2
+    return np.concatenate([[2 * t[0] - mid[0]], mid, [2 * t[-1] - mid[-1]]])
+
+
+def plot_band(ax, results, variable, kind='t'):
+    """Time series of a variable with its CI band (if the results have MC columns)"""
+    t, central, lower, upper = ci_band(results, variable, kind)
+    if lower is not None:
+        label = 't CI' if kind == 't' else 'percentile CI'
+        ax.fill_between(t, lower, upper, alpha=0.3, label=label)
+        ax.plot(t, central, marker='o', label='MC mean')
+        ax.legend(loc='best', fontsize='small')
+    else:
+        ax.plot(t, central, marker='o')
+    ax.set_title(variable)
+    ax.set_xlabel('t')
+
+
+def plot_density(ax, t, values, variable, bins=100):
+    """Density of all realizations (counts per time step and value bin, log colour scale)"""
+    from matplotlib.colors import LogNorm
+
+    counts, edges = realization_density(values, bins)
+    counts = np.ma.masked_equal(counts.T, 0)
+    if counts.count():
+        mesh = ax.pcolormesh(_time_edges(t), edges, counts, norm=LogNorm(vmin=1, vmax=counts.max()),
+                             cmap='viridis', shading='flat')
+        ax.figure.colorbar(mesh, ax=ax, label='realizations')
+    ax.plot(t, np.nanmean(values, axis=0), color='white', linewidth=1.5, label='mean')
+    ax.set_title(f"{variable} ({len(values)} realizations)")
+    ax.set_xlabel('t')
+
+
+def plot_spaghetti(ax, t, values, variable, max_lines=200, seed=0):
+    """A decimated sample of realizations drawn as one LineCollection, with the mean"""
+    from matplotlib.collections import LineCollection
+
+    sample = decimate(values, max_lines, seed)
+    segments = np.stack([np.broadcast_to(np.asarray(t, dtype=float), sample.shape), sample], axis=-1)
+    ax.add_collection(LineCollection(segments, linewidths=0.5, alpha=max(0.02, min(0.5, 20 / len(sample)))))
+    ax.autoscale_view()
+    ax.plot(t, np.nanmean(values, axis=0), color='black', linewidth=1.5, label='mean')
+    ax.set_title(f"{variable} ({len(sample)} of {len(values)} realizations)")
+    ax.set_xlabel('t')
+
+
+def plot_results(fig, results, variables, mode='band', mc_values=None, mc_variables=None,
+                 kind='t', bins=100, max_lines=200):
+    """Draw one panel per variable into a matplotlib Figure
+
+    mode 'band' uses the CI columns of results; 'density' and 'spaghetti' need the raw
+    realizations mc_values[n, T, len(mc_variables)] (run_analysis with output_variables).
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown plot mode {mode!r}, expected one of {', '.join(MODES)}")
+    if mode != 'band':
+        if mc_values is None:
+            raise ValueError("Density and spaghetti plots need Monte Carlo realizations; "
+                             "run the analysis with output variables")
+        missing = [var for var in variables if var not in mc_variables]
+        if missing:
+            raise ValueError(f"No realizations kept for: {', '.join(missing)}")
+
+    fig.clear()
+    n_cols = min(len(variables), 2)
+    n_rows = -(-len(variables) // n_cols)
+    t = results['t'].to_numpy(dtype=float)
+    for i, variable in enumerate(variables):
+        ax = fig.add_subplot(n_rows, n_cols, i + 1)
+        if mode == 'band':
+            plot_band(ax, results, variable, kind)
+        else:
+            values = mc_values[:, :, list(mc_variables).index(variable)]
+            if variable in FLUX_COLUMNS:
+                # as in the results table, fluxes are 0 at t0
+                values = values.copy()
+                values[:, 0] = 0.0
+            if mode == 'density':
+                plot_density(ax, t, values, variable, bins)
+            else:
+                plot_spaghetti(ax, t, values, variable, max_lines)
+    fig.tight_layout()
+    return fig
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PEMCAFE plots")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--results', help="results CSV exported by the GUI or the engine")
+    source.add_argument('--input', help="input CSV: run the analysis (with MC) first")
+    parser.add_argument('--variables', nargs='+', default=['NEP', 'TNPP'])
+    parser.add_argument('--mode', default='band', choices=MODES)
+    parser.add_argument('--ci', default='t', choices=['t', 'percentile'])
+    parser.add_argument('--n-simulations', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bins', type=int, default=100)
+    parser.add_argument('--max-lines', type=int, default=200)
+    parser.add_argument('--output', required=True, help="image file (.png, .pdf, .svg)")
+    args = parser.parse_args()
+
+    if args.results and args.mode != 'band':
+        parser.error("density and spaghetti plots need the raw realizations: use --input instead of --results")
+    if not matplotlib_available():
+        parser.error("plotting needs matplotlib (pip install matplotlib)")
+    from matplotlib.figure import Figure
+    import pandas as pd
+
+    mc_values = None
+    if args.results:
+        results = pd.read_csv(args.results)
+    else:
+        import pemcafe_engine
+        df = pd.read_csv(args.input, encoding='utf-8-sig')
+        config = pemcafe_engine.analysis_config(n_simulations=args.n_simulations, seed=args.seed,
+                                                output_variables=args.variables)
+        output = pemcafe_engine.run_analysis(df, config, progress=print)
+        results, mc_values = output['results'], output['mc_values']
+
+    n_rows = -(-len(args.variables) // 2)
+    fig = Figure(figsize=(12, 4 * n_rows))
+    plot_results(fig, results, args.variables, args.mode, mc_values, args.variables,
+                 args.ci, args.bins, args.max_lines)
+    fig.savefig(args.output, dpi=120)
+    print(f"Plot written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# PEMCAFE run instrumentation
+# per-stage wall time, model evaluations, evaluations/sec, cache hits and memory high-water marks
+# a RunProfiler is passed through a run; stages are timed with `with profiler.stage(name):`
+# and the report is shown as text in the GUI and written as JSON
+
+import cProfile
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+STAGES = ('optimisation', 'monte_carlo', 'confidence_intervals', 'final_run', 'csv_export')
+
+
+def process_peak_mb():
+    """High-water mark of the process resident memory in MB (None if not available)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+class RunProfiler:
+    """Collects timings and counters of one run
+
+    trace_memory : also record the Python allocation peak of every stage (tracemalloc,
+                   slows the run down noticeably)
+    profile_stage: name of a stage to run under cProfile; the stats are dumped to
+                   profile_dir/pemcafe_<stage>.prof
+    """
+
+    def __init__(self, trace_memory=False, profile_stage=None, profile_dir='.'):
+        self.trace_memory = trace_memory
+        self.profile_stage = profile_stage
+        self.profile_dir = profile_dir
+        self.stages = []
+        self.counters = {}
+        self.profile_path = None
+        self.started = time.time()
+
+    def count(self, name, n=1):
+        """Add n to a counter (model_evaluations, cache_hits, cache_misses, ...)"""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def stage(self, name):
+        """Time a stage and record the counters and memory used inside it"""
+        counters_before = dict(self.counters)
+        profiler = cProfile.Profile() if name == self.profile_stage else None
+        started_tracing = False
+        if self.trace_memory:
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+                started_tracing = True
+
+        peak_before = process_peak_mb()
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield self
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            seconds = time.perf_counter() - start
+
+            record = {'stage': name, 'seconds': seconds}
+            for counter, value in self.counters.items():
+                delta = value - counters_before.get(counter, 0)
+                if delta:
+                    record[counter] = delta
+            evaluations = record.get('model_evaluations', 0)
+            record['evaluations_per_second'] = evaluations / seconds if evaluations and seconds > 0 else 0.0
+            if self.trace_memory:
+                record['python_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+                if started_tracing:
+                    tracemalloc.stop()
+            # the process high-water mark only grows: report it as such, and how much it rose
+            # during this stage (0 if an earlier stage already needed more memory)
+            peak_after = process_peak_mb()
+            record['process_peak_so_far_mb'] = peak_after
+            record['process_peak_increase_mb'] = (peak_after - peak_before
+                                                  if peak_after is not None else None)
+            self.stages.append(record)
+
+            if profiler is not None:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                self.profile_path = os.path.join(self.profile_dir, f"pemcafe_{name}.prof")
+                profiler.dump_stats(self.profile_path)
+
+    def report(self):
+        """Machine-readable run report"""
+        total = sum(s['seconds'] for s in self.stages)
+        evaluations = self.counters.get('model_evaluations', 0)
+        return {
+            'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+            'total_seconds': total,
+            'counters': dict(self.counters),
+            'evaluations_per_second': evaluations / total if evaluations and total > 0 else 0.0,
+            'process_peak_mb': process_peak_mb(),
+            'stages': list(self.stages),
+            'profile_file': self.profile_path,
+        }
+
+    def write_json(self, path, extra=None):
+        """Write the report (plus any extra run information) to a JSON file"""
+        report = self.report()
+        if extra:
+            report.update(extra)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        return path
+
+    def format_text(self):
+        """Plain-text report for the Results tab"""
+        report = self.report()
+        text = "RUN INSTRUMENTATION:\n"
+        text += "-" * 80 + "\n"
+        # per-stage peak with tracemalloc; otherwise only the rise of the process high-water mark
+        memory_column = 'Peak MB' if self.trace_memory else 'Peak +MB'
+        text += f"{'Stage':<22} {'Time (s)':>10} {'Evals':>8} {'Evals/s':>10} {'Cache hits':>11} {memory_column:>10}\n"
+        text += "-" * 80 + "\n"
+        for s in report['stages']:
+            peak = s.get('python_peak_mb') if self.trace_memory else s.get('process_peak_increase_mb')
+            peak_text = f"{peak:10.1f}" if peak is not None else f"{'N/A':>10}"
+            text += (f"{s['stage']:<22} {s['seconds']:10.3f} {s.get('model_evaluations', 0):8d} "
+                     f"{s['evaluations_per_second']:10.1f} {s.get('cache_hits', 0):11d} {peak_text}\n")
+        text += "-" * 80 + "\n"
+        text += f"Total: {report['total_seconds']:.3f} s, {report['counters'].get('model_evaluations', 0)} model evaluations"
+        text += f" ({report['evaluations_per_second']:.1f}/s)\n"
+        if not self.trace_memory:
+            text += "Peak +MB: rise of the process memory high-water mark during the stage (enable memory tracing for per-stage peaks)\n"
+        if report['process_peak_mb'] is not None:
+            text += f"Process memory high-water mark: {report['process_peak_mb']:.1f} MB\n"
+        if report['profile_file']:
+            text += f"cProfile dump: {report['profile_file']}\n"
+        return text
@@ -0,0 +1,207 @@
+# PEMCAFE long-horizon projection / scenario engine
+# runs calibrated parameters forward for many temperature x HBP scenarios at once
+# every scenario is one column of the batch, so a year of all scenarios is one step_batch call
+# results are written year by year to .npy files (memory mapped) so long runs never sit in RAM
+# limit: temperature only enters the aboveground autotrophic respiration (and so GPP = TNPP + AR);
+# production, heterotrophic respiration and the pools do not depend on it, so with the aboveground
+# pools held fixed, NEP and TEC are the same for every warming rate (only GPP / AR differ)
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+import pemcafe_engine
+
+# outputs written by default (one .npy file each, shape = years x scenarios)
+DEFAULT_OUTPUTS = ['ANPP', 'BNPP', 'TNPP', 'NEP', 'GPP', 'AR', 'HR', 'SR',
+                   'AGC', 'BGC', 'Litter_layer', 'SC', 'TEC']
+
+
+def read_weather_temperature(path, sheet='6NT'):
+    """Read the daily station record (e.g. 6NTweatherdata.xlsx) and return annual mean temperature
+
+    The sheet has the English header in the first row and the Chinese header in the
+    second row, so non-numeric rows are dropped. Returns a Series indexed by year.
+    """
+    weather = pd.read_excel(path, sheet_name=sheet)
+    year = pd.to_numeric(weather['ObsTime(year)'], errors='coerce')
+    temperature = pd.to_numeric(weather['Temperature'], errors='coerce')
+    daily = pd.DataFrame({'year': year, 'Temperature': temperature}).dropna()
+    annual = daily.groupby(daily['year'].astype(int))['Temperature'].mean()
+    annual.name = 'AvgTemp'
+    return annual
+
+
+def make_temperature_scenarios(baseline, n_years, warming_rates=(0.0,), n_replicates=1,
+                               interannual_sd=0.0, seed=None):
+    """Build annual temperature scenarios
+
+    baseline       : mean annual temperature at the start of the projection (°C)
+    warming_rates  : linear trends in °C per year, one scenario family per rate
+    n_replicates   : random replicates per rate (year-to-year noise with interannual_sd)
+
+    Returns (temperatures, labels): an array (n_scenarios, n_years) and a DataFrame
+    describing each scenario.
+    """
+    rng = np.random.default_rng(seed)
+    years = np.arange(1, n_years + 1)
+    temperatures = []
+    labels = []
+    for rate in warming_rates:
+        trend = baseline + rate * years
+        for rep in range(n_replicates):
+            noise = rng.normal(0, interannual_sd, n_years) if interannual_sd > 0 else 0.0
+            temperatures.append(trend + noise)
+            labels.append({'warming_rate': rate, 'replicate': rep})
+    return np.array(temperatures), pd.DataFrame(labels)
+
+
+def combine_scenarios(temperatures, labels, hbp_options=(0, 1)):
+    """Cross temperature scenarios with harvest (HBP) options
+
+    Returns (temperatures, hbp, labels) with one entry per temperature x HBP scenario.
+    """
+    temperatures = np.asarray(temperatures, dtype=float)
+    n = len(temperatures)
+    all_temps = np.concatenate([temperatures] * len(hbp_options))
+    hbp = np.repeat(np.asarray(hbp_options, dtype=int), n)
+    all_labels = pd.concat([labels.assign(HBP=h) for h in hbp_options], ignore_index=True)
+    all_labels.insert(0, 'scenario', np.arange(len(all_labels)))
+    return all_temps, hbp, all_labels
+
+
+def run_projection(initial_state, params, temperatures, hbp=0, bnpp_method=1,
+                   aboveground=None, undergrowth=0.0, outputs=DEFAULT_OUTPUTS,
+                   output_dir=None, flush_every=10, progress=None):
+    """Run all scenarios forward together
+
+    initial_state : dict of STATE_COLUMNS, usually pemcafe_engine.final_state() of the
+                    calibrated run on the observed series
+    params        : 8 parameters (each scalar or one value per scenario)
+    temperatures  : array (n_scenarios, n_years) of annual mean temperature
+    hbp           : 0/1 or one flag per scenario
+    aboveground   : optional dict with 'Foliages', 'Branches', 'Culms' trajectories,
+                    each broadcastable to (n_scenarios, n_years); by default the
+                    aboveground pools are held at the initial state (steady managed stand);
+                    temperature then changes only AR and GPP, not NEP or the pools
+    output_dir    : if given, every output is written to <output_dir>/<name>.npy as the
+                    run proceeds and the memory-mapped arrays are returned
+
+    Returns a dict of output name -> array (n_years, n_scenarios).
+    """
+    temperatures = np.atleast_2d(np.asarray(temperatures, dtype=float))
+    n_scenarios, n_years = temperatures.shape
+    hbp = np.broadcast_to(np.asarray(hbp, dtype=int), (n_scenarios,))
+
+    trajectories = {}
+    for col in ['Foliages', 'Branches', 'Culms']:
+        if aboveground is not None and col in aboveground:
+            values = np.asarray(aboveground[col], dtype=float)
+        else:
+            # held at the starting pool (one column per scenario)
+            values = np.asarray(initial_state[col], dtype=float).reshape(-1, 1)
+        trajectories[col] = np.broadcast_to(values, (n_scenarios, n_years))
+    undergrowth = np.broadcast_to(np.asarray(undergrowth, dtype=float), (n_scenarios,))
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        store = {name: np.lib.format.open_memmap(os.path.join(output_dir, f"{name}.npy"), mode='w+',
+                                                 dtype=np.float32, shape=(n_years, n_scenarios))
+                 for name in outputs}
+    else:
+        store = {name: np.empty((n_years, n_scenarios), dtype=np.float32) for name in outputs}
+
+    state = {col: np.broadcast_to(np.asarray(initial_state[col], dtype=float), (n_scenarios,)).copy()
+             for col in pemcafe_engine.STATE_COLUMNS}
+
+    for year in range(n_years):
+        drivers = {
+            'AvgTemp': temperatures[:, year],
+            'Foliages': trajectories['Foliages'][:, year],
+            'Branches': trajectories['Branches'][:, year],
+            'Culms': trajectories['Culms'][:, year],
+            'Undergrowth': undergrowth,
+        }
+        values = pemcafe_engine.step_batch(state, drivers, params, hbp, bnpp_method)
+        state = {col: values[col] for col in pemcafe_engine.STATE_COLUMNS}
+
+        for name in outputs:
+            store[name][year] = values[name]
+
+        if output_dir is not None and (year + 1) % flush_every == 0:
+            for arr in store.values():
+                arr.flush()
+        if progress is not None:
+            progress(year + 1, n_years)
+
+    if output_dir is not None:
+        for arr in store.values():
+            arr.flush()
+
+    return store
+
+
+def summarise_projection(store, labels, variables=('NEP', 'TEC', 'GPP', 'AR')):
+    """Per-scenario summary: mean flux over the horizon and final value of each variable"""
+    summary = labels.copy()
+    for name in variables:
+        arr = np.asarray(store[name])
+        summary[f'{name}_mean'] = arr.mean(axis=0)
+        summary[f'{name}_final'] = arr[-1]
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="PEMCAFE long-horizon scenario projection",
+        epilog="Temperature only changes aboveground autotrophic respiration (AR) and so GPP. With the "
+               "aboveground pools held at their last observed values, NEP, HR and the carbon pools "
+               "(TEC, SC, litter) are the same for every warming rate.")
+    parser.add_argument('--input', required=True, help="observed input CSV (same format as the GUI)")
+    parser.add_argument('--weather', help="daily weather workbook used for the baseline temperature")
+    parser.add_argument('--baseline-temp', type=float, help="baseline temperature if no weather file is given")
+    parser.add_argument('--params', type=float, nargs=8, metavar='P', required=True,
+                        help="calibrated parameters (run the GUI or pemcafe_engine.run_analysis first) "
+                             "in the order " + ", ".join(pemcafe_engine.PARAM_NAMES))
+    parser.add_argument('--years', type=int, default=100)
+    parser.add_argument('--warming', type=float, nargs='+', default=[0.0, 0.02, 0.04],
+                        help="warming rates (°C per year)")
+    parser.add_argument('--replicates', type=int, default=100)
+    parser.add_argument('--hbp', type=int, nargs='+', default=[0, 1])
+    parser.add_argument('--bnpp-method', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output-dir', default='projection_results')
+    args = parser.parse_args()
+
+    params = args.params
+    df = pd.read_csv(args.input, encoding='utf-8-sig')
+
+    if args.weather:
+        annual = read_weather_temperature(args.weather)
+        baseline = annual.mean()
+        interannual_sd = annual.std()
+    else:
+        baseline = args.baseline_temp if args.baseline_temp is not None else df['AvgTemp'].iloc[-1]
+        interannual_sd = 0.0
+
+    temperatures, labels = make_temperature_scenarios(baseline, args.years, args.warming,
+                                                      args.replicates, interannual_sd, args.seed)
+    temperatures, hbp, labels = combine_scenarios(temperatures, labels, args.hbp)
+
+    # calibrated run on the observed series gives the starting pools, one per HBP option
+    start = {}
+    for h in args.hbp:
+        observed = pemcafe_engine.run_model(df, params, h, args.bnpp_method)
+        start[h] = pemcafe_engine.final_state(observed)
+    initial_state = {col: np.array([start[h][col] for h in hbp]) for col in pemcafe_engine.STATE_COLUMNS}
+
+    store = run_projection(initial_state, params, temperatures, hbp, args.bnpp_method,
+                           output_dir=args.output_dir)
+    labels.to_csv(os.path.join(args.output_dir, 'scenarios.csv'), index=False)
+    summarise_projection(store, labels).to_csv(os.path.join(args.output_dir, 'summary.csv'), index=False)
+    print(f"{len(labels)} scenarios x {args.years} years written to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
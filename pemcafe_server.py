@@ -0,0 +1,315 @@
+# PEMCAFE local model server
+# small HTTP/JSON service so other tools can run PEMCAFE without the Tk app
+# jobs are queued onto a pool of pre-warmed worker processes (engine and scipy already imported)
+#
+#   python pemcafe_server.py --port 8765 --workers 4
+#
+#   GET    /health               server and queue status
+#   POST   /jobs                 submit one job          -> 202 {"job_id": ...}
+#   POST   /batch                submit {"jobs": [...]}  -> 202 {"job_ids": [...]}
+#   GET    /jobs/<id>            job status (queued, running, done or failed)
+#   GET    /jobs/<id>/result     results (columnar: {"columns": [...], "data": {column: [values]}})
+#   DELETE /jobs/<id>            forget a job
+#
+# job body: {"input": {"columns": [...], "data": {...}} or {"csv": "<csv text>"},
+#            "config": {... see pemcafe_engine.analysis_config ...}}
+
+import argparse
+import io
+import json
+import math
+import multiprocessing
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pemcafe_engine
+import pemcafe_cache
+
+# finished jobs kept in memory before the oldest are dropped
+MAX_FINISHED_JOBS = 1000
+
+# worker side of JobManager.started_queue (set by _warm_worker)
+_started_queue = None
+
+
+def _warm_worker(started_queue=None):
+    """Pool initializer: import the numerical stack and run the model once"""
+    global _started_queue
+    _started_queue = started_queue
+    import pandas as pd
+    params = [pemcafe_engine.DEFAULT_PARAMS[name] for name in pemcafe_engine.PARAM_NAMES]
+    row = {col: 1.0 for col in pemcafe_engine.STATE_COLUMNS + pemcafe_engine.DRIVER_COLUMNS}
+    pemcafe_engine.run_model(pd.DataFrame([row, row]), params)
+
+
+def table_from_json(payload):
+    """DataFrame from a columnar table or CSV text"""
+    import pandas as pd
+    if 'csv' in payload:
+        return pd.read_csv(io.StringIO(payload['csv'].lstrip('\ufeff')))
+    data = payload['data']
+    columns = payload.get('columns', list(data.keys()))
+    return pd.DataFrame({col: data[col] for col in columns}, columns=columns).astype(float)
+
+
+def _json_number(value):
+    """value, or None if it is a non-finite float (strict JSON has no NaN or infinity)"""
+    return None if isinstance(value, float) and not math.isfinite(value) else value
+
+
+def table_to_json(df):
+    """Columnar JSON table; NaN and +/-inf become null"""
+    data = {}
+    for col in df.columns:
+        data[str(col)] = [_json_number(v) for v in df[col].tolist()]
+    return {'columns': [str(c) for c in df.columns], 'data': data}
+
+
+def run_job(input_payload, config, cache_dir=None, job_id=None):
+    """Worker entry point: run one analysis and return a JSON-ready result"""
+    if job_id is not None and _started_queue is not None:
+        _started_queue.put(job_id)
+    df = table_from_json(input_payload)
+    output = pemcafe_engine.run_analysis(df, config,
+                                         state_cache=pemcafe_cache.StateCache(cache_dir),
+                                         result_cache=pemcafe_cache.ResultCache(cache_dir))
+    optimisation = output['optimisation']
+    return {
+        'optimisation': {
+            'success': bool(optimisation.success),
+            'fun': _json_number(float(optimisation.fun)),
+            'nit': optimisation.nit,
+            'nfev': optimisation.nfev,
+            'message': optimisation.message,
+            'params': dict(zip(pemcafe_engine.PARAM_NAMES, [_json_number(float(p)) for p in output['params']])),
+        },
+        'n_failed_simulations': len(output['error_log']),
+        'results': table_to_json(output['results']),
+    }
+
+
+class JobManager:
+    """Job table and the worker pool
+
+    A worker sends the job id through started_queue when it picks a job up; a watcher
+    thread then marks the job 'running', so only jobs still waiting count as pending.
+    """
+
+    def __init__(self, workers=None, max_pending=1000, cache_dir=None):
+        self.started_queue = multiprocessing.Queue()
+        self.pool = multiprocessing.Pool(processes=workers, initializer=_warm_worker,
+                                         initargs=(self.started_queue,))
+        self.workers = workers or multiprocessing.cpu_count()
+        self.max_pending = max_pending
+        self.cache_dir = cache_dir
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.watcher = threading.Thread(target=self._watch_started, daemon=True)
+        self.watcher.start()
+
+    def _watch_started(self):
+        while True:
+            job_id = self.started_queue.get()
+            if job_id is None:
+                break
+            with self.lock:
+                job = self.jobs.get(job_id)
+                if job is not None and job['status'] == 'queued':
+                    job.update(status='running', started=time.time())
+
+    def pending(self):
+        """Jobs waiting for a worker (running jobs are not counted)"""
+        return sum(1 for job in self.jobs.values() if job['status'] == 'queued')
+
+    def validate(self, body):
+        """Check one job body; returns its complete configuration (ValueError if invalid)"""
+        if not isinstance(body, dict) or 'input' not in body:
+            raise ValueError("Job has no 'input' table")
+        config = pemcafe_engine.analysis_config(**body.get('config', {}))
+        if config['time_step'] not in pemcafe_engine.TIME_STEPS:
+            raise ValueError(f"Unknown time_step {config['time_step']}")
+        if config['method'] not in pemcafe_engine.OPTIMISATION_METHODS:
+            raise ValueError(f"Unknown method {config['method']}, expected one of "
+                             f"{', '.join(pemcafe_engine.OPTIMISATION_METHODS)}")
+        if config['run_mc'] and config['output_variables']:
+            pemcafe_engine.check_output_variables(config['output_variables'], config['bnpp_method'])
+        return config
+
+    def submit(self, body):
+        """Queue one job; returns its id"""
+        return self.submit_batch([body])[0]
+
+    def submit_batch(self, bodies):
+        """Queue several jobs, all or none: every job is validated (and the queue checked
+        for room) before the first one is queued. Returns their ids."""
+        configs = [self.validate(body) for body in bodies]
+
+        with self.lock:
+            if self.pending() + len(bodies) > self.max_pending:
+                raise OverflowError("Job queue is full")
+            job_ids = [uuid.uuid4().hex for _ in bodies]
+            for job_id in job_ids:
+                self.jobs[job_id] = {'status': 'queued', 'submitted': time.time(), 'started': None,
+                                     'finished': None, 'result': None, 'error': None}
+
+        for job_id, body, config in zip(job_ids, bodies, configs):
+            self._enqueue(job_id, body['input'], config)
+        return job_ids
+
+    def _enqueue(self, job_id, input_payload, config):
+        def done(result):
+            self._finish(job_id, 'done', result=result)
+
+        def failed(error):
+            self._finish(job_id, 'failed', error=f"{type(error).__name__}: {error}")
+
+        self.pool.apply_async(run_job, (input_payload, config, self.cache_dir, job_id),
+                              callback=done, error_callback=failed)
+
+    def _finish(self, job_id, status, result=None, error=None):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            job.update(status=status, finished=time.time(), result=result, error=error)
+
+            finished = sorted((j['finished'], jid) for jid, j in self.jobs.items() if j['finished'] is not None)
+            for _, old_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                del self.jobs[old_id]
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            info = {'job_id': job_id, 'status': job['status'], 'submitted': job['submitted'],
+                    'started': job['started'], 'finished': job['finished']}
+            if job['error']:
+                info['error'] = job['error']
+            return info
+
+    def result(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def delete(self, job_id):
+        with self.lock:
+            return self.jobs.pop(job_id, None) is not None
+
+    def health(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+        return {'status': 'ok', 'workers': self.workers, 'jobs': counts}
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.started_queue.put(None)
+        self.watcher.join()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """JSON request handler; the JobManager is attached to the server"""
+
+    def _send(self, code, payload):
+        body = json.dumps(payload, allow_nan=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _parts(self):
+        return [p for p in self.path.split('?')[0].split('/') if p]
+
+    def do_GET(self):
+        manager = self.server.manager
+        parts = self._parts()
+        if parts == ['health']:
+            self._send(200, manager.health())
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            info = manager.status(parts[1])
+            if info is None:
+                self._send(404, {'error': 'Unknown job'})
+            else:
+                self._send(200, info)
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'result':
+            job = manager.result(parts[1])
+            if job is None:
+                self._send(404, {'error': 'Unknown job'})
+            elif job['status'] in ('queued', 'running'):
+                self._send(202, {'job_id': parts[1], 'status': job['status']})
+            elif job['status'] == 'failed':
+                self._send(500, {'job_id': parts[1], 'status': 'failed', 'error': job['error']})
+            else:
+                self._send(200, dict(job['result'], job_id=parts[1], status='done'))
+        else:
+            self._send(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        manager = self.server.manager
+        parts = self._parts()
+        try:
+            body = self._read_json()
+            if parts == ['jobs']:
+                self._send(202, {'job_id': manager.submit(body)})
+            elif parts == ['batch']:
+                self._send(202, {'job_ids': manager.submit_batch(body.get('jobs', []))})
+            else:
+                self._send(404, {'error': 'Not found'})
+        except OverflowError as e:
+            self._send(503, {'error': str(e)})
+        except (ValueError, KeyError, TypeError) as e:
+            self._send(400, {'error': str(e)})
+
+    def do_DELETE(self):
+        parts = self._parts()
+        if len(parts) == 2 and parts[0] == 'jobs' and self.server.manager.delete(parts[1]):
+            self._send(200, {'job_id': parts[1], 'deleted': True})
+        else:
+            self._send(404, {'error': 'Unknown job'})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def make_server(host='127.0.0.1', port=8765, workers=None, max_pending=1000, cache_dir=None, verbose=False):
+    """Create the HTTP server and its worker pool (call serve_forever() to start)"""
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.manager = JobManager(workers, max_pending, cache_dir)
+    server.verbose = verbose
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PEMCAFE local model server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--max-pending', type=int, default=1000, help="queued jobs before new ones are refused")
+    parser.add_argument('--cache-dir', default=None, help="cache folder (default ~/.pemcafe_cache)")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.workers, args.max_pending, args.cache_dir, args.verbose)
+    print(f"PEMCAFE server on http://{args.host}:{args.port} with {server.manager.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.manager.close()
+
+
+if __name__ == "__main__":
+    main()
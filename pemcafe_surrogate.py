@@ -0,0 +1,416 @@
+# PEMCAFE surrogate (emulator)
+# polynomial chaos expansion of the model over the parameter bounds: orthonormal Legendre
+# polynomials up to a total degree, fitted by least squares to a Latin hypercube design of real runs
+# emulated: the yearly fit residuals NEP_from_dTEC - NEP (the calibration objective is their RMSE,
+# which is smooth in the residuals but not in the parameters) and the series means of NEP, GPP and TNPP
+# the emulator screens / proposes parameter sets; every proposal is checked with the true model
+# and the emulator error on those fresh runs is reported (then they join the training set)
+# the training design grows only until the leave-one-out error is small enough, and the best
+# proposal is polished by a least-squares fit of the true residuals, which converges in a few
+# Jacobian evaluations from a good start point
+#
+#   surrogate, X, Y = build_surrogate(input_df, bounds)
+#   surrogate.predict(params)       # (n, 4): objective, NEP, GPP, TNPP
+#   surrogate.sobol_indices()       # first-order / total Sobol indices of NEP, GPP, TNPP
+#   result = calibrate_with_surrogate(input_df, bounds)
+
+import itertools
+import numpy as np
+
+import pemcafe_engine
+
+# output columns emulated as the mean over the simulated years
+DEFAULT_OUTPUTS = ('NEP', 'GPP', 'TNPP')
+
+
+def latin_hypercube(bounds, n, seed=0):
+    """n parameter sets spread over the bounds (Latin hypercube design)"""
+    from scipy.stats import qmc
+    lower, upper = np.asarray(bounds, dtype=float).T
+    sample = qmc.LatinHypercube(d=len(lower), seed=seed).random(n)
+    return qmc.scale(sample, lower, upper)
+
+
+def satisfies_constraints(X):
+    """Boolean mask of the parameter sets that meet the turnover-rate ordering constraints"""
+    X = np.atleast_2d(X)
+    return np.all([c['fun'](X.T) >= 0 for c in pemcafe_engine.parameter_constraints()], axis=0)
+
+
+def evaluate_design(input_df, X, hbp=0, bnpp_method=1, dt=1.0, outputs=DEFAULT_OUTPUTS, profiler=None):
+    """True model runs for every parameter set in X
+
+    Returns (Y, residuals):
+    Y         (n, 1 + len(outputs)): the objective (NEP vs NEP_from_dTEC RMSE, as objective_function)
+              and the mean of each output column over the simulated years (t=0 excluded)
+    residuals (n, steps - 1): NEP_from_dTEC - NEP of every simulated year
+    Failed runs give NaN rows.
+    """
+    Y = np.full((len(X), 1 + len(outputs)), np.nan)
+    residuals = np.full((len(X), max(len(input_df) - 1, 0)), np.nan)
+    for i, params in enumerate(X):
+        if profiler is not None:
+            profiler.count('model_evaluations')
+        try:
+            results = pemcafe_engine.run_model(input_df, list(params), hbp, bnpp_method, dt).iloc[1:]
+        except Exception:
+            continue
+        residuals[i] = (results['NEP_from_dTEC'] - results['NEP']).to_numpy(dtype=float)
+        Y[i, 0] = np.sqrt(np.mean(residuals[i]**2))
+        Y[i, 1:] = [results[name].mean() for name in outputs]
+    return Y, residuals
+
+
+def multi_indices(n_dims, degree):
+    """Polynomial degree of each parameter for every basis term (total degree <= degree)"""
+    indices = []
+    for total in range(degree + 1):
+        for combo in itertools.combinations_with_replacement(range(n_dims), total):
+            alpha = np.zeros(n_dims, dtype=int)
+            for d in combo:
+                alpha[d] += 1
+            indices.append(alpha)
+    return np.array(indices)
+
+
+class PCESurrogate:
+    """Polynomial chaos expansion with Legendre polynomials on the parameter bounds
+
+    Fits any number of target columns at once.
+    degree : total polynomial degree (2 needs 45 terms for 8 parameters, 3 needs 165)
+    ridge  : small Tikhonov term keeping the least-squares fit stable
+    """
+
+    def __init__(self, bounds, degree=2, ridge=1e-8):
+        self.lower, self.upper = np.asarray(bounds, dtype=float).T
+        self.degree = degree
+        self.ridge = ridge
+        self.indices = multi_indices(len(self.lower), degree)
+        self.coefficients = None
+        self.loo_rmse = None
+        self.n_train = 0
+
+    @property
+    def n_terms(self):
+        return len(self.indices)
+
+    def basis(self, X):
+        """Design matrix (n, n_terms) of the orthonormal basis at parameter sets X"""
+        z = 2 * (np.atleast_2d(X) - self.lower) / (self.upper - self.lower) - 1
+        # Legendre recurrence, normalised to unit variance on [-1, 1]
+        P = [np.ones_like(z), z]
+        for k in range(1, self.degree):
+            P.append(((2*k + 1) * z * P[k] - k * P[k-1]) / (k + 1))
+        P = [P[k] * np.sqrt(2*k + 1) for k in range(self.degree + 1)]
+
+        A = np.ones((len(z), self.n_terms))
+        for j, alpha in enumerate(self.indices):
+            for d in np.nonzero(alpha)[0]:
+                A[:, j] *= P[alpha[d]][:, d]
+        return A
+
+    def fit(self, X, targets):
+        """Least-squares fit to the runs X -> targets; runs with NaN targets are left out"""
+        X, targets = np.atleast_2d(X), np.asarray(targets, dtype=float).reshape(len(X), -1)
+        ok = np.all(np.isfinite(targets), axis=1)
+        X, targets = X[ok], targets[ok]
+        if len(X) < self.n_terms:
+            raise ValueError(f"{len(X)} valid runs for {self.n_terms} polynomial terms; "
+                             f"use more training runs or a lower degree")
+
+        A = self.basis(X)
+        gram_inv = np.linalg.inv(A.T @ A + self.ridge * np.eye(self.n_terms))
+        self.coefficients = gram_inv @ A.T @ targets
+        self.n_train = len(X)
+
+        # leave-one-out error of every target from the hat matrix, no refits needed
+        residuals = targets - A @ self.coefficients
+        leverage = np.einsum('ij,jk,ik->i', A, gram_inv, A)
+        loo = residuals / (1 - np.minimum(leverage, 1 - 1e-12))[:, None]
+        self.loo_rmse = np.sqrt(np.mean(loo**2, axis=0))
+        return self
+
+    def predict_targets(self, X):
+        """Emulated targets, shape (n, number of target columns)"""
+        return self.basis(X) @ self.coefficients
+
+    def variance_shares(self, column):
+        """First-order and total Sobol indices of one target column, per parameter"""
+        c2 = self.coefficients[:, column]**2
+        order = self.indices.sum(axis=1)
+        variance = c2[order > 0].sum()
+        first = np.zeros(len(self.lower))
+        total = np.zeros(len(self.lower))
+        if variance > 0:
+            for d in range(len(self.lower)):
+                first[d] = c2[(self.indices[:, d] > 0) & (order == self.indices[:, d])].sum() / variance
+                total[d] = c2[self.indices[:, d] > 0].sum() / variance
+        return first, total
+
+
+class ModelSurrogate(PCESurrogate):
+    """Emulator of the calibration objective and of the mean outputs
+
+    The targets are the output means followed by the yearly fit residuals;
+    predict returns the objective (RMSE of the emulated residuals) and the output means.
+    """
+
+    def __init__(self, bounds, degree=2, outputs=DEFAULT_OUTPUTS, ridge=1e-8):
+        super().__init__(bounds, degree, ridge)
+        self.outputs = tuple(outputs)
+
+    @property
+    def names(self):
+        return ('objective',) + self.outputs
+
+    def fit(self, X, Y, residuals):
+        targets = np.hstack([Y[:, 1:], residuals])
+        super().fit(X, targets)
+        spread = np.nanstd(targets, axis=0)
+        self.relative_loo = self.loo_rmse / np.where(spread > 0, spread, 1.0)
+        return self
+
+    def predict(self, X):
+        """Emulated objective and output means, shape (n, 1 + len(outputs))"""
+        targets = self.predict_targets(X)
+        n_outputs = len(self.outputs)
+        residuals = targets[:, n_outputs:]
+        objective = np.sqrt(np.mean(residuals**2, axis=1)) if residuals.shape[1] else np.full(len(targets), 1e6)
+        return np.column_stack([objective, targets[:, :n_outputs]])
+
+    def validate(self, X, Y):
+        """Emulator error against true model runs: {name: {rmse, max_abs_error, r2}}
+
+        r2 is only meaningful for points spread over the bounds; near the optimum the
+        true values hardly vary and r2 says little.
+        """
+        X, Y = np.atleast_2d(X), np.atleast_2d(Y)
+        ok = np.all(np.isfinite(Y), axis=1)
+        if not ok.any():
+            return {}
+        errors = self.predict(X[ok]) - Y[ok]
+        report = {}
+        for k, name in enumerate(self.names):
+            variance = np.var(Y[ok, k])
+            report[name] = {
+                'rmse': float(np.sqrt(np.mean(errors[:, k]**2))),
+                'max_abs_error': float(np.max(np.abs(errors[:, k]))),
+                'r2': float(1 - np.mean(errors[:, k]**2) / variance) if variance > 0 else float('nan'),
+            }
+        return report
+
+    def sobol_indices(self):
+        """{output: {'first_order': {param: S_i}, 'total': {param: S_Ti}}} from the coefficients"""
+        names = pemcafe_engine.PARAM_NAMES[:len(self.lower)]
+        indices = {}
+        for k, name in enumerate(self.outputs):
+            first, total = self.variance_shares(k)
+            indices[name] = {'first_order': dict(zip(names, first.tolist())),
+                             'total': dict(zip(names, total.tolist()))}
+        return indices
+
+
+def build_surrogate(input_df, bounds, n_train=None, degree=2, hbp=0, bnpp_method=1, dt=1.0,
+                    outputs=DEFAULT_OUTPUTS, seed=0, tolerance=0.25, max_train=None, profiler=None):
+    """Run a Latin hypercube design with the true model and fit a ModelSurrogate to it
+
+    With n_train the design has that many runs. Otherwise it starts a little above the number
+    of polynomial terms (54 runs for degree 2) and grows by half the number of terms while the
+    leave-one-out error of any target exceeds tolerance x its spread, up to max_train runs
+    (default 3 runs per term).
+    Returns (surrogate, X, Y) with Y as from evaluate_design.
+    """
+    surrogate = ModelSurrogate(bounds, degree, outputs)
+    n_terms = surrogate.n_terms
+    n_first = n_train or n_terms + max(2, n_terms // 5)
+    max_train = n_train or max_train or 3 * n_terms
+
+    X = latin_hypercube(bounds, n_first, seed)
+    Y, residuals = evaluate_design(input_df, X, hbp, bnpp_method, dt, outputs, profiler)
+    batch = 0
+    while True:
+        try:
+            surrogate.fit(X, Y, residuals)
+            if n_train or np.max(surrogate.relative_loo) <= tolerance:
+                break
+        except ValueError:
+            # too many failed runs for the number of terms
+            if n_train:
+                raise
+        if len(X) >= max_train:
+            if surrogate.coefficients is None:
+                raise ValueError(f"Surrogate could not be fitted with {len(X)} runs")
+            break
+        batch += 1
+        X_new = latin_hypercube(bounds, min(max(2, n_terms // 2), max_train - len(X)), seed + 1000 + batch)
+        Y_new, residuals_new = evaluate_design(input_df, X_new, hbp, bnpp_method, dt, outputs, profiler)
+        X, Y, residuals = np.vstack([X, X_new]), np.vstack([Y, Y_new]), np.vstack([residuals, residuals_new])
+
+    surrogate.training = (X, Y, residuals)
+    return surrogate, X, Y
+
+
+def propose(surrogate, bounds, n_proposals, n_candidates=100000, seed=0):
+    """Parameter sets the emulator rates best (lowest emulated objective)
+
+    n_candidates Latin hypercube points meeting the constraints are screened, and the best
+    one is refined further by minimising the emulated objective (SLSQP). Empty if no candidate
+    meets the constraints.
+    """
+    from scipy.optimize import minimize
+
+    candidates = latin_hypercube(bounds, n_candidates, seed)
+    candidates = candidates[satisfies_constraints(candidates)]
+    if len(candidates) == 0:
+        return candidates
+    predicted = surrogate.predict(candidates)[:, 0]
+    proposals = candidates[np.argsort(predicted)[:n_proposals]]
+
+    refined = minimize(lambda p: surrogate.predict(p)[0, 0], proposals[0], method='SLSQP',
+                       bounds=bounds, constraints=pemcafe_engine.parameter_constraints())
+    if refined.success and satisfies_constraints(refined.x)[0]:
+        proposals = np.vstack([np.clip(refined.x, surrogate.lower, surrogate.upper), proposals[:-1]])
+    return proposals
+
+
+def validation_error(record, surrogate):
+    """One number per round: the largest emulator RMSE on the fresh runs relative to the spread
+    of that output in the training design"""
+    _, Y, _ = surrogate.training
+    spread = np.nanstd(Y, axis=0)
+    errors = [error['rmse'] / spread[k] for k, (name, error) in enumerate(record['error'].items())
+              if spread[k] > 0]
+    return max(errors) if errors else float('inf')
+
+
+def polish_least_squares(input_df, x, bounds, hbp=0, bnpp_method=1, dt=1.0, profiler=None):
+    """Bounded least-squares fit of the yearly residuals NEP_from_dTEC - NEP, starting at x
+
+    Minimises the same RMSE as objective_function. Returns an OptimizeResult with x, fun, nfev.
+    """
+    from scipy.optimize import OptimizeResult, least_squares
+
+    lower, upper = np.asarray(bounds, dtype=float).T
+
+    def residuals(params):
+        if profiler is not None:
+            profiler.count('model_evaluations')
+        results = pemcafe_engine.run_model(input_df, list(params), hbp, bnpp_method, dt).iloc[1:]
+        values = (results['NEP_from_dTEC'] - results['NEP']).to_numpy(dtype=float)
+        return np.where(np.isfinite(values), values, 1e6)
+
+    # least_squares needs a start strictly inside the bounds
+    span = upper - lower
+    start = np.clip(x, lower + 1e-9 * span, upper - 1e-9 * span)
+    fit = least_squares(residuals, start, bounds=(lower, upper))
+    return OptimizeResult(x=fit.x, fun=float(np.sqrt(np.mean(fit.fun**2))), success=bool(fit.success),
+                          nfev=int(fit.nfev + fit.njev * len(start)), message=str(fit.message))
+
+
+def calibrate_with_surrogate(input_df, bounds, hbp=0, bnpp_method=1, dt=1.0, n_train=None, degree=2,
+                             n_rounds=3, n_proposals=10, n_candidates=100000, polish_method='least_squares',
+                             fallback_method='Nelder-Mead', initial_params=None, objective=None, seed=0,
+                             profiler=None, progress=None):
+    """Calibration driven by the emulator
+
+    1. fit the emulator to a Latin hypercube design of true runs (sized by build_surrogate)
+    2. up to n_rounds rounds: propose n_proposals parameter sets from the emulator, run them with
+       the true model and record the emulator error on them (validation); the fresh runs are
+       added and the emulator refitted, until the validation error stops improving
+    3. polish the best true parameter set: 'least_squares' fits the true residuals
+       (polish_least_squares), any other method goes to optimise_parameters (objective is
+       passed on, e.g. to count evaluations); None skips the polish. The polished point is
+       kept only if it is better and meets the parameter constraints (satisfies_constraints)
+
+    If none of the runs is usable (all failed or break the constraints), the result is that of
+    optimise_parameters(fallback_method) from initial_params (default: the middle of the bounds).
+
+    Returns an OptimizeResult with x, fun (true objective), nfev (true model runs),
+    surrogate and validation (one record per round).
+    """
+    from scipy.optimize import OptimizeResult
+
+    def report(message):
+        if progress is not None:
+            progress(message)
+
+    report("Training surrogate...")
+    surrogate, _, _ = build_surrogate(input_df, bounds, n_train, degree, hbp, bnpp_method, dt,
+                                      seed=seed, profiler=profiler)
+    X, Y, residuals = surrogate.training
+    n_outputs = len(surrogate.outputs)
+
+    validation = []
+    previous_error = float('inf')
+    for round_number in range(n_rounds):
+        report(f"Surrogate round {round_number+1}/{n_rounds}")
+        proposals = propose(surrogate, bounds, n_proposals, n_candidates, seed + 1 + round_number)
+        if len(proposals) == 0:
+            break
+        Y_new, residuals_new = evaluate_design(input_df, proposals, hbp, bnpp_method, dt,
+                                               surrogate.outputs, profiler)
+        finite = np.isfinite(Y_new[:, 0])
+        record = {
+            'round': round_number + 1,
+            'n_train': surrogate.n_train,
+            'loo_rmse': dict(zip(surrogate.outputs, surrogate.loo_rmse[:n_outputs].tolist())),
+            'error': surrogate.validate(proposals, Y_new),
+            'best_objective': float(Y_new[finite, 0].min()) if finite.any() else None,
+        }
+        validation.append(record)
+        X, Y, residuals = np.vstack([X, proposals]), np.vstack([Y, Y_new]), np.vstack([residuals, residuals_new])
+
+        error = validation_error(record, surrogate)
+        if error >= previous_error:
+            # refitting no longer makes the emulator better where it matters
+            break
+        previous_error = error
+        if round_number + 1 < n_rounds:
+            surrogate.fit(X, Y, residuals)
+    surrogate.training = (X, Y, residuals)
+    nfev = len(X)
+
+    feasible = np.flatnonzero(satisfies_constraints(X) & np.isfinite(Y[:, 0]))
+    if len(feasible) == 0:
+        report("No usable surrogate runs, falling back to the optimiser...")
+        start = initial_params if initial_params is not None else np.mean(np.asarray(bounds, dtype=float), axis=1)
+        result = pemcafe_engine.optimise_parameters(input_df, start, bounds, fallback_method, hbp, bnpp_method, dt,
+                                                    objective=objective)
+        return OptimizeResult(x=np.asarray(result.x), fun=float(result.fun), success=bool(result.success),
+                              nit=getattr(result, 'nit', None), nfev=nfev + (getattr(result, 'nfev', 0) or 0),
+                              message=f"No usable surrogate runs; {fallback_method}: {getattr(result, 'message', '')}",
+                              surrogate=surrogate, validation=validation)
+
+    best = feasible[np.argmin(Y[feasible, 0])]
+    x, fun = X[best], float(Y[best, 0])
+    message = "Best of the design and surrogate-proposed runs"
+
+    if polish_method is not None:
+        report("Polishing with the true model...")
+        if polish_method == 'least_squares':
+            polished = polish_least_squares(input_df, x, bounds, hbp, bnpp_method, dt, profiler)
+        else:
+            polished = pemcafe_engine.optimise_parameters(input_df, x, bounds, polish_method, hbp, bnpp_method, dt,
+                                                          objective=objective)
+        nfev += getattr(polished, 'nfev', 0) or 0
+        # the polish only keeps the box bounds; a point breaking the turnover ordering is
+        # not a valid calibration, whatever its objective
+        if polished.fun <= fun and satisfies_constraints(np.asarray(polished.x))[0]:
+            x, fun = np.asarray(polished.x), float(polished.fun)
+            message = f"Surrogate start point polished with {polish_method}: {getattr(polished, 'message', '')}"
+        elif polished.fun <= fun:
+            message += f" ({polish_method} result broke the parameter constraints and was not used)"
+
+    return OptimizeResult(x=np.asarray(x), fun=fun, success=True, nit=len(validation), nfev=nfev,
+                          message=message, surrogate=surrogate, validation=validation)
+
+
+def format_validation(validation):
+    """Plain-text table of the per-round emulator errors"""
+    text = "Surrogate validation against the true model:\n"
+    text += f"{'Round':>5} {'Train':>6} {'Output':>10} {'RMSE':>12} {'Max error':>12}\n"
+    for record in validation:
+        for name, error in record['error'].items():
+            text += (f"{record['round']:5d} {record['n_train']:6d} {name:>10} {error['rmse']:12.5f} "
+                     f"{error['max_abs_error']:12.5f}\n")
+    return text
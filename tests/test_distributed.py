@@ -0,0 +1,69 @@
+# checks of the distributed mode with workers on localhost: the merged Monte Carlo statistics
+# and the retry of failing shards
+#
+#   python -m pytest -q
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import pemcafe_distributed
+import pemcafe_engine
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inputdataforPEMCAFE.csv")
+PARAMS = [pemcafe_engine.DEFAULT_PARAMS[name] for name in pemcafe_engine.PARAM_NAMES]
+
+
+class CountingCoordinator(pemcafe_distributed.Coordinator):
+    """Coordinator recording how often each shard was handed out"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.attempts = {}
+
+    def _put(self, shard_id, kind, payload, attempt):
+        self.attempts[shard_id] = self.attempts.get(shard_id, 0) + 1
+        super()._put(shard_id, kind, payload, attempt)
+
+
+@pytest.fixture
+def coordinator():
+    with CountingCoordinator(('127.0.0.1', 0), max_retries=2) as coordinator:
+        workers = pemcafe_distributed.start_local_workers(coordinator.address, coordinator.authkey, 3)
+        yield coordinator
+        for worker in workers:
+            worker.terminate()
+
+
+def test_distributed_monte_carlo_matches_single_machine(coordinator):
+    input_df = pd.read_csv(SAMPLE)
+    sds = pemcafe_engine.DEFAULT_SDS
+    accumulator, error_log = coordinator.run_monte_carlo(input_df, PARAMS, sds, 200, seed=3, chunk_size=40)
+
+    all_results, expected_log = pemcafe_engine.run_monte_carlo(input_df, PARAMS, sds, 200, seed=3)
+    expected = pemcafe_engine.calculate_confidence_intervals(all_results, 0.95)
+    merged = accumulator.ci_results(0.95)
+
+    assert error_log == expected_log
+    assert set(merged) == set(expected)
+    for var, stats in expected.items():
+        for name, values in stats.items():
+            np.testing.assert_allclose(merged[var][name], values, rtol=1e-9, atol=1e-12, err_msg=f"{var} {name}")
+
+
+def test_failing_shard_is_retried_then_reported(coordinator):
+    input_df = pd.read_csv(SAMPLE)
+    good = ('mc', {'input_df': input_df, 'params': PARAMS, 'sds': pemcafe_engine.DEFAULT_SDS, 'seed': 0,
+                   'start': 0, 'count': 5})
+    bad = ('no such kind', {})
+    finished = []
+
+    failures = coordinator.run_shards([good, bad], on_result=lambda index, value: finished.append(index))
+
+    assert finished == [0]
+    assert list(failures) == [1]
+    assert failures[1].startswith("ValueError: Unknown shard kind")
+    # the first attempt and max_retries retries
+    assert sorted(coordinator.attempts.values()) == [1, coordinator.max_retries + 1]
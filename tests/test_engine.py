@@ -0,0 +1,96 @@
+# checks of the model engine: the time step (dt) scaling of calculate_values / step_batch
+#
+#   python -m pytest -q
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import pemcafe_engine
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inputdataforPEMCAFE.csv")
+PARAMS = [pemcafe_engine.DEFAULT_PARAMS[name] for name in pemcafe_engine.PARAM_NAMES]
+
+
+@pytest.fixture
+def sample_df():
+    return pd.read_csv(SAMPLE, encoding='utf-8-sig')
+
+
+def constant_drivers(sample_df, years):
+    """Annual inventory repeating the first row of the sample for the given number of years"""
+    annual = pd.concat([sample_df.iloc[[0]]] * (years + 1), ignore_index=True)
+    annual['t'] = range(years + 1)
+    for col in ['Stumps', 'Rhizomes', 'Roots', 'Litter_layer', 'SC', 'TEC']:
+        annual.loc[1:, col] = np.nan
+    return annual
+
+
+def test_annual_step_is_original_model(sample_df):
+    """dt=1: litter retention is (previous pool + litterfall) * kLitter and step_batch equals run_model"""
+    results = pemcafe_engine.run_model(sample_df, PARAMS, dt=1.0)
+    k = pemcafe_engine.DEFAULT_PARAMS['kLitter']
+    expected = (results['Litter_layer'].shift(1) + results['Litterfall']) * k
+    np.testing.assert_allclose(results['Litter_layer'].iloc[1:], expected.iloc[1:], rtol=1e-12)
+
+    state = pemcafe_engine.initial_state(sample_df.iloc[0])
+    for i in range(len(sample_df)):
+        drivers = {col: sample_df[col].iloc[i] for col in pemcafe_engine.DRIVER_COLUMNS}
+        step = pemcafe_engine.step_batch(state, drivers, PARAMS, dt=1.0)
+        state = {col: step[col] for col in pemcafe_engine.STATE_COLUMNS}
+        for col in ['NEP', 'TNPP', 'Litter_layer', 'DLitter_layer', 'Litter_layer_HR', 'SC', 'TEC']:
+            if i > 0:
+                assert float(step[col]) == pytest.approx(results[col].iloc[i], rel=1e-9)
+
+
+@pytest.mark.parametrize('time_step', ['Monthly', 'Daily'])
+def test_sub_annual_steps_add_up_to_annual_model(sample_df, time_step):
+    """Under constant drivers a year of monthly / daily steps gives the annual fluxes and pools"""
+    years = 30
+    annual = constant_drivers(sample_df, years)
+    dt = pemcafe_engine.TIME_STEPS[time_step]
+    steps_per_year = int(round(1 / dt))
+
+    annual_results = pemcafe_engine.run_model(annual, PARAMS, dt=1.0)
+    fine_results = pemcafe_engine.run_model(pemcafe_engine.interpolate_inventory(annual, steps_per_year),
+                                            PARAMS, dt=dt)
+
+    last_year = fine_results.iloc[-steps_per_year:]
+    for col in ['NEP', 'TNPP', 'Litterfall', 'DLitter_layer', 'Litter_layer_HR', 'Soil_HR', 'Dbelow']:
+        assert last_year[col].sum() == pytest.approx(annual_results[col].iloc[-1], rel=1e-3), col
+    assert fine_results['Litter_layer'].iloc[-1] == pytest.approx(annual_results['Litter_layer'].iloc[-1], rel=1e-3)
+
+
+def test_seeded_perturbation_does_not_change_when_rows_are_appended(sample_df):
+    long_df = pd.concat([sample_df] * 10, ignore_index=True)
+    sds = pemcafe_engine.analysis_config()['sds']
+    split = pemcafe_engine.PERTURB_ROW_BLOCK + 6
+    full = pemcafe_engine.perturb_rows(long_df, sds, 7, 3)
+    resumed = pd.concat([pemcafe_engine.perturb_rows(long_df.iloc[:split], sds, 7, 3),
+                         pemcafe_engine.perturb_rows(long_df, sds, 7, 3, split)])
+    pd.testing.assert_frame_equal(full, resumed)
+
+
+@pytest.mark.parametrize("variables, bnpp_method", [(['NEP', 'NPP'], 1), (['NEP'], 0)])
+def test_output_variables_are_checked_before_optimising(sample_df, variables, bnpp_method):
+    config = pemcafe_engine.analysis_config(output_variables=variables, bnpp_method=bnpp_method)
+    messages = []
+    with pytest.raises(ValueError):
+        pemcafe_engine.run_analysis(sample_df, config, progress=messages.append)
+    assert messages == []
+
+
+def test_monte_carlo_mean_tracks_model_run_at_sub_annual_steps(sample_df):
+    monthly = pemcafe_engine.interpolate_inventory(sample_df, 12)
+    dt = pemcafe_engine.TIME_STEPS['Monthly']
+    model = pemcafe_engine.run_model(monthly, PARAMS, dt=dt)
+    realizations, _ = pemcafe_engine.run_monte_carlo(monthly, PARAMS, pemcafe_engine.DEFAULT_SDS, 200, dt=dt, seed=1)
+    values, _ = pemcafe_engine.run_monte_carlo_arrays(monthly, PARAMS, pemcafe_engine.DEFAULT_SDS, 200,
+                                                      ['TNPP', 'BGC'], dt=dt, seed=1)
+
+    last_year_tnpp = model['TNPP'].iloc[-12:].sum()
+    assert np.mean([r['TNPP'].iloc[-12:].sum() for r in realizations]) == pytest.approx(last_year_tnpp, rel=0.05)
+    assert np.mean([r['BGC'].iloc[-1] for r in realizations]) == pytest.approx(model['BGC'].iloc[-1], rel=0.05)
+    assert values[:, -12:, 0].sum(axis=1).mean() == pytest.approx(last_year_tnpp, rel=0.05)